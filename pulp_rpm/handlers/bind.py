@@ -16,6 +16,7 @@ import os
 from pulp.agent.lib.handler import BindHandler
 from pulp.agent.lib.report import BindReport, CleanReport
 from pulp_rpm.handler import repolib
+from pulp_rpm.common.profile import ProfileRecord
 from logging import getLogger
 
 log = getLogger(__name__)
@@ -98,6 +99,8 @@ class RepoHandler(BindHandler):
         report = CleanReport()
         cfg = conduit.get_consumer_config().graph()
         repolib.delete_repo_file(cfg.filesystem.repo_file)
+        # the next profile uploaded is sent whole
+        ProfileRecord().clear()
         report.set_succeeded()
         return report
 
@@ -35,7 +35,8 @@ _ = gettext.gettext
 
 REQUIRED_CONFIG_KEYS = ["relative_url", "http", "https"]
 OPTIONAL_CONFIG_KEYS = ["protected", "auth_cert", "auth_ca", "https_ca", "gpgkey",  "checksum_type",
-                        "skip", "https_publish_dir", "http_publish_dir", "use_createrepo", "skip_pkg_tags"]
+                        "skip", "https_publish_dir", "http_publish_dir", "use_createrepo", "skip_pkg_tags",
+                        "incremental_publish"]
 
 SUPPORTED_UNIT_TYPES = [TYPE_ID_RPM, TYPE_ID_SRPM, TYPE_ID_DRPM, TYPE_ID_DISTRO]
 HTTP_PUBLISH_DIR="/var/lib/pulp/published/http/repos"
@@ -63,6 +64,8 @@ RELATIVE_URL = '/pulp/repos'
 # gpgkey                - GPG Key associated with the packages in this repo
 # use_createrepo        - This is  mostly a debug flag to override default snippet based metadata generation with createrepo
 #                         False will not run and uses existing metadata from sync
+# incremental_publish   - True/False: Reuse the compressed package metadata of the last publish, only compressing
+#                         the snippets of packages added since then; not used with use_createrepo
 # checksum_type         - Checksum type to use for metadata generation
 # skip                  - List of what content types to skip during sync, options:
 #                         ["rpm", "drpm", "errata", "distribution", "packagegroup"]
@@ -155,6 +158,12 @@ class YumDistributor(Distributor):
                     msg = _("use_createrepo should be a boolean; got %s instead" % use_createrepo)
                     _LOG.error(msg)
                     return False, msg
+            if key == 'incremental_publish':
+                incremental_publish = config.get('incremental_publish')
+                if not isinstance(incremental_publish, bool):
+                    msg = _("incremental_publish should be a boolean; got %s instead" % incremental_publish)
+                    _LOG.error(msg)
+                    return False, msg
             if key == 'checksum_type':
                 checksum_type = config.get('checksum_type')
                 if checksum_type is not None and not util.is_valid_checksum_type(checksum_type):
@@ -545,6 +554,10 @@ class YumDistributor(Distributor):
             repo_relative_path = repo_relative_path[1:]
         repo_cert_utils_obj.delete_for_repo(repo.id)
         protected_repo_utils_obj.delete_protected_repo(repo_relative_path)
+        # the incremental publish cache is kept next to the working dir, not in it
+        unit_metadata_cache_dir = metadata.get_unit_metadata_cache_dir(repo.working_dir)
+        if os.path.isdir(unit_metadata_cache_dir):
+            shutil.rmtree(unit_metadata_cache_dir)
 
     def set_progress(self, type_id, status, progress_callback=None):
         if progress_callback:
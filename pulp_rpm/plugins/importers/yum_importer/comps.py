@@ -24,9 +24,13 @@ from pulp_rpm.common.ids import TYPE_ID_PKG_GROUP, TYPE_ID_PKG_CATEGORY, UNIT_KE
         METADATA_PKG_GROUP, UNIT_KEY_PKG_CATEGORY, METADATA_PKG_CATEGORY
 from pulp_rpm.yum_plugin import comps_util, util
 from pulp.server.db.model.criteria import UnitAssociationCriteria
+from yum_importer import repomd_state
 
 _LOG = util.getLogger(__name__)
 
+# repomd.xml metadata types the package groups and categories are imported from
+COMPS_METADATA_TYPES = ["group", "group_gz"]
+
 
 def form_group_unit_key(grp, repo_id):
     unit_key = {}
@@ -334,6 +338,16 @@ class ImporterComps(object):
 
         start = time.time()
 
+        metadata_checksums = repomd_state.get_metadata_checksums(repo_dir, COMPS_METADATA_TYPES)
+        if not config.get("force_full_sync") and repomd_state.is_unchanged(sync_conduit, metadata_checksums):
+            _LOG.info("comps of <%s> are unchanged since the last sync; skipping package groups and categories" % \
+                    repo.id)
+            set_progress({"state":"FINISHED"})
+            summary = {"unchanged" : True, "num_new_groups" : 0, "num_new_categories" : 0,
+                       "num_orphaned_groups" : 0, "num_orphaned_categories" : 0,
+                       "time_total_sec" : time.time() - start}
+            return True, summary, {}
+
         available_groups, available_categories = get_available(repo_dir)
         _LOG.info("Parsed comps data from <%s>: %s groups and %s categories are available in <%s>" % \
                 (repo_dir, len(available_groups), len(available_categories), repo.id))
@@ -380,4 +394,5 @@ class ImporterComps(object):
 
         details = dict()
         _LOG.info("Comps Summary: %s \n Details: %s" % (summary, details))
+        repomd_state.record_synced_checksums(sync_conduit, metadata_checksums)
         return True, summary, details
@@ -0,0 +1,447 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2013 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+
+"""
+Package download support for the Yum Importer built on the pulp download library
+"""
+import os
+import threading
+import time
+import urlparse
+
+from grinder.BaseFetch import BaseFetch
+from pulp.common.download import factory, listener, request
+from pulp.common.download.config import DownloaderConfig
+from pulp_rpm.common import constants
+from pulp_rpm.yum_plugin import util
+
+_LOG = util.getLogger(__name__)
+
+# Upper bound on the bytes queued to a single host's downloader at once
+DEFAULT_MAX_IN_FLIGHT_BYTES = 512 * 1024 * 1024
+# Upper bound on concurrent downloads from a single host
+DEFAULT_MAX_DOWNLOADS_PER_HOST = constants.DEFAULT_NUM_THREADS
+# Retries of a failed item and seconds waited before each, when num_retries and retry_delay are not configured
+DEFAULT_NUM_RETRIES = 2
+DEFAULT_RETRY_DELAY = 2
+
+EXPECTED_DETAILS = (BaseFetch.RPM, BaseFetch.DELTA_RPM, BaseFetch.TREE_FILE, BaseFetch.FILE)
+# Feed protocols whose items are downloaded natively unless native_download is set to False
+NATIVE_DOWNLOAD_PROTOCOLS = ("http", "https")
+
+
+def use_native_download(config):
+    """
+    Items of remote feeds are fetched with the pulp download library by default, so their
+    units can be saved as each download completes; grinder is used when native_download is
+    False and for local feeds.
+
+    @param config plugin config parameters
+    @type config pulp.server.content.plugins.config.PluginCallConfiguration
+
+    @return True if the items should be downloaded with YumDownloadRun
+    @rtype bool
+    """
+    native_download = config.get("native_download")
+    if native_download is not None:
+        return native_download
+    protocol = urlparse.urlparse(config.get("feed_url") or "")[0]
+    return protocol in NATIVE_DOWNLOAD_PROTOCOLS
+
+
+def get_downloader_config(config, num_threads):
+    """
+    @param config plugin config parameters
+    @type config pulp.server.content.plugins.config.PluginCallConfiguration
+
+    @param num_threads number of concurrent downloads
+    @type num_threads int
+
+    @return downloader configuration
+    @rtype pulp.common.download.config.DownloaderConfig
+    """
+    protocol = urlparse.urlparse(config.get("feed_url"))[0] or "http"
+    sslverify = config.get_boolean("ssl_verify")
+    if sslverify is None:
+        sslverify = True
+    max_speed = config.get("max_speed")
+    if max_speed is not None:
+        max_speed = float(max_speed)
+    downloader_config = {
+        'max_speed': max_speed, 'num_threads': num_threads,
+        'ssl_verify_host': int(sslverify), 'ssl_verify_peer': int(sslverify),
+        'proxy_url': config.get("proxy_url"), 'proxy_port': config.get("proxy_port"),
+        'proxy_user': config.get("proxy_user"), 'proxy_password': config.get("proxy_pass"),
+        'ssl_ca_cert': config.get("ssl_ca_cert"), 'ssl_client_cert': config.get("ssl_client_cert"),
+        'ssl_client_key': config.get("ssl_client_key")}
+    return DownloaderConfig(protocol=protocol, **downloader_config)
+
+
+def fetch_file(url, destination, config):
+    """
+    Downloads a single file, such as the feed's repomd.xml
+
+    @param url url of the file
+    @type url str
+
+    @param destination path the file is written to
+    @type destination str
+
+    @param config plugin config parameters
+    @type config pulp.server.content.plugins.config.PluginCallConfiguration
+
+    @return True when the file was downloaded
+    @rtype bool
+    """
+    fetch_listener = FetchListener()
+    downloader_config = get_downloader_config(config, 1)
+    downloader = factory.get_downloader(downloader_config, fetch_listener)
+    downloader.download([request.DownloadRequest(url, destination)])
+    return fetch_listener.succeeded
+
+
+def get_item_destination(item):
+    """
+    @param item grinder style item info dict
+    @type item {}
+
+    @return path the item should be written to
+    @rtype str
+    """
+    filename = item.get("filename") or item["fileName"]
+    return os.path.join(item["pkgpath"], filename)
+
+
+def split_by_host(items):
+    """
+    @param items grinder style item info dicts
+    @type items [{}]
+
+    @return items grouped by the host serving them, order within a host is preserved
+    @rtype {str:[{}]}
+    """
+    hosts = {}
+    for item in items:
+        host = urlparse.urlparse(item["downloadurl"])[1]
+        hosts.setdefault(host, []).append(item)
+    return hosts
+
+
+def split_by_size(items, max_bytes):
+    """
+    Splits items into batches whose summed size stays within max_bytes; an item
+    larger than max_bytes gets a batch of its own.
+
+    @param items grinder style item info dicts
+    @type items [{}]
+
+    @param max_bytes byte budget of a batch
+    @type max_bytes int
+
+    @return list of batches
+    @rtype [[{}]]
+    """
+    batches = []
+    batch = []
+    batch_bytes = 0
+    for item in items:
+        size = int(item.get("size") or 0)
+        if batch and batch_bytes + size > max_bytes:
+            batches.append(batch)
+            batch = []
+            batch_bytes = 0
+        batch.append(item)
+        batch_bytes += size
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+class DownloadProgress(object):
+    """
+    Download counters shaped like grinder's ProgressReport, so form_report and
+    the content progress report keep working unchanged
+    """
+    def __init__(self):
+        self.items_total = 0
+        self.items_left = 0
+        self.size_total = 0
+        self.size_left = 0
+        self.num_success = 0
+        self.num_error = 0
+        self.error_details = []
+        self.details = {}
+
+
+class ItemDownloadState(object):
+    """
+    Download state of a single item, kept by the run rather than on the item dict
+    """
+    def __init__(self):
+        self.finished = False
+        self.error = None
+        self.bytes_downloaded = 0
+
+
+class DownloadRunReport(object):
+    """
+    Final report of a download run, shaped like grinder's SyncReport
+    """
+    def __init__(self, progress):
+        self.successes = progress.num_success
+        self.downloads = progress.num_success
+        self.errors = progress.num_error
+        self.last_progress = progress
+
+    def __str__(self):
+        return "%s successes, %s errors" % (self.successes, self.errors)
+
+
+class FetchListener(listener.DownloadEventListener):
+    """
+    Records whether the download of a single file succeeded
+    """
+    def __init__(self):
+        self.succeeded = False
+
+    def download_succeeded(self, report):
+        self.succeeded = True
+
+    def download_failed(self, report):
+        _LOG.error("Failed to download %s: %s" % (report.url, getattr(report, "error_report", None)))
+
+
+class YumDownloadRun(listener.DownloadEventListener):
+    """
+    Downloads the items gathered during a yum sync with the pulp download library.
+    Items are grouped by host; each host gets its own downloader, so its connections
+    are kept alive across batches, and at most max_downloads_per_host transfers and
+    max_in_flight_bytes of queued data per host. Hosts are downloaded from in parallel.
+    A failed item is retried up to num_retries times, retry_delay seconds apart, before
+    it is reported as failed.
+
+    Accepts the same addItems/download/stop calls ImporterRPM makes on a YumRepoGrinder.
+    """
+    def __init__(self, config, progress_callback=None, item_callback=None):
+        """
+        @param config plugin config parameters
+        @type config pulp.server.content.plugins.config.PluginCallConfiguration
+
+        @param progress_callback called with the content progress status dict
+        @type progress_callback function
+
+        @param item_callback called with (item, succeeded) as soon as each item finishes
+        @type item_callback function
+        """
+        self.config = config
+        self.progress_callback = progress_callback
+        self.item_callback = item_callback
+        num_threads = config.get("num_threads") or constants.DEFAULT_NUM_THREADS
+        self.max_downloads_per_host = min(num_threads,
+            config.get("max_downloads_per_host") or DEFAULT_MAX_DOWNLOADS_PER_HOST)
+        self.max_in_flight_bytes = config.get("max_in_flight_bytes") or DEFAULT_MAX_IN_FLIGHT_BYTES
+        self.num_retries = config.get("num_retries")
+        if self.num_retries is None:
+            self.num_retries = DEFAULT_NUM_RETRIES
+        self.retry_delay = config.get("retry_delay")
+        if self.retry_delay is None:
+            self.retry_delay = DEFAULT_RETRY_DELAY
+        self.items = []
+        self.canceled = False
+        self.progress = DownloadProgress()
+        self._url_item_map = {}
+        # download url -> ItemDownloadState of the item
+        self._item_states = {}
+        self._lock = threading.RLock()
+
+    def addItems(self, items):
+        """
+        @param items grinder style item info dicts to download
+        @type items [{}]
+        """
+        self.items.extend(items)
+
+    def stop(self):
+        """
+        Stops queueing new batches; transfers already handed to a downloader finish.
+        """
+        self.canceled = True
+
+    def download(self):
+        """
+        Downloads every added item, blocking until all hosts are done.
+
+        @return report of the run
+        @rtype DownloadRunReport
+        """
+        self._init_progress()
+        self._url_item_map = dict([(item["downloadurl"], item) for item in self.items])
+        self._item_states = dict([(url, ItemDownloadState()) for url in self._url_item_map])
+        workers = []
+        for host, items in split_by_host(self.items).items():
+            worker = threading.Thread(target=self._download_host, args=(host, items),
+                                      name="yum-download-%s" % host)
+            worker.setDaemon(True)
+            worker.start()
+            workers.append(worker)
+        for worker in workers:
+            worker.join()
+        self._report_progress(finished=True)
+        return DownloadRunReport(self.progress)
+
+    def _download_host(self, host, items):
+        downloader_config = get_downloader_config(self.config, self.max_downloads_per_host)
+        downloader = factory.get_downloader(downloader_config, self)
+        for batch in split_by_size(items, self.max_in_flight_bytes):
+            if self.canceled:
+                _LOG.info("Download from %s canceled, %s items not queued" % (host, len(batch)))
+                break
+            self._download_batch(host, downloader, batch)
+
+    def _download_batch(self, host, downloader, batch):
+        pending = batch
+        attempt = 0
+        while pending:
+            requests = []
+            for item in pending:
+                destination = get_item_destination(item)
+                util.create_dirs(os.path.dirname(destination))
+                requests.append(request.DownloadRequest(item["downloadurl"], destination))
+            try:
+                downloader.download(requests)
+            except Exception, e:
+                _LOG.exception("Downloading batch of %s items from %s failed" % (len(pending), host))
+                for item in pending:
+                    if not self._state(item).finished:
+                        self._state(item).error = str(e)
+            # items that failed are neither finished nor reported yet
+            failed = [item for item in pending if not self._state(item).finished]
+            if failed and (attempt >= self.num_retries or self.canceled):
+                for item in failed:
+                    self._item_finished(item, False, self._state(item).error)
+                break
+            if failed:
+                attempt += 1
+                _LOG.info("Retrying %s failed items from %s in %s seconds, attempt %s of %s" % \
+                    (len(failed), host, self.retry_delay, attempt, self.num_retries))
+                time.sleep(self.retry_delay)
+            pending = failed
+
+    # -- download event listener ------------------------------------------------
+
+    def download_progress(self, report):
+        item = self._url_item_map.get(report.url)
+        if item is None:
+            return
+        self._lock.acquire()
+        try:
+            state = self._state(item)
+            additional = report.bytes_downloaded - state.bytes_downloaded
+            state.bytes_downloaded = report.bytes_downloaded
+            self.progress.size_left -= additional
+            self._detail(item)["size_left"] -= additional
+        finally:
+            self._lock.release()
+
+    def download_succeeded(self, report):
+        item = self._url_item_map.get(report.url)
+        if item is None:
+            return
+        self.download_progress(report)
+        self._item_finished(item, True)
+
+    def download_failed(self, report):
+        item = self._url_item_map.get(report.url)
+        if item is None:
+            return
+        # the item is reported as failed by _download_batch once it runs out of retries;
+        # a retry starts the transfer over, so its bytes are no longer counted as downloaded
+        self._lock.acquire()
+        try:
+            state = self._state(item)
+            state.error = getattr(report, "error_report", None)
+            downloaded = state.bytes_downloaded
+            state.bytes_downloaded = 0
+            self.progress.size_left += downloaded
+            self._detail(item)["size_left"] += downloaded
+        finally:
+            self._lock.release()
+
+    # -- progress -----------------------------------------------------------------
+
+    def _state(self, item):
+        return self._item_states[item["downloadurl"]]
+
+    def _detail(self, item):
+        return self.progress.details[item.get("item_type", BaseFetch.RPM)]
+
+    def _init_progress(self):
+        progress = DownloadProgress()
+        for key in EXPECTED_DETAILS:
+            progress.details[key] = {"num_success": 0, "num_error": 0, "size_left": 0,
+                "size_total": 0, "items_left": 0, "items_total": 0}
+        for item in self.items:
+            size = int(item.get("size") or 0)
+            detail = progress.details.setdefault(item.get("item_type", BaseFetch.RPM),
+                {"num_success": 0, "num_error": 0, "size_left": 0, "size_total": 0,
+                 "items_left": 0, "items_total": 0})
+            detail["items_total"] += 1
+            detail["items_left"] += 1
+            detail["size_total"] += size
+            detail["size_left"] += size
+            progress.items_total += 1
+            progress.size_total += size
+        progress.items_left = progress.items_total
+        progress.size_left = progress.size_total
+        self.progress = progress
+        self._report_progress()
+
+    def _item_finished(self, item, succeeded, error=None):
+        self._lock.acquire()
+        try:
+            self._state(item).finished = True
+            detail = self._detail(item)
+            self.progress.items_left -= 1
+            detail["items_left"] -= 1
+            if succeeded:
+                self.progress.num_success += 1
+                detail["num_success"] += 1
+            else:
+                # search_for_errors looks for this key on the item
+                item["error"] = error
+                self.progress.num_error += 1
+                detail["num_error"] += 1
+                self.progress.error_details.append({"filename": get_item_destination(item),
+                    "url": item["downloadurl"], "error": str(error)})
+            self._report_progress()
+        finally:
+            self._lock.release()
+        if self.item_callback:
+            self.item_callback(item, succeeded)
+
+    def _report_progress(self, finished=False):
+        if not self.progress_callback:
+            return
+        status = {}
+        if finished:
+            if self.canceled:
+                status["state"] = "CANCELED"
+            else:
+                status["state"] = "FINISHED"
+        else:
+            status["state"] = "IN_PROGRESS"
+        for key in ("num_success", "num_error", "size_left", "size_total", "items_left", "items_total"):
+            status[key] = getattr(self.progress, key)
+        status["error_details"] = list(self.progress.error_details)
+        status["details"] = dict([(k, dict(v)) for k, v in self.progress.details.items()])
+        self.progress_callback(status)
@@ -20,10 +20,15 @@ import yum
 from pulp_rpm.common.ids import TYPE_ID_ERRATA, UNIT_KEY_ERRATA, METADATA_ERRATA
 from pulp_rpm.yum_plugin import util, updateinfo
 from pulp.server.db.model.criteria import UnitAssociationCriteria, Criteria
-from yum_importer import importer_rpm
+from yum_importer import importer_rpm, repomd_state
 
 _LOG = util.getLogger(__name__)
 
+# Number of errata ids looked up per query
+ERRATA_QUERY_LIMIT = 1000
+# repomd.xml metadata types the errata are imported from
+ERRATA_METADATA_TYPES = ["updateinfo"]
+
 def get_available_errata(repo_dir):
     """
         Check and Parses the updateinfo.xml and extract errata items to sync
@@ -90,14 +95,44 @@ def get_orphaned_errata(available_errata, existing_errata):
     return orphaned_errata
 
 
-def get_new_errata_units(available_errata, sync_conduit):
+def get_errata_units_by_id(errata_ids, sync_conduit, limit=ERRATA_QUERY_LIMIT):
+    """
+    Looks up the erratum units with the given ids in every repository
+
+    :param errata_ids:   ids of the errata to look up
+    :type  errata_ids:   iterable of str
+    :param sync_conduit: conduit the units are searched through
+    :type  sync_conduit: pulp.server.content.conduits.repo_sync.RepoSyncConduit
+    :param limit:        number of ids looked up per query
+    :type  limit:        int
+    :return:             the erratum units found, keyed by errata id
+    :rtype:              dict
+    """
+    errata_ids = list(errata_ids)
+    found = {}
+    for index in range(0, len(errata_ids), limit):
+        criteria = Criteria(filters={'id' : {'$in' : errata_ids[index:index + limit]}})
+        for unit in sync_conduit.search_all_units(type_id=TYPE_ID_ERRATA, criteria=criteria):
+            # errata id is unique, there is one unit per id
+            found[unit.unit_key['id']] = unit
+    return found
+
+
+def get_new_errata_units(available_errata, sync_conduit, existing_errata=None):
     """
     Determines which errata to add  or remove and will initialize new units
 
+    The errata already in Pulp are looked up with one query per ERRATA_QUERY_LIMIT
+    ids. An erratum that has not changed is only saved when it is not yet
+    associated with the repository, so it gets an association.
+
     :param available_errata: a dict of available errata
     :type  available_errata: dict
     :param sync_conduit:     The sync conduit to save new units to
     :type  sync_conduit:     pulp.server.content.conduits.repo_sync.RepoSyncConduit
+    :param existing_errata:  errata units already associated with the repository, keyed by
+                             errata id; when not given every unchanged erratum is saved
+    :type  existing_errata:  dict
     :return:                  A tuple of 2 dictionaries and the sync conduit.  First dict is of new
                              errata, second dict is of new units, and I (rbarlow) am not sure why we
                              are returning the sync conduit, but apparently we are.
@@ -105,14 +140,11 @@ def get_new_errata_units(available_errata, sync_conduit):
     """
     new_errata = {}
     new_units = {}
+    if existing_errata is None:
+        existing_errata = {}
+    known_errata = get_errata_units_by_id(available_errata.keys(), sync_conduit)
     for key in available_errata:
-        criteria = Criteria(filters={'id' : key})
-        try:
-            # errata id is unique and will return only 1 entry if matched
-            existing_erratum = sync_conduit.search_all_units(type_id=TYPE_ID_ERRATA,
-                                                             criteria=criteria)[0]
-        except IndexError:
-            existing_erratum = None
+        existing_erratum = known_errata.get(key)
         if existing_erratum:
             if available_errata[key]['updated'] and existing_erratum.metadata['updated']:
                 available_errata_date = available_errata[key]['updated']
@@ -129,16 +161,21 @@ def get_new_errata_units(available_errata, sync_conduit):
                 # Its the same errata as we already have, but the pkglist collections could be
                 # different. compare the collection name in the list of what we already have
                 # if the collection name is missing we add it to delta.
-                coll_names = [plist['name'] for plist in existing_erratum.metadata['pkglist']]
+                coll_names = set([plist['name'] for plist in existing_erratum.metadata['pkglist']])
                 for elist in available_errata[key]['pkglist']:
                     if elist['name'] not in coll_names:
                         # merge the pkglist and save
                         existing_erratum.metadata['pkglist'].append(elist)
+                        coll_names.add(elist['name'])
                         new_units[key] = existing_erratum
                         new_errata[key] = available_errata[key]
-                # We need to save this erratum, so that the repo_content_units collection is sure to
-                # have an entry for the repo for this sync_conduit
-                sync_conduit.save_unit(existing_erratum)
+                if key in new_units:
+                    existing_erratum.metadata[util.ERRATUM_PACKAGE_KEYS] = \
+                        util.get_errata_package_keys(existing_erratum.metadata['pkglist'])
+                if key not in new_units and key not in existing_errata:
+                    # We need to save this erratum, so that the repo_content_units collection is sure to
+                    # have an entry for the repo for this sync_conduit
+                    sync_conduit.save_unit(existing_erratum)
                 continue
         # If we're here, the existing erratum is outdated or doesnt exist. Let's create/update
         # new available erratum.
@@ -160,6 +197,7 @@ def form_errata_metadata(erratum):
     metadata = {}
     for key in METADATA_ERRATA:
         metadata[key] = erratum[key]
+    metadata[util.ERRATUM_PACKAGE_KEYS] = util.get_errata_package_keys(metadata['pkglist'])
     return metadata
 
 def errata_sync_details(errata_list):
@@ -176,7 +214,9 @@ def errata_sync_details(errata_list):
 
 def link_errata_rpm_units(sync_conduit, new_errata_units):
     """
-    Links errata to corresponding rpms
+    Links errata to corresponding rpms. The rpm keys listed by the errata are gathered
+    first, then the repo's rpms with those names are fetched in one query, projected to
+    their unit key, and the errata keys are looked up in them.
 
     @param sync_conduit
     @type sync_conduit pulp.server.content.conduits.repo_sync.RepoSyncConduit
@@ -184,31 +224,47 @@ def link_errata_rpm_units(sync_conduit, new_errata_units):
     @param new_errata_units: errata units to link
     @type  new_errata_units: {}
 
-    @return a link_report dictionry.
+    @return a link_report dictionary with the linked rpm units, the package entries
+            not linked and the number of links made and skipped
     @rtype {}
     """
-    link_report = {}
-    # link errata and rpm units
-    criteria = UnitAssociationCriteria(type_ids=[importer_rpm.RPM_TYPE_ID, importer_rpm.SRPM_TYPE_ID])
-    existing_rpms = importer_rpm.get_existing_units(sync_conduit, criteria=criteria)
-    link_report['linked_units'] = []
-    link_report['missing_rpms'] = []
+    link_report = {'linked_units' : [], 'missing_rpms' : [], 'num_linked' : 0, 'num_skipped' : 0}
+    # rpm lookup key -> package entry for each erratum; an rpm listed in several
+    # collections of an erratum is linked once
+    errata_rpm_keys = []
+    rpm_names = set()
     for u in new_errata_units.values():
-        pkglist = u.metadata['pkglist']
-        for pkg in pkglist:
+        rpm_keys = {}
+        for pkg in u.metadata['pkglist']:
             for pinfo in pkg['packages']:
                 if not pinfo.has_key('sum'):
                     _LOG.debug("Missing checksum info on package <%s> for linking a rpm to an erratum." % (pinfo))
+                    link_report['num_skipped'] += 1
                     continue
                 pinfo['checksumtype'], pinfo['checksum'] = pinfo['sum']
-                rpm_key = importer_rpm.form_lookup_key(pinfo)
-                if rpm_key in existing_rpms.keys():
-                    rpm_unit = existing_rpms[rpm_key]
-                    sync_conduit.link_unit(u, rpm_unit, bidirectional=True)
-                    link_report['linked_units'].append(rpm_unit)
-                else:
-                    link_report['missing_rpms'].append(pinfo)
-                    _LOG.debug("rpm unit %s not found; skipping" % pinfo)
+                rpm_keys[importer_rpm.form_lookup_key(pinfo)] = pinfo
+                rpm_names.add(pinfo['name'])
+        errata_rpm_keys.append((u, rpm_keys))
+    if not rpm_names:
+        return link_report
+
+    criteria = UnitAssociationCriteria(type_ids=[importer_rpm.RPM_TYPE_ID, importer_rpm.SRPM_TYPE_ID],
+                                       unit_fields=list(importer_rpm.RPM_UNIT_KEY),
+                                       unit_filters={'name' : {'$in' : sorted(rpm_names)}})
+    existing_rpms = importer_rpm.get_existing_units(sync_conduit, criteria=criteria)
+    for u, rpm_keys in errata_rpm_keys:
+        for rpm_key, pinfo in rpm_keys.items():
+            rpm_unit = existing_rpms.get(rpm_key)
+            if rpm_unit is None:
+                link_report['missing_rpms'].append(pinfo)
+                link_report['num_skipped'] += 1
+                _LOG.debug("rpm unit %s not found; skipping" % pinfo)
+                continue
+            sync_conduit.link_unit(u, rpm_unit, bidirectional=True)
+            link_report['linked_units'].append(rpm_unit)
+            link_report['num_linked'] += 1
+    _LOG.info("Linked %s rpms to %s errata, skipped %s" %
+              (link_report['num_linked'], len(errata_rpm_keys), link_report['num_skipped']))
     return link_report
 
 class ErrataProgress(object):
@@ -255,6 +311,13 @@ class ImporterErrata(object):
 
         start = time.time()
         repo_dir = "%s/%s" % (repo.working_dir, repo.id)
+        metadata_checksums = repomd_state.get_metadata_checksums(repo_dir, ERRATA_METADATA_TYPES)
+        if not config.get("force_full_sync") and repomd_state.is_unchanged(sync_conduit, metadata_checksums):
+            _LOG.info("updateinfo of <%s> is unchanged since the last sync; skipping errata" % repo.id)
+            set_progress({"state":"FINISHED", "num_errata":0})
+            summary = {"unchanged" : True, "num_new_errata" : 0, "num_orphaned_errata" : 0,
+                       "errata_time_total_sec" : time.time() - start}
+            return True, summary, {}
         available_errata = get_available_errata(repo_dir)
         _LOG.info("Available Errata %s" % len(available_errata))
         progress = {"state":"IN_PROGRESS", "num_errata":len(available_errata)}
@@ -263,7 +326,8 @@ class ImporterErrata(object):
         criteria = UnitAssociationCriteria(type_ids=[TYPE_ID_ERRATA])
         existing_errata = get_existing_errata(sync_conduit, criteria=criteria)
         orphaned_units = get_orphaned_errata(available_errata, existing_errata)
-        new_errata, new_units, sync_conduit = get_new_errata_units(available_errata, sync_conduit)
+        new_errata, new_units, sync_conduit = get_new_errata_units(available_errata, sync_conduit,
+                                                                   existing_errata=existing_errata)
         _LOG.info("%s new_errata, %s new_units" % (len(new_errata), len(new_units)))
         # Save the new units
         for u in new_units.values():
@@ -294,5 +358,6 @@ class ImporterErrata(object):
         _LOG.debug("Errata Summary: %s \n Details: %s" % (summary, details))
         progress = {"state":"FINISHED", "num_errata":len(available_errata)}
         set_progress(progress)
+        repomd_state.record_synced_checksums(sync_conduit, metadata_checksums)
         _LOG.info("Finished errata sync")
         return True, summary, details
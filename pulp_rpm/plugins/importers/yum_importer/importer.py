@@ -19,17 +19,18 @@ import os
 import shutil
 import itertools
 import copy
+import time
 
 from yum_importer.comps import ImporterComps
 from yum_importer.errata import ImporterErrata, link_errata_rpm_units
 from yum_importer.importer_rpm import ImporterRPM, get_existing_units, form_lookup_key
-from pulp.server.db.model.criteria import UnitAssociationCriteria, Criteria
+from pulp.server.db.model.criteria import UnitAssociationCriteria
 from pulp.plugins.importer import Importer
 from pulp.plugins.model import Unit, SyncReport
 from pulp_rpm.common.ids import TYPE_ID_IMPORTER_YUM, TYPE_ID_PKG_GROUP, TYPE_ID_PKG_CATEGORY, TYPE_ID_DISTRO,\
-        TYPE_ID_DRPM, TYPE_ID_ERRATA, TYPE_ID_RPM, TYPE_ID_SRPM
+        TYPE_ID_DRPM, TYPE_ID_ERRATA, TYPE_ID_RPM, TYPE_ID_SRPM, UNIT_KEY_RPM
 from pulp_rpm.common import constants
-from pulp_rpm.yum_plugin import util, depsolver, metadata
+from pulp_rpm.yum_plugin import util, depindex, depsolver, evr
 from pulp_rpm.yum_plugin.metadata import get_package_xml
 
 _ = gettext.gettext
@@ -41,7 +42,9 @@ OPTIONAL_CONFIG_KEYS = ['feed_url', 'ssl_verify', 'ssl_ca_cert', 'ssl_client_cer
                         'proxy_url', 'proxy_port', 'proxy_pass', 'proxy_user',
                         'max_speed', 'verify_size', 'verify_checksum', 'num_threads',
                         'newest', 'remove_old', 'num_old_packages', 'purge_orphaned', 'skip', 'checksum_type',
-                        'num_retries', 'retry_delay', 'resolve_dependencies']
+                        'num_retries', 'retry_delay', 'resolve_dependencies', 'native_download',
+                        'max_downloads_per_host', 'max_in_flight_bytes', 'verify_checksum_cache',
+                        'verify_checksum_max_age', 'force_full_sync']
 ###
 # Config Options Explained
 ###
@@ -56,6 +59,10 @@ OPTIONAL_CONFIG_KEYS = ['feed_url', 'ssl_verify', 'ssl_ca_cert', 'ssl_client_cer
 # proxy_pass: Password for Proxy
 # max_speed: Limit the Max speed in KB/sec per thread during package downloads
 # verify_checksum: if True will verify the checksum for each existing package repo metadata
+# verify_checksum_cache: Defaults to True, when True a package verified by verify_checksum is not re-hashed
+#                        on later syncs unless its inode, size or mtime changed
+# verify_checksum_max_age: Number of days a cached verification is trusted before the package is re-hashed;
+#                          unset trusts it until the file changes
 # verify_size: if True will verify the size for each existing package against repo metadata
 # num_threads: Controls number of threads to use for package download (technically number of processes spawned)
 # newest: Boolean option, if True only download the latest packages
@@ -67,6 +74,24 @@ OPTIONAL_CONFIG_KEYS = ['feed_url', 'ssl_verify', 'ssl_ca_cert', 'ssl_client_cer
 # checksum_type: checksum type to use for repodata; defaults to source checksum type or sha256
 # num_retries: Number of times to retry before declaring an error
 # retry_delay: Minimal number of seconds to wait before each retry
+# native_download: if False download packages with grinder instead of the pulp download library; by default
+#                  http and https feeds use the pulp download library, which saves each package as soon as
+#                  its download completes, and file feeds use grinder
+# max_downloads_per_host: Limit on concurrent downloads from one host with the pulp download library
+# max_in_flight_bytes: Limit on bytes queued to one host's downloader with the pulp download library
+# force_full_sync: if True always process the full repo metadata; by default a sync whose feed repomd.xml
+#                  revision and the checksums of every metadata type it lists match the last successful
+#                  sync returns without fetching anything else, so packages removed from disk are not re-fetched
+
+def unit_key_id(unit_key):
+    """
+    @param unit_key: unit key
+    @type  unit_key: dict
+
+    @return hashable form of the unit key, used for set lookups
+    @rtype tuple
+    """
+    return tuple(sorted(unit_key.items()))
 
 class YumImporter(Importer):
     def __init__(self):
@@ -190,6 +215,20 @@ class YumImporter(Importer):
                     _LOG.error(msg)
                     return False, msg
 
+            if key == 'verify_checksum_cache':
+                value = config.get(key)
+                if value is not None and not isinstance(value, bool) :
+                    msg = _("verify_checksum_cache should be a boolean; got %s instead" % value)
+                    _LOG.error(msg)
+                    return False, msg
+
+            if key == 'verify_checksum_max_age':
+                value = config.get(key)
+                if value is not None and (not isinstance(value, int) or value < 0):
+                    msg = _("verify_checksum_max_age should be a non-negative integer; got %s instead" % value)
+                    _LOG.error(msg)
+                    return False, msg
+
             if key == 'verify_size':
                 verify_size = config.get('verify_size')
                 if verify_size is not None and not isinstance(verify_size, bool) :
@@ -252,6 +291,27 @@ class YumImporter(Importer):
                     _LOG.error(msg)
                     return False, msg
 
+            if key == 'native_download':
+                native_download = config.get('native_download')
+                if native_download is not None and not isinstance(native_download, bool) :
+                    msg = _("native_download should be a boolean; got %s instead" % native_download)
+                    _LOG.error(msg)
+                    return False, msg
+
+            if key == 'force_full_sync':
+                force_full_sync = config.get('force_full_sync')
+                if force_full_sync is not None and not isinstance(force_full_sync, bool) :
+                    msg = _("force_full_sync should be a boolean; got %s instead" % force_full_sync)
+                    _LOG.error(msg)
+                    return False, msg
+
+            if key in ('max_downloads_per_host', 'max_in_flight_bytes'):
+                value = config.get(key)
+                if value is not None and (not isinstance(value, int) or value < 1):
+                    msg = _("%(k)s should be a positive integer; got %(v)s instead") % {'k' : key, 'v' : value}
+                    _LOG.error(msg)
+                    return False, msg
+
             if key == 'resolve_dependencies':
                 value = config.get(key)
                 if value is not None and not isinstance(value, bool) :
@@ -280,41 +340,61 @@ class YumImporter(Importer):
         @param units: optional list of pre-filtered units to import
         @type  units: list of L{pulp.plugins.data.Unit}
         """
+        start = time.time()
         if not units:
             # If no units are passed in, assume we will use all units from source repo
             units = import_conduit.get_source_units()
         blacklist_units = self._query_blacklist_units(import_conduit, config)
         _LOG.info("Importing %s units from %s to %s" % (len(units), source_repo.id, dest_repo.id))
         existing_rpm_units_dict = get_existing_units(import_conduit, criteria=UnitAssociationCriteria(type_ids=[TYPE_ID_RPM, TYPE_ID_SRPM]))
+        lookup_time = time.time()
+        # rpm units imported directly or through an erratum; their dependencies are resolved together
+        rpm_units = []
+        # package groups and categories whose members are looked up together once every unit is associated
+        pkg_group_units = []
+        pkg_category_units = []
         for u in units:
-            if u.unit_key in blacklist_units:
+            if blacklist_units and unit_key_id(u.unit_key) in blacklist_units:
                 continue
             # do any additional work associated with the unit
             if u.type_id == TYPE_ID_RPM:
                 import_conduit.associate_unit(u)
-                # if its an rpm unit process dependencies and import them as well
-                self._import_unit_dependencies(source_repo, [u], import_conduit, config,
-                    existing_rpm_units=existing_rpm_units_dict, blacklist_units=blacklist_units)
+                rpm_units.append(u)
             elif u.type_id == TYPE_ID_ERRATA:
                 import_conduit.associate_unit(u)
-                # if erratum, lookup deps and process associated units
-                self._import_errata_unit_rpms(source_repo, u, import_conduit, config,
-                    existing_rpm_units_dict, blacklist_units=blacklist_units)
+                # if erratum, lookup and import the associated rpm units
+                rpm_units.extend(self._import_errata_unit_rpms(source_repo, u, import_conduit, config,
+                    existing_rpm_units_dict, blacklist_units=blacklist_units))
             elif u.type_id == TYPE_ID_PKG_GROUP:
                 u = self._safe_copy_unit(u)
                 u.unit_key['repo_id'] = dest_repo.id
                 import_conduit.save_unit(u)
-                # pkg group unit associated, lookup child units underneath and import them as well
-                self._import_pkg_group_unit(source_repo, u, import_conduit, config)
+                pkg_group_units.append(u)
             elif u.type_id == TYPE_ID_PKG_CATEGORY:
                 u = self._safe_copy_unit(u)
                 u.unit_key['repo_id'] = dest_repo.id
                 import_conduit.save_unit(u)
-                # pkg category associated, lookup pkg groups underneath and import them as well
-                self._import_pkg_category_unit(source_repo, u, import_conduit, config)
+                pkg_category_units.append(u)
             elif u.type_id == TYPE_ID_DISTRO:
                 import_conduit.associate_unit(u)
+        if pkg_category_units:
+            # pkg categories associated, lookup pkg groups underneath and import them as well
+            pkg_group_units.extend(self._import_pkg_category_units(source_repo, pkg_category_units,
+                import_conduit, config))
+        if pkg_group_units:
+            # pkg groups associated, lookup child units underneath and import them as well
+            self._import_pkg_group_units(source_repo, pkg_group_units, import_conduit, config,
+                blacklist_units=blacklist_units)
+        associate_time = time.time()
+        if rpm_units:
+            # process the dependencies of every imported rpm in one solve and import them as well
+            self._import_unit_dependencies(source_repo, rpm_units, import_conduit, config,
+                existing_rpm_units=existing_rpm_units_dict, blacklist_units=blacklist_units)
+        end = time.time()
         _LOG.debug("%s units from %s have been associated to %s" % (len(units), source_repo.id, dest_repo.id))
+        _LOG.info("Import from %s to %s completed in %s seconds: blacklist and existing unit lookups %s, "
+                  "associations %s, dependency resolution %s" % (source_repo.id, dest_repo.id, end - start,
+                  lookup_time - start, associate_time - lookup_time, end - associate_time))
 
     def _safe_copy_unit(self, unit):
         """
@@ -332,26 +412,29 @@ class YumImporter(Importer):
 
     def _query_blacklist_units(self, import_conduit, config):
         """
-        @param unfiltered_units: list of prefiltered units L{pulp.plugins.data.Unit}
-        @type  unfiltered_units: list of L{pulp.plugins.data.Unit}
+        @param import_conduit: provides access to relevant Pulp functionality
+        @type  import_conduit: L{pulp.plugins.conduits.unit_import.ImportUnitConduit}
         @param config: plugin configuration
         @type  config: L{pulp.plugins.plugins.config.PluginCallConfiguration}
+        @return: unit key ids, see unit_key_id, of the source rpm units whose filename
+                 matches one of the blacklist patterns
+        @rtype:  set
         """
-        blacklist = []
-        if not config.get('blacklist'):
+        blacklist = set()
+        patterns = config.get('blacklist')
+        if not patterns:
             return blacklist
-        pattern =  config.get('blacklist')
-        for p in pattern:
-            criteria = UnitAssociationCriteria(type_ids=TYPE_ID_RPM, unit_filters={'filename' : {'$regex' : p}})
-            found_blklist = import_conduit.get_source_units(criteria=criteria)
-            if found_blklist:
-                blacklist.extend(found_blklist)
-        blacklist = [unit.unit_key for unit in blacklist]
+        # a single query matching any of the patterns
+        regex = "|".join(["(?:%s)" % p for p in patterns])
+        criteria = UnitAssociationCriteria(type_ids=TYPE_ID_RPM, unit_filters={'filename' : {'$regex' : regex}})
+        for unit in import_conduit.get_source_units(criteria=criteria):
+            blacklist.add(unit_key_id(unit.unit_key))
         return blacklist
 
     def _import_errata_unit_rpms(self, source_repo, erratum_unit, import_conduit, config, existing_rpm_units=None, blacklist_units=None):
         """
-        lookup rpms units associated with an erratum; resolve deps and import rpm units
+        lookup rpms units associated with an erratum and import them; their dependencies
+        are left to the caller so they can be resolved together with other units
         @param source_repo: metadata describing the repository containing the
                units to import
         @type  source_repo: L{pulp.plugins.data.Repository}
@@ -368,9 +451,14 @@ class YumImporter(Importer):
 
         @param existing_rpm_units: optional list of pre-filtered units to import
         @type  existing_rpm_units: list of L{pulp.plugins.data.Unit}
+
+        @return: the rpm units imported
+        @rtype:  list of L{pulp.plugins.data.Unit}
         """
         pkglist = erratum_unit.metadata['pkglist']
         existing_rpm_units = existing_rpm_units or {}
+        blacklist_units = blacklist_units or set()
+        rpm_units = []
         for pkg in pkglist:
             for pinfo in pkg['packages']:
                 if not pinfo.has_key('sum'):
@@ -378,28 +466,28 @@ class YumImporter(Importer):
                     continue
                 pinfo['checksumtype'], pinfo['checksum'] = pinfo['sum']
                 rpm_key = form_lookup_key(pinfo)
-                if rpm_key in existing_rpm_units.keys():
-                    if rpm_key in blacklist_units:
+                if rpm_key in existing_rpm_units:
+                    rpm_unit = existing_rpm_units[rpm_key]
+                    if unit_key_id(rpm_unit.unit_key) in blacklist_units:
                         _LOG.debug("package %s blacklisted; skip import" % pinfo)
                         continue
-                    rpm_unit = existing_rpm_units[rpm_key]
                     import_conduit.associate_unit(rpm_unit)
-                    # process any deps
-                    self._import_unit_dependencies(source_repo, [rpm_unit], import_conduit, config, existing_rpm_units=existing_rpm_units)
+                    rpm_units.append(rpm_unit)
                     _LOG.debug("Found matching rpm unit %s" % rpm_unit)
                 else:
                     _LOG.debug("rpm unit %s not found; skipping" % pinfo)
+        return rpm_units
 
-    def _import_pkg_category_unit(self, source_repo, pkg_category_unit, import_conduit, config):
+    def _import_pkg_category_units(self, source_repo, pkg_category_units, import_conduit, config):
         """
-        looks up the package category and associated groups within and imports the units
+        looks up the package groups of the package categories in the source repo and
+        imports them; the groups of every category are looked up in a single query
         @param source_repo: metadata describing the repository containing the
                units to import
         @type  source_repo: L{pulp.plugins.data.Repository}
 
-        @param pkg_category_unit: package category unit to lookup child units for to import
-               into
-        @type  pkg_category_unit: L{pulp.plugins.data.Unit}
+        @param pkg_category_units: package category units to lookup child units for to import
+        @type  pkg_category_units: list of L{pulp.plugins.data.Unit}
 
         @param import_conduit: provides access to relevant Pulp functionality
         @type  import_conduit: L{pulp.plugins.conduits.unit_import.ImportUnitConduit}
@@ -407,48 +495,65 @@ class YumImporter(Importer):
         @param config: plugin configuration
         @type  config: L{pulp.plugins.plugins.config.PluginCallConfiguration}
 
+        @return: the package group units imported
+        @rtype:  list of L{pulp.plugins.data.Unit}
         """
-        pkg_group_unit_ids = pkg_category_unit.metadata['packagegroupids']
-        for pgid in pkg_group_unit_ids:
-            criteria = Criteria(filters={'id' : pgid})
-            found_pkggrp = import_conduit.search_all_units(type_id=TYPE_ID_PKG_GROUP, criteria=criteria)
-            if not len(found_pkggrp):
-                # couldnt find the pkggrp, continue to the next one
-                _LOG.debug(" Package group id %s not found" % found_pkggrp)
-                continue
-            import_conduit.associate_unit(found_pkggrp[0])
-            # import any associated packages
-            self._import_pkg_group_unit(source_repo, found_pkggrp[0], import_conduit, config)
-            _LOG.debug("Associated Package group id %s" % found_pkggrp)
-
-    def _import_pkg_group_unit(self, source_repo, pkg_group_unit, import_conduit, config):
+        pkg_group_ids = set()
+        for pkg_category_unit in pkg_category_units:
+            pkg_group_ids.update(pkg_category_unit.metadata['packagegroupids'] or [])
+        if not pkg_group_ids:
+            return []
+        criteria = UnitAssociationCriteria(type_ids=[TYPE_ID_PKG_GROUP],
+            unit_filters={'id' : {'$in' : list(pkg_group_ids)}})
+        found_pkggrps = {}
+        for pkggrp in import_conduit.get_source_units(criteria=criteria):
+            pgid = pkggrp.unit_key['id']
+            if pgid in pkg_group_ids and pgid not in found_pkggrps:
+                found_pkggrps[pgid] = pkggrp
+        for pgid in pkg_group_ids.difference(found_pkggrps):
+            # couldnt find the pkggrp, continue to the next one
+            _LOG.debug(" Package group id %s not found" % pgid)
+        for pkggrp in found_pkggrps.values():
+            import_conduit.associate_unit(pkggrp)
+        _LOG.debug("Associated Package group ids %s" % found_pkggrps.keys())
+        return found_pkggrps.values()
+
+    def _import_pkg_group_units(self, source_repo, pkg_group_units, import_conduit, config, blacklist_units=None):
         """
-        look up package groups and associated packages and import the units
+        look up the packages of package groups in the source repo and import the newest
+        of each name and arch; the packages of every group are looked up in a single query
         @param source_repo: metadata describing the repository containing the
                units to import
         @type  source_repo: L{pulp.plugins.data.Repository}
 
-        @param pkg_group_unit: package group unit to lookup child units for to import
-               into
-        @type  pkg_group_unit: L{pulp.plugins.data.Unit}
+        @param pkg_group_units: package group units to lookup child units for to import
+        @type  pkg_group_units: list of L{pulp.plugins.data.Unit}
 
         @param import_conduit: provides access to relevant Pulp functionality
         @type  import_conduit: L{pulp.plugins.conduits.unit_import.ImportUnitConduit}
 
         @param config: plugin configuration
         @type  config: L{pulp.plugins.plugins.config.PluginCallConfiguration}
+
+        @param blacklist_units: unit key ids of the blacklisted units, see unit_key_id
+        @type  blacklist_units: set
         """
-        mandatory_pkg_names = pkg_group_unit.metadata["mandatory_package_names"] or []
-        optional_pkg_names = pkg_group_unit.metadata["optional_package_names"] or []
-        conditional_pkg_names = [cond_pkg[0] for cond_pkg in pkg_group_unit.metadata["conditional_package_names"]]
-        default_pkg_names = pkg_group_unit.metadata['default_package_names'] or []
-        for pname in mandatory_pkg_names + optional_pkg_names + conditional_pkg_names + default_pkg_names:
-            criteria = Criteria(filters={'name' : pname})
-            found_pkgs = import_conduit.search_all_units(type_id=TYPE_ID_RPM, criteria=criteria)
-            if not len(found_pkgs):
-                continue
-            newest = self._find_newest_pkg(found_pkgs)
-            map(import_conduit.associate_unit, newest)
+        pkg_names = set()
+        for pkg_group_unit in pkg_group_units:
+            mandatory_pkg_names = pkg_group_unit.metadata["mandatory_package_names"] or []
+            optional_pkg_names = pkg_group_unit.metadata["optional_package_names"] or []
+            conditional_pkg_names = [cond_pkg[0] for cond_pkg in pkg_group_unit.metadata["conditional_package_names"] or []]
+            default_pkg_names = pkg_group_unit.metadata['default_package_names'] or []
+            pkg_names.update(mandatory_pkg_names + optional_pkg_names + conditional_pkg_names + default_pkg_names)
+        if not pkg_names:
+            return
+        criteria = UnitAssociationCriteria(type_ids=[TYPE_ID_RPM], unit_fields=list(UNIT_KEY_RPM),
+            unit_filters={'name' : {'$in' : list(pkg_names)}})
+        found_pkgs = [u for u in import_conduit.get_source_units(criteria=criteria) if u.unit_key['name'] in pkg_names]
+        # newest package of each name and arch
+        newest = self._find_newest_pkg(found_pkgs, blacklist_units=blacklist_units)
+        map(import_conduit.associate_unit, newest)
+        _LOG.debug("Associated %s packages of %s package groups" % (len(newest), len(pkg_group_units)))
 
     def _find_newest_pkg(self, list_rpms, blacklist_units=None):
         """
@@ -456,17 +561,9 @@ class YumImporter(Importer):
         @param list_rpms: list of rpm units
         @return: returns newest rpm unit by rpm.name, rpm.arch
         """
-        newest = {}
-        for pkg in list_rpms:
-            pkg_unit_key = pkg.unit_key
-            if blacklist_units and pkg_unit_key in blacklist_units:
-                continue
-            if (pkg_unit_key["name"], pkg_unit_key["arch"]) not in newest:
-                newest[(pkg_unit_key["name"], pkg_unit_key["arch"])] = pkg
-            else:
-                pkg2 = newest[(pkg_unit_key["name"], pkg_unit_key["arch"])]
-                if util.is_rpm_newer(pkg_unit_key, pkg2.unit_key):
-                    newest[(pkg_unit_key["name"], pkg_unit_key["arch"])] = pkg
+        if blacklist_units:
+            list_rpms = [pkg for pkg in list_rpms if unit_key_id(pkg.unit_key) not in blacklist_units]
+        newest = evr.newest_rpms(list_rpms, key=lambda pkg: pkg.unit_key)
         return newest.values()
 
     def _import_unit_dependencies(self, source_repo, units, import_conduit, config, existing_rpm_units=None, blacklist_units=None):
@@ -481,9 +578,15 @@ class YumImporter(Importer):
         missing_deps =\
             self.find_missing_dependencies(source_repo, units, import_conduit, config, existing_rpm_units=existing_rpm_units)
         _LOG.debug("missing deps found %s" % missing_deps)
+        blacklist_units = blacklist_units or set()
+        # skip units already imported and dependencies shared by several of them
+        imported = set([form_lookup_key(u.unit_key) for u in units])
         for dep in missing_deps:
-            if dep.unit_key not in blacklist_units:
-                import_conduit.associate_unit(dep)
+            key = form_lookup_key(dep.unit_key)
+            if key in imported or unit_key_id(dep.unit_key) in blacklist_units:
+                continue
+            imported.add(key)
+            import_conduit.associate_unit(dep)
 
     # -- actions --------------------------------------------------------------
 
@@ -614,6 +717,7 @@ class YumImporter(Importer):
             return False, summary, details
         # get the xml dumps for the pkg
         u.metadata["repodata"] = get_package_xml(new_path)
+        u.metadata[util.REPODATA_DIGEST] = util.get_repodata_digest(u.metadata["repodata"])
         conduit.save_unit(u)
         summary['num_units_processed'] = len([file_path])
         summary['num_units_saved'] = len([file_path])
@@ -630,6 +734,8 @@ class YumImporter(Importer):
         summary = {'num_units_saved' : 0}
         details = {'errors' : []}
         try:
+            if 'pkglist' in metadata:
+                metadata[util.ERRATUM_PACKAGE_KEYS] = util.get_errata_package_keys(metadata['pkglist'])
             u = conduit.init_unit(TYPE_ID_ERRATA, unit_key, metadata, None)
             conduit.save_unit(u)
             summary['num_units_saved'] += 1
@@ -662,47 +768,35 @@ class YumImporter(Importer):
     def resolve_dependencies(self, repo, units, dependency_conduit, config):
         result_dict = {}
         pkglist =  self.pkglist(units)
-        # generate metadata for the source repo
-        metadata_status, metadata_errors = self._generate_metadata(repo, dependency_conduit, config)
-        if not metadata_status:
-            # unable to generate metadata, lets fail right here as dependency resolver wont handle this
-            # gracefully.
-            msg = "Failed to generate metadata for repo %s; Error %s" % (repo.id, metadata_errors)
-            _LOG.error(msg)
-            raise metadata.GenerateYumMetadataException(msg)
-        dsolve = depsolver.DepSolver([repo], pkgs=pkglist)
-        if config.get('recursive'):
-            results = dsolve.getRecursiveDepList()
-        else:
-            results = dsolve.getDependencylist()
-        solved, unsolved = dsolve.processResults(results)
-        dep_pkgs_map = {}
-        _LOG.debug(" results from depsolver %s" % results)
-        criteria = UnitAssociationCriteria(type_ids=[TYPE_ID_RPM])
-        existing_units = get_existing_units(dependency_conduit, criteria)
-        for dep, pkgs in solved.items():
-            dep_pkgs_map[dep] = []
-            for pkg in pkgs:
-                if not existing_units.has_key(pkg):
-                    continue
-                epkg = existing_units[pkg]
-                dep_pkgs_map[dep].append(epkg.unit_key)
-        _LOG.debug("deps packages suggested %s" % solved)
-        result_dict['resolved'] = dep_pkgs_map
-        result_dict['unresolved'] = unsolved
-        result_dict['printable_dependency_result'] = dsolve.printable_result(results)
-        dsolve.cleanup()
+        # answer from the repo's dependency index rather than generating its metadata
+        index = depindex.DependencyIndex(depindex.index_path(repo))
+        try:
+            index.update(dependency_conduit)
+            dsolve = depsolver.DepSolver([repo], pkgs=pkglist, index=index)
+            if config.get('recursive'):
+                results = dsolve.getRecursiveDepList()
+            else:
+                results = dsolve.getDependencylist()
+            solved, unsolved = dsolve.processResults(results)
+            dep_pkgs_map = {}
+            _LOG.debug(" results from depsolver %s" % results)
+            criteria = UnitAssociationCriteria(type_ids=[TYPE_ID_RPM])
+            existing_units = get_existing_units(dependency_conduit, criteria)
+            for dep, pkgs in solved.items():
+                dep_pkgs_map[dep] = []
+                for pkg in pkgs:
+                    if not existing_units.has_key(pkg):
+                        continue
+                    epkg = existing_units[pkg]
+                    dep_pkgs_map[dep].append(epkg.unit_key)
+            _LOG.debug("deps packages suggested %s" % solved)
+            result_dict['resolved'] = dep_pkgs_map
+            result_dict['unresolved'] = unsolved
+            result_dict['printable_dependency_result'] = dsolve.printable_result(results)
+        finally:
+            index.close()
         return result_dict
 
-    def _generate_metadata(self, repo, conduit, config):
-        _LOG.info("Generating metadata for source repo %s" % repo.id)
-        metadata_status, metadata_errors = metadata.generate_yum_metadata(
-            os.path.join(repo.working_dir, repo.id), conduit, config,
-            is_cancelled=self.canceled, repo_scratchpad=conduit.get_repo_scratchpad())
-        _LOG.debug("metadata generation complete; metadata status : %s; errors : %s" %
-                  (metadata_status, metadata_errors))
-        return metadata_status, metadata_errors
-
     def cancel_sync_repo(self, call_request, call_report):
         self.canceled = True
         self.comps.cancel_sync()
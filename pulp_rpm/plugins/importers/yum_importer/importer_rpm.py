@@ -11,16 +11,20 @@
 # have received a copy of GPLv2 along with this software; if not, see
 # http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
 import gzip
+import heapq
 import os
+import threading
 import time
 import itertools
+import urlparse
 
 from grinder.BaseFetch import BaseFetch
 from grinder.GrinderCallback import ProgressReport
 from grinder.RepoFetch import YumRepoGrinder
+from pulp.common.util import decode_unicode
 from pulp.server.db.model.criteria import UnitAssociationCriteria
 from pulp_rpm.yum_plugin import util, metadata
-from yum_importer import distribution, drpm
+from yum_importer import distribution, download, drpm, repomd_state
 import pulp_rpm.common.constants as constants
 
 _LOG = util.getLogger(__name__)
@@ -33,6 +37,35 @@ RPM_UNIT_KEY = ("name", "epoch", "version", "release", "arch", "checksum", "chec
 PROGRESS_REPORT_FIELDS = ["state", "items_total", "items_left", "size_total", "size_left",
     "num_error", "num_success", "details", "error_details"]
 
+# Field order used when streaming existing units out of the database, must match form_lookup_key
+RPM_SORT_FIELDS = util.RPM_SORT_FIELDS
+# Number of existing units fetched per query while diffing the source repo against pulp
+DIFF_BATCH_SIZE = 500
+
+DIFF_NEW = "new"
+DIFF_EXISTING = "existing"
+DIFF_ORPHANED = "orphaned"
+
+# Verification cache kept in the importer working dir when verify_checksum is enabled
+VERIFY_CACHE_FILENAME = "verify_checksum_cache.db"
+
+# Metadata types whose checksums the errata and comps imports record once they are imported;
+# the rpm sync records the checksums of every other type the feed lists
+SEPARATELY_RECORDED_TYPES = ["updateinfo", "group", "group_gz"]
+# The metadata state is not recorded while one of these is skipped, so the next sync without
+# the skip does the full sync
+RECORDED_CONTENT_TYPES = ("rpm", "drpm", "distribution")
+# Temporary copy of the feed repomd.xml in the importer working dir
+FEED_REPOMD_FILENAME = "feed_repomd.xml"
+
+
+class DiffOrderError(Exception):
+    """
+    Raised when an input to diff_rpms is not sorted by form_sort_key
+    """
+    pass
+
+
 def get_existing_units(sync_conduit, criteria=None):
    """
    @param sync_conduit
@@ -100,17 +133,9 @@ def get_new_rpms_and_units(available_rpms, existing_units, sync_conduit):
         if key not in existing_units:
             rpm = available_rpms[key]
             new_rpms[key] = rpm
-            unit_key = form_rpm_unit_key(rpm)
-            metadata = form_rpm_metadata(rpm)
-            pkgpath = os.path.join(rpm["pkgpath"], metadata["filename"])
-            if rpm['arch'] == 'src':
-                # initialize unit as a src rpm
-                new_units[key] = sync_conduit.init_unit(SRPM_TYPE_ID, unit_key, metadata, pkgpath)
-            else:
-                new_units[key] = sync_conduit.init_unit(RPM_TYPE_ID, unit_key, metadata, pkgpath)
             # We need to determine where the unit should be stored and update
             # rpm["pkgpath"] so Grinder will store the rpm to the correct location
-            rpm["pkgpath"] = os.path.dirname(new_units[key].storage_path)
+            new_units[key] = init_new_rpm_unit(rpm, sync_conduit)
     return new_rpms, new_units
 
 def get_missing_rpms_and_units(available_rpms, existing_units, verify_options={}):
@@ -126,17 +151,18 @@ def get_missing_rpms_and_units(available_rpms, existing_units, verify_options={}
     """
     missing_rpms = {}
     missing_units = {}
-    for key in available_rpms:
-        if key in existing_units:
+    keys = [key for key in available_rpms if key in existing_units]
+    files = [(existing_units[key].storage_path, existing_units[key].unit_key.get('checksum'),
+              existing_units[key].unit_key.get('checksumtype'), None) for key in keys]
+    for key, exists in zip(keys, util.verify_files(files, verify_options)):
+        if not exists:
             rpm_path = existing_units[key].storage_path
-            if not util.verify_exists(rpm_path, existing_units[key].unit_key.get('checksum'),
-                existing_units[key].unit_key.get('checksumtype'), verify_options):
-                _LOG.debug("Missing an existing unit: %s.  Will add to resync." % (rpm_path))
-                missing_rpms[key] = available_rpms[key]
-                missing_units[key] = existing_units[key]
-                # Adjust storage path to match intended location
-                # Grinder will use this 'pkgpath' to write the file
-                missing_rpms[key]["pkgpath"] = os.path.dirname(missing_units[key].storage_path)
+            _LOG.debug("Missing an existing unit: %s.  Will add to resync." % (rpm_path))
+            missing_rpms[key] = available_rpms[key]
+            missing_units[key] = existing_units[key]
+            # Adjust storage path to match intended location
+            # Grinder will use this 'pkgpath' to write the file
+            missing_rpms[key]["pkgpath"] = os.path.dirname(missing_units[key].storage_path)
     return missing_rpms, missing_units
 
 def form_rpm_unit_key(rpm):
@@ -149,12 +175,140 @@ def form_rpm_metadata(rpm):
     metadata = {}
     for key in ("filename", "vendor", "description", "buildhost", "license", "vendor", "requires", "provides", "relativepath", "changelog", "filelist", "files", "repodata"):
         metadata[key] = rpm[key]
+    metadata[util.REPODATA_DIGEST] = util.get_repodata_digest(metadata["repodata"])
     return metadata
 
 def form_lookup_key(rpm):
     rpm_key = (rpm["name"], rpm["epoch"], rpm["version"], rpm['release'], rpm["arch"], rpm["checksumtype"], rpm["checksum"])
     return rpm_key
 
+def form_sort_key(rpm):
+    """
+    Lookup key with every string decoded to unicode, so python orders it the
+    same way mongo orders the unit key fields.
+
+    @param rpm rpm info dict or unit key
+    @type rpm {}
+
+    @return sortable lookup key
+    @rtype ()
+    """
+    return tuple([decode_unicode(v) for v in form_lookup_key(rpm)])
+
+def iter_existing_units(sync_conduit, type_id, unit_fields=None, batch_size=DIFF_BATCH_SIZE):
+    """
+    Streams the existing units of a single type sorted by form_sort_key, fetching
+    at most batch_size units from the database at a time. Each page starts after the
+    sort key of the last unit of the previous page, so the database seeks to it
+    through the index rather than skipping over the earlier pages.
+
+    @param sync_conduit
+    @type sync_conduit pulp.server.content.conduits.repo_sync.RepoSyncConduit
+
+    @param type_id unit type to query, rpm or srpm
+    @type type_id str
+
+    @param unit_fields optional list of unit fields to limit the query to
+    @type unit_fields [str]
+
+    @param batch_size number of units fetched per query
+    @type batch_size int
+
+    @return generator of (sort key, unit) tuples
+    @rtype generator
+    """
+    unit_sort = [(field, 1) for field in RPM_SORT_FIELDS]
+    unit_filters = None
+    while True:
+        criteria = UnitAssociationCriteria(type_ids=[type_id], unit_fields=unit_fields,
+            unit_filters=unit_filters, unit_sort=unit_sort, limit=batch_size)
+        units = sync_conduit.get_units(criteria)
+        if not units:
+            break
+        page = [(form_sort_key(u.unit_key), u) for u in units]
+        page.sort(key=lambda item: item[0])
+        for item in page:
+            yield item
+        if len(units) < batch_size:
+            break
+        # the database order, not the page order, decides where the next page starts
+        unit_filters = util.form_seek_filter(units[-1].unit_key)
+
+def diff_rpms(rpm_items, existing_units):
+    """
+    Merge-joins the available rpms against the existing units. Both inputs must be
+    sorted by form_sort_key, so only the current item of each side is held in memory.
+
+    @param rpm_items available rpms sorted by form_sort_key
+    @type rpm_items iterable of {}
+
+    @param existing_units existing units as (sort key, unit) tuples sorted by sort key
+    @type existing_units iterable of ((), pulp.server.content.plugins.model.Unit)
+
+    @return generator of (DIFF_NEW, rpm, None), (DIFF_EXISTING, rpm, unit) and
+            (DIFF_ORPHANED, None, unit) tuples
+    @rtype generator
+    """
+    existing_units = iter(existing_units)
+
+    def next_unit(previous_key):
+        for unit_key, unit in existing_units:
+            if previous_key is not None:
+                if unit_key < previous_key:
+                    raise DiffOrderError("existing units are not sorted at %s" % (unit_key,))
+                if unit_key == previous_key:
+                    # duplicate association, the first one is enough to diff against
+                    continue
+            return unit_key, unit
+        return None, None
+
+    unit_key, unit = next_unit(None)
+    last_rpm_key = None
+    for rpm in rpm_items:
+        rpm_key = form_sort_key(rpm)
+        if last_rpm_key is not None:
+            if rpm_key < last_rpm_key:
+                raise DiffOrderError("available rpms are not sorted at %s" % (rpm_key,))
+            if rpm_key == last_rpm_key:
+                continue
+        last_rpm_key = rpm_key
+        while unit is not None and unit_key < rpm_key:
+            yield DIFF_ORPHANED, None, unit
+            unit_key, unit = next_unit(unit_key)
+        if unit is not None and unit_key == rpm_key:
+            yield DIFF_EXISTING, rpm, unit
+            unit_key, unit = next_unit(unit_key)
+        else:
+            yield DIFF_NEW, rpm, None
+    while unit is not None:
+        yield DIFF_ORPHANED, None, unit
+        unit_key, unit = next_unit(unit_key)
+
+def init_new_rpm_unit(rpm, sync_conduit):
+    """
+    Initializes the unit for a new rpm and points rpm["pkgpath"] at the unit's
+    storage location so Grinder writes the rpm to the correct place.
+
+    @param rpm rpm info dict
+    @type rpm {}
+
+    @param sync_conduit
+    @type sync_conduit pulp.server.content.conduits.repo_sync.RepoSyncConduit
+
+    @return initialized unit
+    @rtype pulp.server.content.plugins.model.Unit
+    """
+    unit_key = form_rpm_unit_key(rpm)
+    metadata = form_rpm_metadata(rpm)
+    pkgpath = os.path.join(rpm["pkgpath"], metadata["filename"])
+    if rpm['arch'] == 'src':
+        # initialize unit as a src rpm
+        unit = sync_conduit.init_unit(SRPM_TYPE_ID, unit_key, metadata, pkgpath)
+    else:
+        unit = sync_conduit.init_unit(RPM_TYPE_ID, unit_key, metadata, pkgpath)
+    rpm["pkgpath"] = os.path.dirname(unit.storage_path)
+    return unit
+
 def form_report(report):
     """
     @param report grinder synchronization report
@@ -175,7 +329,7 @@ def form_report(report):
     ret_val["size_left"] = report.last_progress.size_left
     return ret_val
 
-def verify_download(missing_rpms, new_rpms, new_units, verify_options={}):
+def verify_download(missing_rpms, new_rpms, new_units, verify_options={}, verified_keys=None):
     """
     Will verify that intended items have been downloaded.
     Items not downloaded will be removed from passed in dicts
@@ -189,26 +343,93 @@ def verify_download(missing_rpms, new_rpms, new_units, verify_options={}):
     @param new_units
     @type new_units {key:pulp.server.content.plugins.model.Unit}
 
+    @param verified_keys keys of rpms already verified as their download completed
+    @type verified_keys set
+
     @return dict of rpms which have not been downloaded
     @rtype {}
     """
     not_synced = {}
-    for key in new_rpms.keys():
-        rpm = new_rpms[key]
-        rpm_path = os.path.join(rpm["pkgpath"], rpm["filename"])
-        if not util.verify_exists(rpm_path, rpm['checksum'], rpm['checksumtype'], rpm['size'], verify_options):
-            not_synced[key] = rpm
-            del new_rpms[key]
-    for key in missing_rpms.keys():
-        rpm = missing_rpms[key]
+    verified_keys = verified_keys or set()
+    # new and missing rpms are verified in one batch so they are hashed concurrently
+    entries = [(new_rpms, key) for key in new_rpms.keys() if key not in verified_keys] + \
+              [(missing_rpms, key) for key in missing_rpms.keys() if key not in verified_keys]
+    files = []
+    for rpms, key in entries:
+        rpm = rpms[key]
         rpm_path = os.path.join(rpm["pkgpath"], rpm["filename"])
-        if not util.verify_exists(rpm_path, rpm['checksum'], rpm['checksumtype'], rpm['size'], verify_options):
-            not_synced[key] = rpm
-            del missing_rpms[key]
+        files.append((rpm_path, rpm['checksum'], rpm['checksumtype'], rpm['size']))
+    for (rpms, key), exists in zip(entries, util.verify_files(files, verify_options)):
+        if not exists:
+            not_synced[key] = rpms.pop(key)
     for key in not_synced:
-        del new_units[key]
+        # missing rpms have no new unit
+        new_units.pop(key, None)
     return not_synced
 
+
+class CompletedRpmSaver(object):
+    """
+    Download item callback verifying each rpm as soon as its download completes and
+    saving the unit of a new rpm right away, so the work of a sync that is canceled
+    or fails part way is kept for the next one.
+    """
+    def __init__(self, sync_conduit, rpm_info, verify_options):
+        """
+        @param sync_conduit
+        @type sync_conduit pulp.server.content.conduits.repo_sync.RepoSyncConduit
+
+        @param rpm_info rpm setup info, see ImporterRPM._setup_rpms
+        @type rpm_info {}
+
+        @param verify_options dict of checksum of size verify options
+        @type verify_options {}
+        """
+        self.sync_conduit = sync_conduit
+        self.rpm_info = rpm_info
+        self.verify_options = verify_options
+        # download destination -> key of the new and missing rpms
+        self.path_keys = {}
+        for rpms in (rpm_info['new_rpms'], rpm_info['missing_rpms']):
+            for key, rpm in rpms.items():
+                self.path_keys[os.path.join(rpm["pkgpath"], rpm["filename"])] = key
+        # keys of the rpms whose download completed and passed verification
+        self.verified_keys = set()
+        # keys of the new rpms whose unit has been saved
+        self.saved_keys = set()
+        self._lock = threading.Lock()
+
+    def item_finished(self, item, succeeded):
+        """
+        @param item grinder style item info dict
+        @type item {}
+
+        @param succeeded True when the download succeeded
+        @type succeeded bool
+        """
+        if not succeeded:
+            return
+        rpm_path = download.get_item_destination(item)
+        key = self.path_keys.get(rpm_path)
+        if key is None:
+            # not an rpm
+            return
+        rpm = self.rpm_info['new_rpms'].get(key) or self.rpm_info['missing_rpms'][key]
+        if not util.verify_exists(rpm_path, rpm['checksum'], rpm['checksumtype'], rpm['size'],
+                                  self.verify_options):
+            return
+        unit = self.rpm_info['new_rpm_units'].get(key)
+        # items finish on the download threads; conduit calls are made one at a time
+        self._lock.acquire()
+        try:
+            self.verified_keys.add(key)
+            if unit is not None:
+                self.sync_conduit.save_unit(unit)
+                self.saved_keys.add(key)
+        finally:
+            self._lock.release()
+
+
 def force_ascii(value):
     retval = value
     if isinstance(value, unicode):
@@ -372,10 +593,57 @@ def preserve_custom_metadata_on_scratchpad(repo, sync_conduit, config):
         existing_scratch_pad["repodata"].update({ftype : data})
     sync_conduit.set_repo_scratchpad(existing_scratch_pad)
 
+def get_repomd_state_types(repomd_xml, config):
+    """
+    @param repomd_xml path to the feed repomd.xml
+    @type repomd_xml str
+
+    @param config plugin configuration
+    @type config pulp.server.content.plugins.config.PluginCallConfiguration
+
+    @return metadata types compared with the last successful sync: every type the feed
+            lists, such as prestodelta, productid and custom metadata, along with the errata
+            and comps types; the ones skipped are left out
+    @rtype [str]
+    """
+    skip_content_types = config.get("skip") or []
+    ftypes = set(repomd_state.get_repomd_types(repomd_xml)).union(SEPARATELY_RECORDED_TYPES)
+    if 'erratum' in skip_content_types:
+        ftypes.discard("updateinfo")
+    return sorted(ftypes)
+
+def get_feed_repomd_state(repo, config):
+    """
+    Fetches repomd.xml from the feed to find out if the repo changed since the last sync
+
+    @param repo metadata describing the repository
+    @type repo pulp.server.content.plugins.data.Repository
+
+    @param config plugin configuration
+    @type config pulp.server.content.plugins.config.PluginCallConfiguration
+
+    @return state of the feed metadata, see repomd_state.get_repomd_state; None when
+            repomd.xml could not be fetched or parsed
+    @rtype {str:str}
+    """
+    repomd_url = urlparse.urljoin(config.get("feed_url").rstrip("/") + "/", "repodata/repomd.xml")
+    destination = os.path.join(repo.working_dir, FEED_REPOMD_FILENAME)
+    try:
+        if not download.fetch_file(repomd_url, destination, config):
+            return None
+        return repomd_state.get_repomd_state(destination, get_repomd_state_types(destination, config))
+    except Exception, e:
+        _LOG.warning("Unable to check %s for changes, doing a full sync: %s" % (repomd_url, e))
+        return None
+    finally:
+        if os.path.exists(destination):
+            os.unlink(destination)
+
 class ImporterRPM(object):
     def __init__(self):
         self.canceled = False
         self.yumRepoGrinder = None
+        self.item_downloader = None
 
     def sync(self, repo, sync_conduit, config, importer_progress_callback=None):
         """
@@ -465,196 +733,302 @@ class ImporterRPM(object):
         num_retries = config.get("num_retries")
         retry_delay = config.get("retry_delay")
         skip_content_types = config.get("skip") or []
+        set_progress("metadata", {"state": "IN_PROGRESS"})
+        if not config.get("force_full_sync"):
+            if repomd_state.is_unchanged(sync_conduit, get_feed_repomd_state(repo, config)):
+                _LOG.info("repomd.xml of <%s> is unchanged since the last sync; skipping sync" % repo.id)
+                set_progress("metadata", {"state": constants.STATE_COMPLETE})
+                set_progress("content", {"state": constants.STATE_SKIPPED})
+                summary = {"unchanged" : True, "time_total_sec" : time.time() - start}
+                return True, summary, {}
         verify_checksum = config.get("verify_checksum") or False
         verify_size = config.get("verify_size") or False
         verify_options = {"checksum":verify_checksum, "size":verify_size}
-        _LOG.info("Begin sync of repo <%s> from feed_url <%s>" % (repo.id, feed_url))
-        start_metadata = time.time()
-        self.yumRepoGrinder = get_yumRepoGrinder(repo.id, repo.working_dir, config)
-        set_progress("metadata", {"state": "IN_PROGRESS"})
+        if verify_checksum and config.get("verify_checksum_cache") is not False:
+            max_age = config.get("verify_checksum_max_age")
+            if max_age is not None:
+                # configured in days
+                max_age = max_age * 24 * 60 * 60
+            verify_options["cache"] = util.VerificationCache(
+                os.path.join(repo.working_dir, VERIFY_CACHE_FILENAME), max_age=max_age)
         try:
-            self.yumRepoGrinder.setup(basepath=repo.working_dir, callback=progress_callback,
-                num_retries=num_retries, retry_delay=retry_delay)
-        except Exception, e:
-            set_progress("metadata", {"state": "FAILED"})
-            _LOG.error("Failed to fetch metadata on: %s" % (feed_url))
-            raise
-        set_progress("metadata", {"state": "FINISHED"})
-        end_metadata = time.time()
-        new_units = {}
-
-        # ----------------- setup items to download and add to grinder ---------------
-        # setup rpm items
-        rpm_info = self._setup_rpms(repo, sync_conduit, verify_options, skip_content_types)
-        new_units.update(rpm_info['new_rpm_units'])
-        # Sync the new and missing rpms
-        self.yumRepoGrinder.addItems(rpm_info['new_rpms'].values())
-        self.yumRepoGrinder.addItems(rpm_info['missing_rpms'].values())
-
-        # setup drpm items
-        drpm_info = self._setup_drpms(repo, sync_conduit, verify_options, skip_content_types)
-        new_units.update(drpm_info['new_drpm_units'])
-        # Sync the new and missing drpms
-        self.yumRepoGrinder.addItems(drpm_info['new_drpms'].values())
-        self.yumRepoGrinder.addItems(drpm_info['missing_drpms'].values())
-
-        # setup distribution items
-        distro_info = self._setup_distros(repo, sync_conduit, verify_options, skip_content_types)
-        new_units.update(distro_info['new_distro_units'])
-        all_new_distro_files = list(itertools.chain(*distro_info['new_distro_files'].values()))
-        # Sync the new and missing distro
-        self.yumRepoGrinder.addItems(all_new_distro_files)
-        all_missing_distro_files = list(itertools.chain(*distro_info['missing_distro_files'].values()))
-        self.yumRepoGrinder.addItems(all_missing_distro_files)
-
-        #----------- start the item download via grinder ---------------
-        start_download = time.time()
-        report = self.yumRepoGrinder.download()
-        if self.canceled:
-            _LOG.info("Sync of %s has been canceled." % repo.id)
-            return False, {}, {}
-        end_download = time.time()
-        _LOG.info("Finished download of %s in %s seconds.  %s" % (repo.id, end_download-start_download, report))
-        # determine the checksum type from downloaded metadata
-        set_repo_checksum_type(repo, sync_conduit, config)
-        # preserve the custom metadata on scratchpad to lookup downloaded data
-        preserve_custom_metadata_on_scratchpad(repo, sync_conduit, config)
-
-        # -------------- process the download results to a report ---------------
-        errors = {}
-        not_synced = {}
-        removal_errors = []
-        summary = {}
-        if 'rpm' not in skip_content_types:
-            rpms_with_errors = search_for_errors(rpm_info['new_rpms'], rpm_info['missing_rpms'])
-            errors.update(rpms_with_errors)
-            # Verify we synced what we expected, update the passed in dicts to remove non-downloaded items
-            not_synced = verify_download(rpm_info['missing_rpms'], rpm_info['new_rpms'], new_units, verify_options)
-            # Save the new units and remove the orphaned units
-            saved_new_unit_keys = []
-            for key in new_units:
-                if key not in rpms_with_errors:
-                    u = new_units[key]
-                    sync_conduit.save_unit(u)
-                    saved_new_unit_keys.append(key)
-
-            for u in rpm_info['orphaned_rpm_units'].values():
-                try:
-                    remove_unit(sync_conduit, u)
-                except Exception, e:
-                    unit_info = str(u.unit_key)
-                    _LOG.exception("Unable to remove: %s" % (unit_info))
-                    removal_errors.append((unit_info, str(e)))
-            # filter out rpm specific data if any
-            new_rpms = filter(lambda u: u.type_id == 'rpm', rpm_info['new_rpm_units'].values())
-            missing_rpms = filter(lambda u: u.type_id == 'rpm', rpm_info['missing_rpm_units'].values())
-            orphaned_rpms = filter(lambda u: u.type_id == 'rpm', rpm_info['orphaned_rpm_units'].values())
-            not_synced_rpms = filter(lambda r: r["arch"] != 'srpm', not_synced.values())
-
-            summary["num_rpms"] = len(rpm_info['available_rpms'])
-            summary["num_synced_new_rpms"] = len(new_rpms)
-            summary["num_resynced_rpms"] = len(missing_rpms)
-            summary["num_not_synced_rpms"] = len(not_synced_rpms)
-            summary["num_orphaned_rpms"] = len(orphaned_rpms)
-            summary["rpm_removal_errors"] = removal_errors
-
-            # filter out srpm specific data if any
-            new_srpms = filter(lambda u: u.type_id == 'srpm', rpm_info['new_rpm_units'].values())
-            missing_srpms = filter(lambda u: u.type_id == 'srpm', rpm_info['missing_rpm_units'].values())
-            orphaned_srpms = filter(lambda u: u.type_id == 'srpm', rpm_info['orphaned_rpm_units'].values())
-            not_synced_srpms = filter(lambda r: r["arch"] == 'srpm', not_synced.values())
-
-            summary["num_synced_new_srpms"] = len(new_srpms)
-            summary["num_resynced_srpms"] = len(missing_srpms)
-            summary["num_not_synced_srpms"] = len(not_synced_srpms)
-            summary["num_orphaned_srpms"] = len(orphaned_srpms)
-        else:
-            _LOG.info("skipping rpm summary report")
-
-        if not_synced:
-            _LOG.warning("%s rpms were not downloaded" % (len(not_synced)))
-
-        if 'drpm' not in skip_content_types:
-            drpms_with_errors = search_for_errors(drpm_info['new_drpms'], drpm_info['missing_drpms'])
-            errors.update(drpms_with_errors)
-            # purge any orphaned drpms
-            drpm.purge_orphaned_drpm_units(sync_conduit, repo, drpm_info['orphaned_drpm_units'].values())
-            # filter out drpm specific data if any
-            new_drpms = filter(lambda u: u.type_id == 'drpm', drpm_info['new_drpm_units'].values())
-            missing_drpms = filter(lambda u: u.type_id == 'drpm', drpm_info['missing_drpm_units'].values())
-            orphaned_drpms = filter(lambda u: u.type_id == 'drpm', drpm_info['orphaned_drpm_units'].values())
-
-            summary["num_synced_new_drpms"] = len(new_drpms)
-            summary["num_resynced_drpms"] = len(missing_drpms)
-            summary["num_orphaned_drpms"] = len(orphaned_drpms)
-        else:
-            _LOG.info("skipping drpm summary report")
-
-        if 'distribution' not in skip_content_types:
-            for u in distro_info['orphaned_distro_units'].values():
-                try:
-                    remove_unit(sync_conduit, u)
-                except Exception, e:
-                    unit_info = str(u.unit_key)
-                    _LOG.exception("Unable to remove: %s" % (unit_info))
-                    removal_errors.append((unit_info, str(e)))
-            orphaned_distros = filter(lambda u: u.type_id == 'distribution', distro_info['orphaned_distro_units'].values())
-            # filter out distribution specific data if any
-            summary["num_synced_new_distributions"] = len(distro_info['new_distro_units'])
-            summary["num_synced_new_distributions_files"] = len(all_new_distro_files)
-            summary["num_resynced_distributions"] = len(distro_info['missing_distro_units'])
-            summary["num_resynced_distribution_files"] = len(all_missing_distro_files)
-            summary["num_orphaned_distributions"] = len(orphaned_distros)
-        else:
-            _LOG.info("skipping distro summary report")
-        end = time.time()
-        summary["time_total_sec"] = end - start
-
-        details = {}
-        details["size_total"] = report.last_progress.size_total
-        details["time_metadata_sec"] = end_metadata - start_metadata
-        details["time_download_sec"] = end_download - start_download
-        details["not_synced"] = not_synced
-        details["sync_report"] = form_report(report)
-
-        status = True
-        if removal_errors or details["sync_report"]["errors"]:
-            status = False
-        _LOG.info("STATUS: %s; SUMMARY: %s; DETAILS: %s" % (status, summary, details))
-        return status, summary, details
+            _LOG.info("Begin sync of repo <%s> from feed_url <%s>" % (repo.id, feed_url))
+            start_metadata = time.time()
+            self.yumRepoGrinder = get_yumRepoGrinder(repo.id, repo.working_dir, config)
+            try:
+                self.yumRepoGrinder.setup(basepath=repo.working_dir, callback=progress_callback,
+                    num_retries=num_retries, retry_delay=retry_delay)
+            except Exception, e:
+                set_progress("metadata", {"state": "FAILED"})
+                _LOG.error("Failed to fetch metadata on: %s" % (feed_url))
+                raise
+            set_progress("metadata", {"state": "FINISHED"})
+            end_metadata = time.time()
+            new_units = {}
+
+            # ----------------- setup items to download and add to grinder ---------------
+            # setup rpm items
+            rpm_info = self._setup_rpms(repo, sync_conduit, verify_options, skip_content_types)
+            completed_rpm_saver = None
+            if download.use_native_download(config):
+                # grinder is only used for the metadata, items are fetched with the pulp download library;
+                # rpms are verified and saved as their downloads complete
+                completed_rpm_saver = CompletedRpmSaver(sync_conduit, rpm_info, verify_options)
+                self.item_downloader = download.YumDownloadRun(config,
+                    progress_callback=lambda status: set_progress("content", status),
+                    item_callback=completed_rpm_saver.item_finished)
+            else:
+                self.item_downloader = self.yumRepoGrinder
+            new_units.update(rpm_info['new_rpm_units'])
+            # Sync the new and missing rpms
+            self.item_downloader.addItems(rpm_info['new_rpms'].values())
+            self.item_downloader.addItems(rpm_info['missing_rpms'].values())
+
+            # setup drpm items
+            drpm_info = self._setup_drpms(repo, sync_conduit, verify_options, skip_content_types)
+            new_units.update(drpm_info['new_drpm_units'])
+            # Sync the new and missing drpms
+            self.item_downloader.addItems(drpm_info['new_drpms'].values())
+            self.item_downloader.addItems(drpm_info['missing_drpms'].values())
+
+            # setup distribution items
+            distro_info = self._setup_distros(repo, sync_conduit, verify_options, skip_content_types)
+            new_units.update(distro_info['new_distro_units'])
+            all_new_distro_files = list(itertools.chain(*distro_info['new_distro_files'].values()))
+            # Sync the new and missing distro
+            self.item_downloader.addItems(all_new_distro_files)
+            all_missing_distro_files = list(itertools.chain(*distro_info['missing_distro_files'].values()))
+            self.item_downloader.addItems(all_missing_distro_files)
+
+            #----------- start the item download via grinder or the native downloader ---------------
+            start_download = time.time()
+            report = self.item_downloader.download()
+            if self.canceled:
+                _LOG.info("Sync of %s has been canceled." % repo.id)
+                return False, {}, {}
+            end_download = time.time()
+            _LOG.info("Finished download of %s in %s seconds.  %s" % (repo.id, end_download-start_download, report))
+            # determine the checksum type from downloaded metadata
+            set_repo_checksum_type(repo, sync_conduit, config)
+            # preserve the custom metadata on scratchpad to lookup downloaded data
+            preserve_custom_metadata_on_scratchpad(repo, sync_conduit, config)
+
+            # -------------- process the download results to a report ---------------
+            errors = {}
+            not_synced = {}
+            removal_errors = []
+            summary = {}
+            if 'rpm' not in skip_content_types:
+                rpms_with_errors = search_for_errors(rpm_info['new_rpms'], rpm_info['missing_rpms'])
+                errors.update(rpms_with_errors)
+                # Verify we synced what we expected, update the passed in dicts to remove non-downloaded items
+                verified_keys = saved_keys = set()
+                if completed_rpm_saver is not None:
+                    verified_keys = completed_rpm_saver.verified_keys
+                    saved_keys = completed_rpm_saver.saved_keys
+                not_synced = verify_download(rpm_info['missing_rpms'], rpm_info['new_rpms'], new_units, verify_options,
+                                             verified_keys)
+                # Save the new units not saved during the download and remove the orphaned units
+                for key in new_units:
+                    if key not in rpms_with_errors and key not in saved_keys:
+                        sync_conduit.save_unit(new_units[key])
+
+                for u in rpm_info['orphaned_rpm_units'].values():
+                    try:
+                        remove_unit(sync_conduit, u)
+                    except Exception, e:
+                        unit_info = str(u.unit_key)
+                        _LOG.exception("Unable to remove: %s" % (unit_info))
+                        removal_errors.append((unit_info, str(e)))
+                # filter out rpm specific data if any
+                new_rpms = filter(lambda u: u.type_id == 'rpm', rpm_info['new_rpm_units'].values())
+                missing_rpms = filter(lambda u: u.type_id == 'rpm', rpm_info['missing_rpm_units'].values())
+                orphaned_rpms = filter(lambda u: u.type_id == 'rpm', rpm_info['orphaned_rpm_units'].values())
+                not_synced_rpms = filter(lambda r: r["arch"] != 'srpm', not_synced.values())
+
+                summary["num_rpms"] = rpm_info['num_available_rpms']
+                summary["num_synced_new_rpms"] = len(new_rpms)
+                summary["num_resynced_rpms"] = len(missing_rpms)
+                summary["num_not_synced_rpms"] = len(not_synced_rpms)
+                summary["num_orphaned_rpms"] = len(orphaned_rpms)
+                summary["rpm_removal_errors"] = removal_errors
+
+                # filter out srpm specific data if any
+                new_srpms = filter(lambda u: u.type_id == 'srpm', rpm_info['new_rpm_units'].values())
+                missing_srpms = filter(lambda u: u.type_id == 'srpm', rpm_info['missing_rpm_units'].values())
+                orphaned_srpms = filter(lambda u: u.type_id == 'srpm', rpm_info['orphaned_rpm_units'].values())
+                not_synced_srpms = filter(lambda r: r["arch"] == 'srpm', not_synced.values())
+
+                summary["num_synced_new_srpms"] = len(new_srpms)
+                summary["num_resynced_srpms"] = len(missing_srpms)
+                summary["num_not_synced_srpms"] = len(not_synced_srpms)
+                summary["num_orphaned_srpms"] = len(orphaned_srpms)
+            else:
+                _LOG.info("skipping rpm summary report")
+
+            if not_synced:
+                _LOG.warning("%s rpms were not downloaded" % (len(not_synced)))
+
+            if 'drpm' not in skip_content_types:
+                drpms_with_errors = search_for_errors(drpm_info['new_drpms'], drpm_info['missing_drpms'])
+                errors.update(drpms_with_errors)
+                # purge any orphaned drpms
+                drpm.purge_orphaned_drpm_units(sync_conduit, repo, drpm_info['orphaned_drpm_units'].values())
+                # filter out drpm specific data if any
+                new_drpms = filter(lambda u: u.type_id == 'drpm', drpm_info['new_drpm_units'].values())
+                missing_drpms = filter(lambda u: u.type_id == 'drpm', drpm_info['missing_drpm_units'].values())
+                orphaned_drpms = filter(lambda u: u.type_id == 'drpm', drpm_info['orphaned_drpm_units'].values())
+
+                summary["num_synced_new_drpms"] = len(new_drpms)
+                summary["num_resynced_drpms"] = len(missing_drpms)
+                summary["num_orphaned_drpms"] = len(orphaned_drpms)
+            else:
+                _LOG.info("skipping drpm summary report")
+
+            if 'distribution' not in skip_content_types:
+                for u in distro_info['orphaned_distro_units'].values():
+                    try:
+                        remove_unit(sync_conduit, u)
+                    except Exception, e:
+                        unit_info = str(u.unit_key)
+                        _LOG.exception("Unable to remove: %s" % (unit_info))
+                        removal_errors.append((unit_info, str(e)))
+                orphaned_distros = filter(lambda u: u.type_id == 'distribution', distro_info['orphaned_distro_units'].values())
+                # filter out distribution specific data if any
+                summary["num_synced_new_distributions"] = len(distro_info['new_distro_units'])
+                summary["num_synced_new_distributions_files"] = len(all_new_distro_files)
+                summary["num_resynced_distributions"] = len(distro_info['missing_distro_units'])
+                summary["num_resynced_distribution_files"] = len(all_missing_distro_files)
+                summary["num_orphaned_distributions"] = len(orphaned_distros)
+            else:
+                _LOG.info("skipping distro summary report")
+            end = time.time()
+            summary["time_total_sec"] = end - start
+
+            details = {}
+            details["size_total"] = report.last_progress.size_total
+            details["time_metadata_sec"] = end_metadata - start_metadata
+            details["time_download_sec"] = end_download - start_download
+            details["not_synced"] = not_synced
+            details["sync_report"] = form_report(report)
+
+            status = True
+            if removal_errors or details["sync_report"]["errors"]:
+                status = False
+            if status and not set(skip_content_types).intersection(RECORDED_CONTENT_TYPES):
+                # errata and comps record their own checksums once imported
+                repomd_xml = os.path.join(repo.working_dir, repo.id, "repodata/repomd.xml")
+                if os.path.exists(repomd_xml):
+                    ftypes = [t for t in repomd_state.get_repomd_types(repomd_xml)
+                              if t not in SEPARATELY_RECORDED_TYPES]
+                    repomd_state.record_synced_checksums(sync_conduit,
+                        repomd_state.get_repomd_state(repomd_xml, ftypes))
+            _LOG.info("STATUS: %s; SUMMARY: %s; DETAILS: %s" % (status, summary, details))
+            return status, summary, details
+        finally:
+            if verify_options.get("cache"):
+                verify_options["cache"].close()
 
     def _setup_rpms(self, repo, sync_conduit, verify_options, skip_content_types):
-        rpm_info = {'available_rpms' : {}, 'existing_rpm_units' : {}, 'orphaned_rpm_units' : {}, 'new_rpms' : {}, 'new_rpm_units' : {},'missing_rpms' : {}, 'missing_rpm_units' : {}}
+        rpm_info = {'num_available_rpms' : 0, 'num_existing_rpm_units' : 0, 'orphaned_rpm_units' : {}, 'new_rpms' : {}, 'new_rpm_units' : {},'missing_rpms' : {}, 'missing_rpm_units' : {}}
         if 'rpm' in skip_content_types:
             _LOG.info("skipping rpm item setup")
             return rpm_info
         start_metadata = time.time()
         rpm_items = self.yumRepoGrinder.getRPMItems()
-        rpm_info['available_rpms'] = get_available_rpms(rpm_items)
+        # Sort in place so the source repo can be merge-joined against the units already
+        # in pulp without building lookup tables of either side
+        rpm_items.sort(key=form_sort_key)
         end_metadata = time.time()
         _LOG.info("%s rpms are available in the source repo %s, calculated in %s seconds" % \
-                    (len(rpm_info['available_rpms']), repo.id, (end_metadata-start_metadata)))
+                    (len(rpm_items), repo.id, (end_metadata-start_metadata)))
 
         # Determine what exists and what has been orphaned, or exists in Pulp but has been removed from the source repo
         # Limit the data we retrieve from the DB to reduce memory consumption
         valid_fields = []
         valid_fields.extend(RPM_UNIT_KEY)
         valid_fields.append("_storage_path")
-        rpm_info['existing_rpm_units'] = {}
-        criteria = UnitAssociationCriteria(type_ids=[SRPM_TYPE_ID], unit_fields=valid_fields)
-        rpm_info['existing_rpm_units'].update(get_existing_units(sync_conduit, criteria))
-        criteria = UnitAssociationCriteria(type_ids=[RPM_TYPE_ID], unit_fields=valid_fields)
-        rpm_info['existing_rpm_units'].update(get_existing_units(sync_conduit, criteria))
-        rpm_info['orphaned_rpm_units'] = get_orphaned_units(rpm_info['available_rpms'], rpm_info['existing_rpm_units'])
-
-        # Determine new and missing items
-        rpm_info['new_rpms'], rpm_info['new_rpm_units'] = get_new_rpms_and_units(rpm_info['available_rpms'], rpm_info['existing_rpm_units'], sync_conduit)
-        rpm_info['missing_rpms'], rpm_info['missing_rpm_units'] = get_missing_rpms_and_units(rpm_info['available_rpms'], rpm_info['existing_rpm_units'], verify_options)
+        existing_units = heapq.merge(iter_existing_units(sync_conduit, SRPM_TYPE_ID, valid_fields),
+                                     iter_existing_units(sync_conduit, RPM_TYPE_ID, valid_fields))
+        try:
+            self._process_rpm_diff(diff_rpms(rpm_items, existing_units), rpm_info, verify_options)
+        except DiffOrderError, e:
+            # The database did not return units in the order python sorts their keys, fall back
+            # to diffing against every existing unit held in memory
+            _LOG.warning("Unable to stream existing units of repo <%s>: %s" % (repo.id, e))
+            existing_units = {}
+            for type_id in (SRPM_TYPE_ID, RPM_TYPE_ID):
+                criteria = UnitAssociationCriteria(type_ids=[type_id], unit_fields=valid_fields)
+                existing_units.update(get_existing_units(sync_conduit, criteria))
+            existing_units = sorted([(form_sort_key(u.unit_key), u) for u in existing_units.values()],
+                                    key=lambda item: item[0])
+            self._process_rpm_diff(diff_rpms(rpm_items, existing_units), rpm_info, verify_options)
+
+        # Only now point the rpms at their storage location, a failed diff above must not
+        # leave half updated 'pkgpath' values behind
+        for key, rpm in rpm_info['new_rpms'].items():
+            rpm_info['new_rpm_units'][key] = init_new_rpm_unit(rpm, sync_conduit)
+        for key, rpm in rpm_info['missing_rpms'].items():
+            # Grinder will use this 'pkgpath' to write the file
+            rpm["pkgpath"] = os.path.dirname(rpm_info['missing_rpm_units'][key].storage_path)
         _LOG.info("Repo <%s> %s existing rpm units, %s have been orphaned, %s new rpms, %s missing rpms." % \
-                    (repo.id, len(rpm_info['existing_rpm_units']), len(rpm_info['orphaned_rpm_units']), len(rpm_info['new_rpms']), len(rpm_info['missing_rpms'])))
+                    (repo.id, rpm_info['num_existing_rpm_units'], len(rpm_info['orphaned_rpm_units']), len(rpm_info['new_rpms']), len(rpm_info['missing_rpms'])))
 
         return rpm_info
 
+    def _process_rpm_diff(self, diff, rpm_info, verify_options):
+        """
+        Sorts the output of diff_rpms into rpm_info; of the existing units only the
+        orphaned ones and the ones missing on disk are kept.
+
+        @param diff output of diff_rpms
+        @type diff generator
+
+        @param rpm_info rpm setup info to fill in, any previous results are reset
+        @type rpm_info {}
+
+        @param verify_options dict of checksum of size verify options
+        @type verify_options {}
+        """
+        for field in ('orphaned_rpm_units', 'new_rpms', 'missing_rpms', 'missing_rpm_units'):
+            rpm_info[field] = {}
+        rpm_info['num_available_rpms'] = 0
+        rpm_info['num_existing_rpm_units'] = 0
+        # existing units are checked on disk a batch at a time so their checksums are computed concurrently
+        existing = []
+        for state, rpm, unit in diff:
+            if state == DIFF_ORPHANED:
+                rpm_info['num_existing_rpm_units'] += 1
+                rpm_info['orphaned_rpm_units'][form_lookup_key(unit.unit_key)] = unit
+                continue
+            key = form_lookup_key(rpm)
+            rpm_info['num_available_rpms'] += 1
+            if state == DIFF_NEW:
+                rpm_info['new_rpms'][key] = rpm
+                continue
+            rpm_info['num_existing_rpm_units'] += 1
+            existing.append((key, rpm, unit))
+            if len(existing) >= DIFF_BATCH_SIZE:
+                self._verify_existing_rpms(existing, rpm_info, verify_options)
+                existing = []
+        self._verify_existing_rpms(existing, rpm_info, verify_options)
+
+    def _verify_existing_rpms(self, existing, rpm_info, verify_options):
+        """
+        Adds the existing units whose files are missing or fail verification to the
+        missing rpms of rpm_info
+
+        @param existing list of (lookup key, rpm, unit) of existing units
+        @type existing [(tuple, {}, pulp.server.content.plugins.model.Unit)]
+        """
+        files = [(unit.storage_path, unit.unit_key.get('checksum'), unit.unit_key.get('checksumtype'), None)
+                 for key, rpm, unit in existing]
+        for (key, rpm, unit), exists in zip(existing, util.verify_files(files, verify_options)):
+            if not exists:
+                _LOG.debug("Missing an existing unit: %s.  Will add to resync." % (unit.storage_path))
+                rpm_info['missing_rpms'][key] = rpm
+                rpm_info['missing_rpm_units'][key] = unit
+
     def _setup_drpms(self, repo, sync_conduit, verify_options, skip_content_types):
         # process deltarpms
         drpm_info = {'available_drpms' : {}, 'existing_drpm_units' : {}, 'orphaned_drpm_units' : {}, 'new_drpms' : {}, 'new_drpm_units' : {}, 'missing_drpms' : {}, 'missing_drpm_units' : {}}
@@ -705,4 +1079,7 @@ class ImporterRPM(object):
         if self.yumRepoGrinder:
             _LOG.info("Telling grinder to stop syncing")
             self.yumRepoGrinder.stop()
+        if self.item_downloader and self.item_downloader is not self.yumRepoGrinder:
+            _LOG.info("Telling the downloader to stop syncing")
+            self.item_downloader.stop()
 
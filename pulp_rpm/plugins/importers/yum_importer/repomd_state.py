@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2013 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+
+"""
+Tracks the repomd.xml checksums of the metadata types a sync has imported, so
+later syncs can skip the types the feed has not changed since.
+"""
+import os
+from xml.etree import ElementTree
+
+from pulp_rpm.yum_plugin import util
+
+_LOG = util.getLogger(__name__)
+
+# Importer scratchpad key holding the checksums of the last successful sync, keyed by metadata type
+SCRATCHPAD_KEY = "synced_metadata_checksums"
+# Entry holding the repomd.xml revision alongside the metadata type checksums
+REVISION_KEY = "revision"
+
+REPOMD_NAMESPACE = "http://linux.duke.edu/metadata/repo"
+
+
+def get_metadata_checksums(repo_dir, ftypes):
+    """
+    @param repo_dir path to a repository, expects 'repodata' to be a child of the path
+    @type repo_dir str
+
+    @param ftypes metadata types to look up, such as updateinfo or group
+    @type ftypes [str]
+
+    @return checksum listed in repomd.xml for each metadata type, None for types the repo
+            does not have; None when there is no repomd.xml
+    @rtype {str:str}
+    """
+    repomd_xml = os.path.join(repo_dir, "repodata/repomd.xml")
+    if not os.path.exists(repomd_xml):
+        return None
+    return get_repomd_checksums(repomd_xml, ftypes)
+
+
+def get_repomd_checksums(repomd_xml, ftypes):
+    """
+    @param repomd_xml path to a repomd.xml file
+    @type repomd_xml str
+
+    @param ftypes metadata types to look up, such as updateinfo or group
+    @type ftypes [str]
+
+    @return checksum listed in repomd.xml for each metadata type, None for types the repo
+            does not have
+    @rtype {str:str}
+    """
+    ft_data = util.get_repomd_filetype_dump(repomd_xml)
+    checksums = {}
+    for ftype in ftypes:
+        if ftype in ft_data:
+            checksums[ftype] = ft_data[ftype]['checksum'][1]
+        else:
+            checksums[ftype] = None
+    return checksums
+
+
+def get_repomd_types(repomd_xml):
+    """
+    @param repomd_xml path to a repomd.xml file
+    @type repomd_xml str
+
+    @return metadata types listed in repomd.xml, such as primary, prestodelta, productid
+            and any custom metadata
+    @rtype [str]
+    """
+    return sorted(util.get_repomd_filetype_dump(repomd_xml).keys())
+
+
+def get_repomd_revision(repomd_xml):
+    """
+    @param repomd_xml path to a repomd.xml file
+    @type repomd_xml str
+
+    @return value of the revision element, None when repomd.xml has none
+    @rtype str
+    """
+    root = ElementTree.parse(repomd_xml).getroot()
+    revision = root.find("{%s}revision" % REPOMD_NAMESPACE)
+    if revision is None:
+        revision = root.find("revision")
+    if revision is None or not revision.text:
+        return None
+    return revision.text.strip()
+
+
+def get_repomd_state(repomd_xml, ftypes):
+    """
+    @param repomd_xml path to a repomd.xml file
+    @type repomd_xml str
+
+    @param ftypes metadata types to look up, such as primary or updateinfo
+    @type ftypes [str]
+
+    @return checksums of the metadata types, see get_repomd_checksums, along with the
+            repomd.xml revision under REVISION_KEY
+    @rtype {str:str}
+    """
+    state = get_repomd_checksums(repomd_xml, ftypes)
+    state[REVISION_KEY] = get_repomd_revision(repomd_xml)
+    return state
+
+
+def get_synced_checksums(sync_conduit):
+    """
+    @param sync_conduit
+    @type sync_conduit pulp.server.content.conduits.repo_sync.RepoSyncConduit
+
+    @return checksums recorded by the last successful syncs, keyed by metadata type
+    @rtype {str:str}
+    """
+    scratchpad = sync_conduit.get_scratchpad() or {}
+    return scratchpad.get(SCRATCHPAD_KEY) or {}
+
+
+def is_unchanged(sync_conduit, checksums):
+    """
+    @param sync_conduit
+    @type sync_conduit pulp.server.content.conduits.repo_sync.RepoSyncConduit
+
+    @param checksums current checksums, see get_metadata_checksums
+    @type checksums {str:str}
+
+    @return True when every metadata type was imported by an earlier sync with the same checksum
+    @rtype bool
+    """
+    if not checksums:
+        return False
+    synced = get_synced_checksums(sync_conduit)
+    for ftype, checksum in checksums.items():
+        if ftype not in synced or synced[ftype] != checksum:
+            return False
+    return True
+
+
+def record_synced_checksums(sync_conduit, checksums):
+    """
+    Records the checksums of metadata types that were imported successfully
+
+    @param sync_conduit
+    @type sync_conduit pulp.server.content.conduits.repo_sync.RepoSyncConduit
+
+    @param checksums checksums to record, see get_metadata_checksums
+    @type checksums {str:str}
+    """
+    if checksums is None:
+        return
+    scratchpad = sync_conduit.get_scratchpad() or {}
+    synced = scratchpad.get(SCRATCHPAD_KEY) or {}
+    synced.update(checksums)
+    scratchpad[SCRATCHPAD_KEY] = synced
+    sync_conduit.set_scratchpad(scratchpad)
+    _LOG.debug("Recorded synced metadata checksums %s" % checksums)
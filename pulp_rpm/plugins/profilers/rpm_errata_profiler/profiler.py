@@ -14,17 +14,122 @@
 """
 Profiler plugin to support RPM Errata functionality
 """
+from collections import deque
 import gettext
+import hashlib
+import threading
 
 from pulp.plugins.model import ApplicabilityReport
 from pulp.plugins.profiler import Profiler, InvalidUnitsRequested
 from pulp.plugins.conduits.mixins import UnitAssociationCriteria
 from pulp_rpm.common.ids import TYPE_ID_PROFILER_RPM_ERRATA, TYPE_ID_ERRATA, TYPE_ID_RPM, UNIT_KEY_RPM
+from pulp_rpm.common.profile import RPMProfile, load_rpm_profile, lookup_hash
 from pulp_rpm.yum_plugin import util
 
 _ = gettext.gettext
 _LOG = util.getLogger(__name__)
 
+# Number of (profile hash, errata revision) entries an ApplicabilityCache holds
+DEFAULT_CACHE_ENTRIES = 1000
+
+
+class ApplicabilityCache(object):
+    """
+    Errata applicability results keyed by the hash of an rpm profile and the revision
+    of the errata it was computed against, see RPMErrataProfiler.errata_revision. The oldest
+    entries are dropped once max_entries is reached. Safe to share between threads.
+    """
+    def __init__(self, max_entries=DEFAULT_CACHE_ENTRIES):
+        self.max_entries = max_entries
+        # cache key -> {erratum id: applicability report or None}
+        self._entries = {}
+        self._keys = deque()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        :return: results cached under the key, by erratum id; empty when nothing is cached
+        :rtype:  dict
+        """
+        self._lock.acquire()
+        try:
+            return dict(self._entries.get(key, {}))
+        finally:
+            self._lock.release()
+
+    def update(self, key, results):
+        """
+        Adds results by erratum id to the ones cached under the key
+        """
+        self._lock.acquire()
+        try:
+            if key not in self._entries:
+                while len(self._keys) >= self.max_entries:
+                    self._entries.pop(self._keys.popleft(), None)
+                self._keys.append(key)
+                self._entries[key] = {}
+            self._entries[key].update(results)
+        finally:
+            self._lock.release()
+
+
+class ErratumPackageIndex(object):
+    """
+    Index from the "name arch" of each package listed by a set of errata to the errata
+    and the package versions they list. Probing it with the packages installed on a
+    consumer finds the applicable errata without going through every pkglist.
+    """
+    def __init__(self):
+        # "name arch" -> [(erratum id, position of the rpm in the erratum, rpm)]
+        self.packages = {}
+        self.errata_ids = set()
+
+    def add(self, erratum_id, rpms):
+        """
+        :param erratum_id: id of the erratum
+        :type erratum_id: str
+
+        :param rpms: the rpms the erratum lists, see RPMErrataProfiler.get_rpms_from_errata
+        :type rpms: list of dict
+        """
+        self.errata_ids.add(erratum_id)
+        for position, rpm in enumerate(rpms):
+            self.packages.setdefault(util.form_package_key(rpm), []).append((erratum_id, position, rpm))
+
+    def applicable(self, lookup, erratum_ids=None):
+        """
+        :param lookup: lookup table of a consumer profile, see RPMErrataProfiler.form_lookup_table
+        :type lookup: dict of str: pulp_rpm.common.profile.InstalledPackage
+
+        :param erratum_ids: ids of the errata to consider, all of them when not given
+        :type erratum_ids: set of str
+
+        :return: for each erratum upgrading an installed rpm, the upgrading rpms in the order
+                 the erratum lists them and the upgrade details
+        :rtype: dict of str: ([{}], {'name arch':{'available':{}, 'installed':{}}})
+        """
+        matches = {}
+        for key, installed_rpm in lookup.items():
+            for erratum_id, position, errata_rpm in self.packages.get(key, []):
+                if erratum_ids is not None and erratum_id not in erratum_ids:
+                    continue
+                if util.is_rpm_newer(errata_rpm, installed_rpm):
+                    matches.setdefault(erratum_id, []).append((position, key, errata_rpm, installed_rpm))
+        applicable = {}
+        for erratum_id, rpm_matches in matches.items():
+            rpm_matches.sort(key=lambda match: match[0])
+            applicable_rpms = [match[2] for match in rpm_matches]
+            upgrade_details = {}
+            for position, key, errata_rpm, installed_rpm in rpm_matches:
+                upgrade_details[key] = {"installed":installed_rpm.to_dict(), "available":errata_rpm}
+            applicable[erratum_id] = (applicable_rpms, upgrade_details)
+        return applicable
+
+
+# Applicability results shared by all the units_applicable calls of the process
+_applicability_cache = ApplicabilityCache()
+
+
 class RPMErrataProfiler(Profiler):
     def __init__(self):
         super(RPMErrataProfiler, self).__init__()
@@ -99,27 +204,104 @@ class RPMErrataProfiler(Profiler):
         :return: An applicability report.
         :rtype: pulp.plugins.model.ApplicabilityReport
         """
+        return self.units_applicable_fleet([(consumer, repo_ids)], unit_type_id, unit_keys, config,
+                                           conduit, cache=_applicability_cache)[consumer.id]
+
+
+    def units_applicable_fleet(self, consumer_repos, unit_type_id, unit_keys, config, conduit,
+                               cache=None):
+        """
+        Determine the applicability of errata to many consumers at once. Consumers whose
+        rpm profiles look up the same installed packages, vendors included, and that are
+        bound to the same repos share one computation, whose reports are handed to each
+        of them.
+
+        :param consumer_repos: consumers along with the repo ids to restrict their
+                               applicability search to
+        :type consumer_repos: list of (pulp.server.plugins.model.Consumer, list of str)
+
+        :param unit_type_id: Common type id of all given unit keys
+        :type unit_type_id: str
+
+        :param unit_keys: list of unit keys to identify units
+        :type unit_keys: list of dict
+
+        :param config: plugin configuration
+        :type config: pulp.server.plugins.config.PluginCallConfiguration
+
+        :param conduit: provides access to relevant Pulp functionality
+        :type conduit: pulp.plugins.conduits.profile.ProfilerConduit
+
+        :param cache: results kept across calls, keyed by the revision of the errata found
+                      in the repos so they are not used once the errata change; the
+                      errata are only fetched in full for the results not cached
+        :type cache: ApplicabilityCache
+
+        :return: applicability reports by consumer id; consumers sharing a profile share
+                 the report instances
+        :rtype: dict of str: list of pulp.plugins.model.ApplicabilityReport
+        """
         if unit_type_id != TYPE_ID_ERRATA:
             error_msg = _("units_applicable invoked with type_id [%s], expected [%s]") % (unit_type_id, TYPE_ID_ERRATA)
             _LOG.error(error_msg)
             raise InvalidUnitsRequested(unit_keys, error_msg)
-        
-        applicability_reports = []
-        
-        # If repo_ids or units are empty lists, no need to check for applicability.
-        if not repo_ids or not unit_keys:
-            return applicability_reports
-
-        # For each unit 
-        for unit in unit_keys:
-            applicable_rpms, upgrade_details = self.translate(unit, repo_ids, consumer, conduit)
-            if applicable_rpms:
-                summary = {}
-                details = {"applicable_rpms": applicable_rpms, "upgrade_details":upgrade_details}
-          
-                applicability_reports.append(ApplicabilityReport(summary, details))
 
-        return applicability_reports
+        reports = {}
+        # (lookup hash, repo ids) -> consumers with that lookup table bound to those repos
+        groups = {}
+        # lookup hash -> lookup table shared by the consumers with that hash
+        lookups = {}
+        for consumer, repo_ids in consumer_repos:
+            reports[consumer.id] = []
+            # If repo_ids or units are empty lists, no need to check for applicability.
+            if not repo_ids or not unit_keys:
+                continue
+            if not consumer.profiles.has_key(TYPE_ID_RPM):
+                _LOG.warn("Consumer [%s] is missing profile information for [%s], found profiles are: %s" % \
+                        (consumer.id, TYPE_ID_RPM, consumer.profiles.keys()))
+                continue
+            lookup = self.form_lookup_table(load_rpm_profile(consumer.profiles))
+            hash_value = lookup_hash(lookup)
+            lookups.setdefault(hash_value, lookup)
+            group_key = (hash_value, tuple(sorted(set(repo_ids))))
+            groups.setdefault(group_key, []).append(consumer)
+        _LOG.info("Computing applicability of %s errata for %s consumers sharing %s profiles" % \
+                (len(unit_keys), len(consumer_repos), len(groups)))
+
+        requested_ids = set([unit_key.get('id') for unit_key in unit_keys])
+        for (hash_value, repo_ids), consumers in groups.items():
+            # only the errata listing an installed package can apply
+            package_keys = sorted(lookups[hash_value].keys())
+            cache_key = None
+            results = {}
+            if cache is not None:
+                cache_key = (hash_value, self.errata_revision(unit_keys, repo_ids, conduit, package_keys))
+                results = cache.get(cache_key)
+            computed = {}
+            missing_ids = requested_ids.difference(results.keys())
+            if missing_ids:
+                missing_keys = [unit_key for unit_key in unit_keys if unit_key.get('id') in missing_ids]
+                package_index = self.form_errata_package_index(missing_keys, repo_ids, conduit, package_keys)
+                applicable = package_index.applicable(lookups[hash_value], missing_ids)
+                for erratum_id in missing_ids:
+                    computed[erratum_id] = None
+                    if erratum_id in applicable:
+                        applicable_rpms, upgrade_details = applicable[erratum_id]
+                        summary = {}
+                        details = {"applicable_rpms": self.form_applicable_rpm_units(applicable_rpms),
+                                   "upgrade_details": upgrade_details}
+                        computed[erratum_id] = ApplicabilityReport(summary, details)
+            if cache_key is not None and computed:
+                cache.update(cache_key, computed)
+            results.update(computed)
+            group_reports = []
+            for unit_key in unit_keys:
+                report = results.get(unit_key.get('id'))
+                if report is not None:
+                    group_reports.append(report)
+            for consumer in consumers:
+                reports[consumer.id] = group_reports
+        return reports
 
 
     # -- Below are helper methods not part of the Profiler interface ----
@@ -144,11 +326,13 @@ class RPMErrataProfiler(Profiler):
                     to the rpm name associated to the errata
         :rtype [{'unit_key':{'name':name.arch}, 'type_id':'rpm'}]
         """
+        unit_keys = [unit['unit_key'] for unit in units]
+        applicable = self.find_applicable_rpms(unit_keys, conduit.get_bindings(consumer.id), consumer, conduit)
         translated_units = []
-        for unit in units:
-            values, upgrade_details = self.translate(unit, conduit.get_bindings(consumer.id), consumer, conduit)
-            if values:
-                translated_units.extend(values)
+        for unit_key in unit_keys:
+            if unit_key.get('id') in applicable:
+                applicable_rpms, upgrade_details = applicable[unit_key.get('id')]
+                translated_units.extend(self.form_applicable_rpm_units(applicable_rpms))
         return translated_units
 
     def translate(self, unit, repo_ids, consumer, conduit):
@@ -176,28 +360,149 @@ class RPMErrataProfiler(Profiler):
 
                         dictionary containing information on what existing rpms will be upgraded
 
+                    (None, None) when the erratum is not found or upgrades no installed rpm
+
         :rtype ([{'unit_key':{'name':name.arch}, 'type_id':'rpm'}], {'name arch':{'available':{}, 'installed':{}}   })
         """
-        errata = self.find_unit_associated_to_consumer(TYPE_ID_ERRATA, unit, repo_ids, consumer, conduit)
-        if not errata:
-            error_msg = _("Unable to find errata with unit_key [%s] in bound repos [%s] to consumer [%s]") % \
-                    (unit, repo_ids, consumer.id)
-            _LOG.info(error_msg)
+        applicable = self.find_applicable_rpms([unit], repo_ids, consumer, conduit)
+        if unit.get('id') not in applicable:
+            _LOG.info("Errata with unit_key [%s] in bound repos [%s] upgrades no rpm installed on consumer [%s]" % \
+                    (unit, repo_ids, consumer.id))
             return None, None
-        else:
-            updated_rpms = self.get_rpms_from_errata(errata)
-            _LOG.info("Errata <%s> refers to %s updated rpms of: %s" % (errata.unit_key['id'], len(updated_rpms), updated_rpms))
-            applicable_rpms, upgrade_details = self.rpms_applicable_to_consumer(consumer, updated_rpms)
-            if applicable_rpms:
-                _LOG.info("Rpms: <%s> were found to be related to errata <%s> and applicable to consumer <%s>" % (applicable_rpms, errata, consumer.id))
-            # Return as list of name.arch values
-            ret_val = []
-            for ar in applicable_rpms:
-                pkg_name = "%s.%s" % (ar["name"], ar["arch"])
-                data = {"unit_key":{"name":pkg_name}, "type_id":TYPE_ID_RPM}
-                ret_val.append(data)
-            _LOG.info("Translated errata <%s> to <%s>" % (errata, ret_val))
-            return ret_val, upgrade_details
+        applicable_rpms, upgrade_details = applicable[unit.get('id')]
+        ret_val = self.form_applicable_rpm_units(applicable_rpms)
+        _LOG.info("Translated errata <%s> to <%s>" % (unit.get('id'), ret_val))
+        return ret_val, upgrade_details
+
+    def find_applicable_rpms(self, unit_keys, repo_ids, consumer, conduit):
+        """
+        Lists the rpms of the errata that upgrade a package installed on the consumer.
+        Only the errata listing the name and arch of an installed package are fetched,
+        through the package keys the importer stores on each erratum.
+
+        :param unit_keys: erratum unit keys
+        :type unit_keys: list of dict
+
+        :param repo_ids: Repo ids to restrict the search to.
+        :type repo_ids: list of str
+
+        :param consumer: A consumer.
+        :type consumer: pulp.server.plugins.model.Consumer
+
+        :param conduit: provides access to relevant Pulp functionality
+        :type conduit: pulp.plugins.conduits.profile.ProfilerConduit
+
+        :return: the upgrading rpms and upgrade details by id of the applicable errata,
+                 see ErratumPackageIndex.applicable
+        :rtype: dict
+        """
+        if not consumer.profiles.has_key(TYPE_ID_RPM):
+            _LOG.warn("Consumer [%s] is missing profile information for [%s], found profiles are: %s" % \
+                    (consumer.id, TYPE_ID_RPM, consumer.profiles.keys()))
+            return {}
+        lookup = self.form_lookup_table(load_rpm_profile(consumer.profiles))
+        if not lookup or not unit_keys:
+            return {}
+        package_index = self.form_errata_package_index(unit_keys, repo_ids, conduit, sorted(lookup.keys()))
+        return package_index.applicable(lookup)
+
+    def form_errata_package_index(self, unit_keys, repo_ids, conduit, package_keys=None):
+        """
+        :param package_keys: "name arch" keys; when given, only the errata listing one
+                             of these packages are looked up
+        :type package_keys: list of str
+
+        :return: package index of the errata with the given unit keys found in the repos
+        :rtype: ErratumPackageIndex
+        """
+        package_index = ErratumPackageIndex()
+        errata_units = self.find_errata_in_repos(unit_keys, repo_ids, conduit, package_keys)
+        for unit_key, errata in zip(unit_keys, errata_units):
+            if errata is None:
+                _LOG.info("Unable to find errata with unit_key [%s] in bound repos [%s]" % (unit_key, list(repo_ids)))
+                continue
+            package_index.add(errata.unit_key['id'], self.get_rpms_from_errata(errata))
+        return package_index
+
+    def errata_revision(self, unit_keys, repo_ids, conduit, package_keys=None):
+        """
+        Looks up only the id and updated date of the errata, which the importer changes
+        whenever it replaces an erratum with a newer one.
+
+        :param package_keys: "name arch" keys; when given, only the errata listing one
+                             of these packages are looked up
+        :type package_keys: list of str
+
+        :return: digest of the ids and updated dates of the errata with the given unit
+                 keys found in the repos
+        :rtype: str
+        """
+        errata_units = self.find_errata_in_repos(unit_keys, repo_ids, conduit, package_keys,
+                                                 unit_fields=['id', 'updated'])
+        found = set()
+        for errata in errata_units:
+            if errata is not None:
+                found.add((errata.unit_key['id'], errata.metadata.get('updated')))
+        digest = hashlib.sha1()
+        for erratum_id, updated in sorted(found):
+            digest.update("%s %s\n" % (erratum_id, updated))
+        return digest.hexdigest()
+
+    def form_applicable_rpm_units(self, applicable_rpms):
+        """
+        :return: the rpms as a list of name.arch values
+        :rtype: [{'unit_key':{'name':name.arch}, 'type_id':'rpm'}]
+        """
+        ret_val = []
+        for ar in applicable_rpms:
+            pkg_name = "%s.%s" % (ar["name"], ar["arch"])
+            data = {"unit_key":{"name":pkg_name}, "type_id":TYPE_ID_RPM}
+            ret_val.append(data)
+        return ret_val
+
+    def find_errata_in_repos(self, unit_keys, repo_ids, conduit, package_keys=None, unit_fields=None):
+        """
+        Looks up the errata with the given unit keys with one query per repo for all
+        the keys not found in an earlier repo.
+
+        :param unit_keys: erratum unit keys
+        :type unit_keys: list of dict
+
+        :param repo_ids: Repo ids to restrict the search to, searched in order.
+        :type repo_ids: list of str
+
+        :param conduit: provides access to relevant Pulp functionality
+        :type conduit: pulp.plugins.conduits.profile.ProfilerConduit
+
+        :param package_keys: "name arch" keys; when given, only the errata listing one
+                             of these packages are looked up
+        :type package_keys: list of str
+
+        :param unit_fields: erratum fields to fetch, all of them when not given
+        :type unit_fields: list of str
+
+        :return: the erratum unit for each unit key, in the order of unit_keys; None for keys not found
+        :rtype: list
+        """
+        errata = [None] * len(unit_keys)
+        # erratum id -> indexes of the unit keys still to be found
+        pending = {}
+        for index, unit_key in enumerate(unit_keys):
+            pending.setdefault(unit_key.get('id'), []).append(index)
+        for repo_id in repo_ids:
+            if not pending:
+                break
+            unit_filters = {'id' : {'$in' : sorted(pending.keys())}}
+            if package_keys is not None:
+                unit_filters[util.ERRATUM_PACKAGE_KEYS] = {'$in' : package_keys}
+            criteria = UnitAssociationCriteria(type_ids=[TYPE_ID_ERRATA], unit_fields=unit_fields,
+                                               unit_filters=unit_filters)
+            result = conduit.get_units(repo_id, criteria)
+            _LOG.info("Found %s items when searching in repo <%s> for %s errata" % (len(result), repo_id, len(pending)))
+            for unit in result:
+                for index in pending.pop(unit.unit_key.get('id'), []):
+                    errata[index] = unit
+        return errata
 
     def find_unit_associated_to_consumer(self, unit_type, unit_key, repo_ids, consumer, conduit):
         criteria = UnitAssociationCriteria(type_ids=[unit_type], unit_filters=unit_key)
@@ -228,7 +533,7 @@ class RPMErrataProfiler(Profiler):
                 rpms.append(rpm)
         return rpms
 
-    def rpms_applicable_to_consumer(self, consumer, errata_rpms):
+    def rpms_applicable_to_consumer(self, consumer, errata_rpms, lookup=None):
         """
         :param consumer:
         :type consumer: pulp.server.plugins.model.Consumer
@@ -236,6 +541,10 @@ class RPMErrataProfiler(Profiler):
         :param errata_rpms: 
         :type errata_rpms: list of dicts
 
+        :param lookup: lookup table of the consumer profile, see form_lookup_table;
+                       formed from the consumer profile when not given
+        :type lookup: dict
+
         :return:    tuple, first entry list of dictionaries of applicable 
                     rpm entries, second entry dictionary with more info 
                     of which installed rpm will be upgraded by what rpm
@@ -247,11 +556,12 @@ class RPMErrataProfiler(Profiler):
         """
         applicable_rpms = []
         older_rpms = {}
-        if not consumer.profiles.has_key(TYPE_ID_RPM):
-            _LOG.warn("Consumer [%s] is missing profile information for [%s], found profiles are: %s" % \
-                    (consumer.id, TYPE_ID_RPM, consumer.profiles.keys()))
-            return applicable_rpms, older_rpms
-        lookup = self.form_lookup_table(consumer.profiles[TYPE_ID_RPM])
+        if lookup is None:
+            if not consumer.profiles.has_key(TYPE_ID_RPM):
+                _LOG.warn("Consumer [%s] is missing profile information for [%s], found profiles are: %s" % \
+                        (consumer.id, TYPE_ID_RPM, consumer.profiles.keys()))
+                return applicable_rpms, older_rpms
+            lookup = self.form_lookup_table(load_rpm_profile(consumer.profiles))
         for errata_rpm in errata_rpms:
             key = self.form_lookup_key(errata_rpm)
             if lookup.has_key(key):
@@ -260,26 +570,30 @@ class RPMErrataProfiler(Profiler):
                 _LOG.info("Found a match of rpm <%s> installed on consumer, is %s newer than %s, %s" % (key, errata_rpm, installed_rpm, is_newer))
                 if is_newer:
                     applicable_rpms.append(errata_rpm)
-                    older_rpms[key] = {"installed":installed_rpm, "available":errata_rpm}
+                    older_rpms[key] = {"installed":installed_rpm.to_dict(), "available":errata_rpm}
             else:
                 _LOG.info("rpm %s was not found in consumer profile of %s" % (key, consumer.id))
         return applicable_rpms, older_rpms
 
     def form_lookup_table(self, rpms):
-        lookup = {}
-        for r in rpms:
-            # Assuming that only 1 name.arch is allowed to be installed on a machine
-            # therefore we will handle only one name.arch in the lookup table
-            key = self.form_lookup_key(r)
-            lookup[key] = r
-        return lookup
+        """
+        :param rpms: consumer rpm profile
+        :type rpms: pulp_rpm.common.profile.RPMProfile or list of dict
+
+        :return: the installed packages keyed by "name arch"; when several share a
+                 name and arch, only the last one is kept
+        :rtype: dict of str: pulp_rpm.common.profile.InstalledPackage
+        """
+        if not isinstance(rpms, RPMProfile):
+            rpms = RPMProfile(rpms)
+        return rpms.lookup
 
     def form_lookup_key(self, item):
         #
         # This key needs to avoid usage of a "." since it may be stored in mongo
         # when the upgrade_details are returned for an ApplicableReport
         #
-        return "%s %s" % (item['name'], item['arch'])
+        return util.form_package_key(item)
 
     def form_rpm_unit_key(self, rpm_dict):
         unit_key = {}
@@ -19,7 +19,9 @@ import gettext
 from pulp.plugins.model import ApplicabilityReport
 from pulp.plugins.profiler import Profiler, InvalidUnitsRequested
 from pulp.plugins.conduits.mixins import UnitAssociationCriteria
-from pulp_rpm.common.ids import TYPE_ID_PROFILER_RPM_PKG, TYPE_ID_RPM
+from pulp_rpm.common.ids import TYPE_ID_PROFILER_RPM_PKG, TYPE_ID_RPM, UNIT_KEY_RPM
+from pulp_rpm.common.profile import RPMProfile, InvalidProfileDelta, DELTA_ADDED, DELTA_REMOVED, \
+    apply_profile_delta, is_profile_delta, load_rpm_profile
 from pulp_rpm.yum_plugin import util
 
 _ = gettext.gettext
@@ -37,6 +39,41 @@ class RPMPkgProfiler(Profiler):
                 'types': [TYPE_ID_RPM],
                 }
 
+    # -- profile translation ---------------------------------------------------
+
+    def update_profile(self, consumer, content_type, profile, config):
+        """
+        Consumers that have already uploaded their rpm profile upload only the packages
+        added and removed since; the delta is applied to the stored profile here.
+
+        :param consumer: A consumer.
+        :type consumer: pulp.server.plugins.model.Consumer
+
+        :param content_type: The content type id of the profile.
+        :type content_type: str
+
+        :param profile: The reported profile, a list of installed package entries or a
+                        profile delta, see pulp_rpm.common.profile.profile_delta
+        :type profile: list of dict or dict
+
+        :param config: plugin configuration
+        :type config: pulp.server.plugins.config.PluginCallConfiguration
+
+        :return: The profile to store, a list of installed package entries.
+        :rtype: list of dict
+
+        :raise InvalidProfileDelta: if the delta is not based on the stored profile;
+                                    the consumer then uploads its whole profile
+        """
+        if content_type != TYPE_ID_RPM or not is_profile_delta(profile):
+            return profile
+        if not consumer.profiles.has_key(TYPE_ID_RPM):
+            raise InvalidProfileDelta(_("Consumer [%s] has no stored profile to apply the delta to") % consumer.id)
+        rpms = apply_profile_delta(consumer.profiles[TYPE_ID_RPM], profile)
+        _LOG.debug("Applied profile delta of consumer [%s]: %s added, %s removed" % \
+                (consumer.id, len(profile.get(DELTA_ADDED, [])), len(profile.get(DELTA_REMOVED, []))))
+        return rpms
+
     # -- applicability ---------------------------------------------------------
 
 
@@ -78,9 +115,20 @@ class RPMPkgProfiler(Profiler):
         if not repo_ids or not unit_keys:
             return applicability_reports
 
-        # For each unit 
-        for unit_key in unit_keys:
-            applicable, upgrade_details = self.find_applicable(unit_key, consumer, repo_ids, conduit)
+        if not consumer.profiles.has_key(TYPE_ID_RPM):
+            _LOG.warn("Consumer [%s] is missing profile information for [%s], found profiles are: %s" % \
+                    (consumer.id, TYPE_ID_RPM, consumer.profiles.keys()))
+            return applicability_reports
+
+        # Look up every unit at once and index the consumer profile a single time
+        rpms = self.find_rpms_in_repos(unit_keys, repo_ids, conduit)
+        lookup = self.form_lookup_table(load_rpm_profile(consumer.profiles))
+        for unit_key, rpm in zip(unit_keys, rpms):
+            if rpm is None:
+                _LOG.debug("Unable to find package with unit_key [%s] in repos [%s] to consumer [%s]" % \
+                        (unit_key, repo_ids, consumer.id))
+                continue
+            applicable, upgrade_details = self.rpm_applicable_to_consumer(consumer, rpm.unit_key, lookup)
             if applicable:
                 details = upgrade_details
                 summary = {}
@@ -92,60 +140,64 @@ class RPMPkgProfiler(Profiler):
     # -- Below are helper methods not part of the Profiler interface ----
 
 
-    def find_applicable(self, unit_key, consumer, repo_ids, conduit):
+    def find_rpms_in_repos(self, unit_keys, repo_ids, conduit):
         """
-        Find whether a package with given unit_key in repo_ids is applicable
-        to the consumer.
-
-        :param unit: A content unit key
-        :type unit: dict
+        Return the rpms with the given unit keys, looked up with one query per repo
+        for all the keys not found in an earlier repo.
 
-        :param consumer: A consumer.
-        :type consumer: pulp.server.plugins.model.Consumer
+        :param unit_keys: content unit keys
+        :type unit_keys: list of dict
 
-        :param repo_ids: Repo ids to restrict the applicability search to.
+        :param repo_ids: Repo ids to restrict the search to, searched in order.
         :type repo_ids: list
 
         :param conduit: provides access to relevant Pulp functionality
         :type conduit: pulp.plugins.conduits.profile.ProfilerConduit
 
-        :return:    a tuple consisting of applicable flag and upgrade details
-
-        :rtype: (applicable_flag, {'name arch':{'available':{}, 'installed':{}}})
-        """
-        applicable = False
-        upgrade_details = {}
-
-        # First check whether rpm exists in given repos 
-        rpm = self.find_rpm_in_repos(unit_key, repo_ids, conduit)
-        if not rpm:
-            error_msg = _("Unable to find package with unit_key [%s] in repos [%s] to consumer [%s]") % \
-                    (unit_key, repo_ids, consumer.id)
-            _LOG.debug(error_msg)
-        else:
-            # If rpm exists, find whether it upgrades a consumer profile unit.
-            applicable, upgrade_details = self.rpm_applicable_to_consumer(consumer, rpm.unit_key)
-            if applicable:
-                _LOG.debug("Rpm: <%s> was found to be applicable to consumer <%s>" % (rpm, consumer.id))
-
-        return applicable, upgrade_details
-
-
-    def find_rpm_in_repos(self, unit_key, repo_ids, conduit):
+        :return: the rpm unit for each unit key, in the order of unit_keys; None for keys not found
+        :rtype: list
         """
-        Return details of an rpm, if it exists in given repos. 
-        Returns none if rpm doesn't exist.
-        """
-        criteria = UnitAssociationCriteria(type_ids=[TYPE_ID_RPM], unit_filters=unit_key)
+        rpms = [None] * len(unit_keys)
+        # rpm name -> indexes of the unit keys with that name still to be found
+        pending = {}
+        fields = set(UNIT_KEY_RPM)
+        for index, unit_key in enumerate(unit_keys):
+            pending.setdefault(unit_key.get('name'), []).append(index)
+            fields.update(unit_key.keys())
         for repo_id in repo_ids:
+            if not pending:
+                break
+            criteria = UnitAssociationCriteria(type_ids=[TYPE_ID_RPM], unit_fields=sorted(fields),
+                                               unit_filters={'name' : {'$in' : sorted(pending.keys())}})
             result = conduit.get_units(repo_id, criteria)
-            _LOG.debug("Found %s items when searching in repo <%s> for <%s>" % (len(result), repo_id, criteria))
-            if result:
-                return result[0]
-        return None
+            _LOG.debug("Found %s items when searching in repo <%s> for %s packages" % (len(result), repo_id, len(pending)))
+            for unit in result:
+                name = unit.unit_key.get('name')
+                indexes = pending.get(name)
+                if not indexes:
+                    continue
+                unit_fields = dict(unit.metadata or {})
+                unit_fields.update(unit.unit_key)
+                for index in list(indexes):
+                    if self.unit_key_matches(unit_keys[index], unit_fields):
+                        rpms[index] = unit
+                        indexes.remove(index)
+                if not indexes:
+                    del pending[name]
+        return rpms
+
+
+    def unit_key_matches(self, unit_key, unit_fields):
+        """
+        Checks the fields of a unit against each field of a unit key, as a database query filter would.
+        """
+        for field, value in unit_key.items():
+            if unit_fields.get(field) != value:
+                return False
+        return True
 
 
-    def rpm_applicable_to_consumer(self, consumer, rpm):
+    def rpm_applicable_to_consumer(self, consumer, rpm, lookup=None):
         """
         Checks whether given rpm upgrades an rpm on the consumer.
 
@@ -155,19 +207,23 @@ class RPMPkgProfiler(Profiler):
         :param rpm: a package rpm
         :type rpm: dict
 
+        :param lookup: lookup table of the consumer profile, see form_lookup_table;
+                       formed from the consumer profile when not given
+        :type lookup: dict
+
         :return:  a tuple consisting of applicable flag and upgrade details
         :rtype: (applicable_flag, {'name arch':{'available':{}, 'installed':{}}})
         """
         applicable = False
         older_rpm = {}
 
-        if not consumer.profiles.has_key(TYPE_ID_RPM):
-            _LOG.warn("Consumer [%s] is missing profile information for [%s], found profiles are: %s" % \
-                    (consumer.id, TYPE_ID_RPM, consumer.profiles.keys()))
-            return applicable, older_rpm
-
-        # Form a lookup table from consumer profile
-        lookup = self.form_lookup_table(consumer.profiles[TYPE_ID_RPM])
+        if lookup is None:
+            if not consumer.profiles.has_key(TYPE_ID_RPM):
+                _LOG.warn("Consumer [%s] is missing profile information for [%s], found profiles are: %s" % \
+                        (consumer.id, TYPE_ID_RPM, consumer.profiles.keys()))
+                return applicable, older_rpm
+            # Form a lookup table from consumer profile
+            lookup = self.form_lookup_table(load_rpm_profile(consumer.profiles))
         key = self.form_lookup_key(rpm)
         
         if lookup.has_key(key):
@@ -177,7 +233,7 @@ class RPMPkgProfiler(Profiler):
             _LOG.debug("Found a match of rpm <%s> installed on consumer, is %s newer than %s, %s" % (key, rpm, installed_rpm, is_newer))
             if is_newer:
                 applicable = True
-                older_rpm[key] = {"installed":installed_rpm, "available":rpm}
+                older_rpm[key] = {"installed":installed_rpm.to_dict(), "available":rpm}
         else:
             _LOG.debug("rpm %s was not found in consumer profile of %s" % (key, consumer.id))
 
@@ -185,13 +241,17 @@ class RPMPkgProfiler(Profiler):
 
 
     def form_lookup_table(self, rpms):
-        lookup = {}
-        for r in rpms:
-            # Assuming that only 1 name.arch is allowed to be installed on a machine
-            # therefore we will handle only one name.arch in the lookup table
-            key = self.form_lookup_key(r)
-            lookup[key] = r
-        return lookup
+        """
+        :param rpms: consumer rpm profile
+        :type rpms: pulp_rpm.common.profile.RPMProfile or list of dict
+
+        :return: the installed packages keyed by "name arch"; when several share a
+                 name and arch, only the last one is kept
+        :rtype: dict of str: pulp_rpm.common.profile.InstalledPackage
+        """
+        if not isinstance(rpms, RPMProfile):
+            rpms = RPMProfile(rpms)
+        return rpms.lookup
 
 
     def form_lookup_key(self, item):
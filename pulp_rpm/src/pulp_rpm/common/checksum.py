@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2013 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+"""
+File hashing shared by the importers. Large files are hashed through mmap and
+smaller ones are read into a reusable buffer; any number of digest types are
+computed in a single pass over the data. ChecksumService hashes many files
+concurrently.
+"""
+from multiprocessing.pool import ThreadPool
+import hashlib
+import mmap
+import os
+import threading
+
+# Files at least this large are hashed through mmap rather than read()
+MMAP_THRESHOLD = 4 * 1024 * 1024
+# Size of the per thread buffer used for files below MMAP_THRESHOLD
+BUFFER_SIZE = 1024 * 1024
+# Size of the blocks of a mapped file fed to each hasher in turn
+MMAP_BLOCK_SIZE = 8 * 1024 * 1024
+DEFAULT_WORKERS = 4
+
+_buffers = threading.local()
+
+
+def normalize_checksum_type(checksum_type):
+    """
+    :param checksum_type: checksum type as found in yum metadata, such as 'sha' or 'sha256'
+    :type  checksum_type: str
+
+    :return: the matching hashlib algorithm name
+    :rtype:  str
+    """
+    if checksum_type in ('sha', 'SHA'):
+        return 'sha1'
+    return checksum_type.lower()
+
+
+def _get_buffer():
+    buf = getattr(_buffers, 'buf', None)
+    if buf is None:
+        buf = _buffers.buf = bytearray(BUFFER_SIZE)
+    return buf
+
+
+def file_checksums(path, checksum_types=('sha256',)):
+    """
+    Computes every requested digest of a file in a single pass.
+
+    :param path: path of the file to hash
+    :type  path: str
+    :param checksum_types: checksum types to compute
+    :type  checksum_types: iterable of str
+
+    :return: mapping of each requested checksum type to its hex digest
+    :rtype:  dict
+    """
+    checksum_types = list(checksum_types)
+    hashers = [hashlib.new(normalize_checksum_type(t)) for t in checksum_types]
+    f = open(path, 'rb')
+    try:
+        size = os.fstat(f.fileno()).st_size
+        if size >= MMAP_THRESHOLD:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                # every hasher digests a block before the next block is touched, so each
+                # page is read once; hashlib releases the GIL while it works through a block
+                for offset in xrange(0, size, MMAP_BLOCK_SIZE):
+                    data = buffer(mapped, offset, MMAP_BLOCK_SIZE)
+                    for hasher in hashers:
+                        hasher.update(data)
+            finally:
+                mapped.close()
+        else:
+            buf = _get_buffer()
+            while True:
+                read = f.readinto(buf)
+                if not read:
+                    break
+                data = buffer(buf, 0, read)
+                for hasher in hashers:
+                    hasher.update(data)
+    finally:
+        f.close()
+    return dict([(t, h.hexdigest()) for t, h in zip(checksum_types, hashers)])
+
+
+def file_checksum(path, checksum_type='sha256'):
+    """
+    :param path: path of the file to hash
+    :type  path: str
+    :param checksum_type: checksum type to compute
+    :type  checksum_type: str
+
+    :return: hex digest of the file
+    :rtype:  str
+    """
+    return file_checksums(path, (checksum_type,))[checksum_type]
+
+
+def _hash_request(request):
+    path, checksum_types = request
+    try:
+        return path, file_checksums(path, checksum_types)
+    except Exception, e:
+        return path, e
+
+
+class ChecksumService(object):
+    """
+    Hashes many files concurrently on a pool of threads. hashlib releases the GIL
+    while digesting, so the work spreads across cores without forking the server
+    process.
+    """
+    def __init__(self, workers=DEFAULT_WORKERS):
+        """
+        :param workers: number of files hashed at once
+        :type  workers: int
+        """
+        self.workers = workers
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def _get_pool(self):
+        self._lock.acquire()
+        try:
+            if self._pool is None:
+                self._pool = ThreadPool(self.workers)
+            return self._pool
+        finally:
+            self._lock.release()
+
+    def checksums(self, requests):
+        """
+        :param requests: (path, checksum types) pairs; the types of a path are computed in one pass
+        :type  requests: iterable of (str, iterable of str)
+
+        :return: iterator of (path, result) pairs in completion order; result is a mapping of
+                 checksum type to hex digest, or the exception raised while hashing that path
+        :rtype:  iterator
+        """
+        requests = [(path, tuple(types)) for path, types in requests]
+        if not requests:
+            return iter([])
+        if len(requests) == 1:
+            return iter([_hash_request(requests[0])])
+        return self._get_pool().imap_unordered(_hash_request, requests)
+
+    def close(self):
+        self._lock.acquire()
+        try:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool.join()
+                self._pool = None
+        finally:
+            self._lock.release()
+
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def get_service():
+    """
+    :return: the process wide ChecksumService
+    :rtype:  ChecksumService
+    """
+    global _service
+    _service_lock.acquire()
+    try:
+        if _service is None:
+            _service = ChecksumService()
+        return _service
+    finally:
+        _service_lock.release()
@@ -0,0 +1,419 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2013 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+"""
+Consumer RPM profile support shared by the profilers and the consumer agent.
+"""
+import hashlib
+import os
+import tempfile
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from pulp_rpm.common.ids import TYPE_ID_RPM
+
+# Fields identifying an installed package in a profile
+PROFILE_ENTRY_FIELDS = ("name", "epoch", "version", "release", "arch")
+
+# Keys of a profile delta, uploaded in place of the whole profile when the server
+# already has the profile the delta is based on
+DELTA_BASE_HASH = "base_hash"
+DELTA_HASH = "hash"
+DELTA_ADDED = "added"
+DELTA_REMOVED = "removed"
+
+# Where the consumer records the last rpm profile it uploaded
+PROFILE_RECORD_PATH = "/var/lib/pulp/consumer/rpm_profile.json"
+
+
+class InvalidProfileDelta(Exception):
+    """
+    Raised when a profile delta does not apply to the profile stored for the consumer.
+    The consumer has to upload its whole profile instead.
+    """
+    pass
+
+
+def profile_entry_id(entry):
+    """
+    :param entry: installed package entry of an rpm profile
+    :type  entry: dict
+
+    :return: the name, epoch, version, release and arch of the package as strings
+    :rtype:  tuple
+    """
+    return tuple([str(entry.get(field)) for field in PROFILE_ENTRY_FIELDS])
+
+
+def profile_hash(rpms):
+    """
+    Hashes the installed packages of an rpm profile. The hash does not depend on
+    the order of the entries, so consumers with the same packages installed get the
+    same hash.
+
+    :param rpms: the rpm profile, a list of installed package entries
+    :type  rpms: list of dict
+
+    :return: hex digest identifying the profile
+    :rtype:  str
+    """
+    digest = hashlib.sha256()
+    for entry_id in sorted([profile_entry_id(entry) for entry in rpms]):
+        digest.update(" ".join(entry_id))
+        digest.update("\n")
+    return digest.hexdigest()
+
+
+# Fields kept for each installed package of a compact profile
+INSTALLED_PACKAGE_FIELDS = PROFILE_ENTRY_FIELDS + ("vendor",)
+
+# Shared copies of the unicode strings and (epoch, version, release) tuples of loaded
+# profiles, which intern() does not take; consumers mostly run the same packages, so
+# most values are shared. The table is dropped once it holds this many values.
+MAX_SHARED_VALUES = 100000
+_shared = {}
+
+
+def intern_value(value):
+    """
+    :param value: a profile value, such as a package name or an (epoch, version, release) tuple
+    :type  value: object
+
+    :return: the shared copy of an equal value, which is value itself the first time it is seen
+    :rtype:  object
+    """
+    if type(value) is str:
+        return intern(value)
+    try:
+        return _shared[value]
+    except KeyError:
+        pass
+    if len(_shared) >= MAX_SHARED_VALUES:
+        _shared.clear()
+    _shared[value] = value
+    return value
+
+
+class InstalledPackage(object):
+    """
+    A package in a compact rpm profile. The strings and the packed (epoch, version, release)
+    tuple are shared between all the profiles listing the same package. Reads like the
+    profile entry dict it was made from, so it can be passed where an rpm dict is expected.
+    """
+    __slots__ = ("name", "arch", "evr", "vendor")
+
+    def __init__(self, name, epoch, version, release, arch, vendor=None):
+        self.name = intern_value(name)
+        self.arch = intern_value(arch)
+        self.evr = intern_value((intern_value(epoch), intern_value(version), intern_value(release)))
+        self.vendor = intern_value(vendor)
+
+    @classmethod
+    def from_entry(cls, entry):
+        """
+        :param entry: installed package entry of an rpm profile
+        :type  entry: dict
+
+        :rtype: InstalledPackage
+        """
+        return cls(entry.get("name"), entry.get("epoch"), entry.get("version"), entry.get("release"),
+                   entry.get("arch"), entry.get("vendor"))
+
+    @property
+    def epoch(self):
+        return self.evr[0]
+
+    @property
+    def version(self):
+        return self.evr[1]
+
+    @property
+    def release(self):
+        return self.evr[2]
+
+    def __getitem__(self, field):
+        if field not in INSTALLED_PACKAGE_FIELDS:
+            raise KeyError(field)
+        return getattr(self, field)
+
+    def __contains__(self, field):
+        return field in INSTALLED_PACKAGE_FIELDS
+
+    has_key = __contains__
+
+    def get(self, field, default=None):
+        if field not in INSTALLED_PACKAGE_FIELDS:
+            return default
+        return getattr(self, field)
+
+    def to_dict(self):
+        """
+        :return: the profile entry for the package
+        :rtype:  dict
+        """
+        return dict([(field, getattr(self, field)) for field in INSTALLED_PACKAGE_FIELDS])
+
+    def __eq__(self, other):
+        if not isinstance(other, InstalledPackage):
+            return NotImplemented
+        return (self.name, self.arch, self.evr, self.vendor) == (other.name, other.arch, other.evr, other.vendor)
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    def __repr__(self):
+        return "InstalledPackage(%r)" % self.to_dict()
+
+
+def package_key(entry):
+    """
+    :param entry: installed package entry of an rpm profile
+    :type  entry: dict or InstalledPackage
+
+    :return: "name arch" of the package, the key the profilers look packages up by
+    :rtype:  str
+    """
+    return "%s %s" % (entry["name"], entry["arch"])
+
+
+class RPMProfile(object):
+    """
+    Compact form of a consumer rpm profile. Iterates over the installed packages like the
+    list of entries it was made from, and holds the lookup table of the packages by
+    "name arch" the profilers use. When several packages share a name and arch, the last
+    one listed is the one looked up.
+    """
+    __slots__ = ("packages", "lookup")
+
+    def __init__(self, rpms):
+        """
+        :param rpms: the rpm profile, a list of installed package entries
+        :type  rpms: list of dict
+        """
+        self.packages = tuple([InstalledPackage.from_entry(entry) for entry in rpms])
+        self.lookup = {}
+        for package in self.packages:
+            self.lookup[intern_value(package_key(package))] = package
+
+    def __iter__(self):
+        return iter(self.packages)
+
+    def __len__(self):
+        return len(self.packages)
+
+    def to_list(self):
+        """
+        :return: the rpm profile as a list of installed package entries
+        :rtype:  list of dict
+        """
+        return [package.to_dict() for package in self.packages]
+
+
+def lookup_hash(lookup):
+    """
+    Hashes a lookup table of installed packages by "name arch", vendors included.
+    Unlike profile_hash, the hash depends on which package is looked up when several
+    share a name and arch, so it changes with the order of such entries; profiles with
+    the same lookup hash get the same applicability.
+
+    :param lookup: installed packages keyed by "name arch"
+    :type  lookup: dict
+
+    :return: hex digest identifying the lookup table
+    :rtype:  str
+    """
+    digest = hashlib.sha256()
+    for key in sorted(lookup.keys()):
+        entry = lookup[key]
+        vendor = entry.get("vendor")
+        if isinstance(vendor, unicode):
+            vendor = vendor.encode("utf-8")
+        digest.update(" ".join(profile_entry_id(entry) + (str(vendor),)))
+        digest.update("\n")
+    return digest.hexdigest()
+
+
+def load_rpm_profile(profiles):
+    """
+    Builds the compact form of the rpm profile of a consumer. The profiles are left as
+    they are and no reference to the entry dicts is kept, so only the compact form
+    outlives them.
+
+    :param profiles: profiles of a consumer, keyed by content type
+    :type  profiles: dict
+
+    :return: the compact rpm profile, None when the consumer has no rpm profile
+    :rtype:  RPMProfile
+    """
+    rpms = profiles.get(TYPE_ID_RPM)
+    if rpms is None or isinstance(rpms, RPMProfile):
+        return rpms
+    return RPMProfile(rpms)
+
+
+def is_profile_delta(profile):
+    """
+    :param profile: an uploaded rpm profile
+    :type  profile: list or dict
+
+    :return: True when the upload is a profile delta rather than a whole profile
+    :rtype:  bool
+    """
+    return isinstance(profile, dict) and DELTA_BASE_HASH in profile
+
+
+def _count_entries(rpms):
+    counts = {}
+    for entry in rpms:
+        entry_id = profile_entry_id(entry)
+        counts[entry_id] = counts.get(entry_id, 0) + 1
+    return counts
+
+
+def profile_delta(base_rpms, rpms):
+    """
+    :param base_rpms: the rpm profile the server has
+    :type  base_rpms: list of dict
+
+    :param rpms: the current rpm profile
+    :type  rpms: list of dict
+
+    :return: the packages added and removed since base_rpms, along with the hashes of
+             both profiles, see apply_profile_delta
+    :rtype:  dict
+    """
+    base_counts = _count_entries(base_rpms)
+    counts = _count_entries(rpms)
+    added = []
+    for entry in rpms:
+        entry_id = profile_entry_id(entry)
+        if base_counts.get(entry_id, 0) > 0:
+            base_counts[entry_id] -= 1
+        else:
+            added.append(entry)
+    removed = []
+    for entry in base_rpms:
+        entry_id = profile_entry_id(entry)
+        if counts.get(entry_id, 0) > 0:
+            counts[entry_id] -= 1
+        else:
+            removed.append(dict([(field, entry.get(field)) for field in PROFILE_ENTRY_FIELDS]))
+    return {DELTA_BASE_HASH : profile_hash(base_rpms), DELTA_HASH : profile_hash(rpms),
+            DELTA_ADDED : added, DELTA_REMOVED : removed}
+
+
+def apply_profile_delta(base_rpms, delta):
+    """
+    :param base_rpms: the rpm profile stored for the consumer
+    :type  base_rpms: list of dict or RPMProfile
+
+    :param delta: profile delta uploaded by the consumer, see profile_delta
+    :type  delta: dict
+
+    :return: the consumer's current rpm profile
+    :rtype:  list of dict
+
+    :raise InvalidProfileDelta: if the delta is not based on base_rpms
+    """
+    if isinstance(base_rpms, RPMProfile):
+        base_rpms = base_rpms.to_list()
+    if profile_hash(base_rpms) != delta.get(DELTA_BASE_HASH):
+        raise InvalidProfileDelta("profile delta is based on profile [%s], not the stored profile" %
+                                  delta.get(DELTA_BASE_HASH))
+    removed = _count_entries(delta.get(DELTA_REMOVED, []))
+    rpms = []
+    for entry in base_rpms:
+        entry_id = profile_entry_id(entry)
+        if removed.get(entry_id, 0) > 0:
+            removed[entry_id] -= 1
+        else:
+            rpms.append(entry)
+    rpms.extend(delta.get(DELTA_ADDED, []))
+    if profile_hash(rpms) != delta.get(DELTA_HASH):
+        raise InvalidProfileDelta("profile delta does not produce profile [%s]" % delta.get(DELTA_HASH))
+    return rpms
+
+
+class ProfileRecord(object):
+    """
+    The last rpm profile a consumer uploaded, which later uploads are sent as deltas against.
+    """
+
+    def __init__(self, path=PROFILE_RECORD_PATH):
+        self.path = path
+
+    def load(self, consumer_id):
+        """
+        :param consumer_id: id of the consumer the profile was uploaded for
+        :type  consumer_id: str
+
+        :return: the recorded profile, None when none is recorded for the consumer
+        :rtype:  list of dict
+        """
+        try:
+            fp = open(self.path)
+            try:
+                record = json.load(fp)
+            finally:
+                fp.close()
+        except (IOError, ValueError):
+            return None
+        if not isinstance(record, dict) or record.get("consumer_id") != consumer_id:
+            return None
+        return record.get("rpms")
+
+    def save(self, consumer_id, rpms):
+        """
+        :param consumer_id: id of the consumer the profile was uploaded for
+        :type  consumer_id: str
+
+        :param rpms: the uploaded rpm profile
+        :type  rpms: list of dict
+        """
+        dir_path = os.path.dirname(self.path)
+        if not os.path.exists(dir_path):
+            os.makedirs(dir_path)
+        # written aside and renamed, so a concurrent upload never reads a partial record
+        fd, tmp_path = tempfile.mkstemp(dir=dir_path)
+        fp = os.fdopen(fd, "w")
+        try:
+            json.dump({"consumer_id" : consumer_id, "rpms" : rpms}, fp)
+        finally:
+            fp.close()
+        os.rename(tmp_path, self.path)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def form_upload(self, consumer_id, rpms):
+        """
+        :param consumer_id: id of the consumer uploading the profile
+        :type  consumer_id: str
+
+        :param rpms: the current rpm profile
+        :type  rpms: list of dict
+
+        :return: a delta against the recorded profile, or the whole profile when
+                 none is recorded
+        :rtype:  dict or list of dict
+        """
+        base_rpms = self.load(consumer_id)
+        if base_rpms is None:
+            return rpms
+        return profile_delta(base_rpms, rpms)
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+# Migration script to store the name and arch of the packages an erratum lists on the erratum.
+#
+# Copyright © 2013 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+
+import logging
+
+from pulp.server.managers.content.query import ContentQueryManager
+from pulp_rpm.common.ids import TYPE_ID_ERRATA
+from pulp_rpm.yum_plugin import util
+
+_log = logging.getLogger('pulp')
+
+def _migrate_errata_package_keys():
+    """
+    Looks up the erratum unit collection in the db and stores the "name arch" of the
+    packages each erratum lists, used by the errata profiler to find the errata that
+    apply to the packages installed on a consumer.
+    """
+    query_manager = ContentQueryManager()
+    collection = query_manager.get_content_unit_collection(type_id=TYPE_ID_ERRATA)
+    for erratum_unit in collection.find({util.ERRATUM_PACKAGE_KEYS : {'$exists' : False}}):
+        erratum_unit[util.ERRATUM_PACKAGE_KEYS] = util.get_errata_package_keys(erratum_unit.get('pkglist'))
+        collection.save(erratum_unit, safe=True)
+    _log.info("Migrated errata to include the name and arch of their packages")
+
+def migrate(*args, **kwargs):
+    _migrate_errata_package_keys()
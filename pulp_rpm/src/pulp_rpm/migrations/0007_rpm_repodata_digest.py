@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+# Migration script to store the digest of the repodata snippets on each rpm and srpm.
+#
+# Copyright © 2013 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+
+import logging
+
+from pulp.server.managers.content.query import ContentQueryManager
+from pulp_rpm.common.ids import TYPE_ID_RPM, TYPE_ID_SRPM
+from pulp_rpm.yum_plugin import util
+
+_log = logging.getLogger('pulp')
+
+def _migrate_rpm_repodata_digest():
+    """
+    Looks up the rpm and srpm unit collections in the db and stores the digest of the
+    repodata snippets of each unit, used by the incremental publish and the dependency
+    index to find the units whose snippets changed without reading them.
+    """
+    query_manager = ContentQueryManager()
+    for type_id in (TYPE_ID_RPM, TYPE_ID_SRPM):
+        collection = query_manager.get_content_unit_collection(type_id=type_id)
+        for rpm_unit in collection.find({util.REPODATA_DIGEST : {'$exists' : False}}):
+            rpm_unit[util.REPODATA_DIGEST] = util.get_repodata_digest(rpm_unit.get('repodata'))
+            collection.save(rpm_unit, safe=True)
+    _log.info("Migrated rpms to include the digest of their repodata")
+
+def migrate(*args, **kwargs):
+    _migrate_rpm_repodata_digest()
@@ -14,11 +14,10 @@ from cStringIO import StringIO
 from gettext import gettext as _
 from urlparse import urljoin
 import csv
-import hashlib
 import logging
 import os
 
-from pulp_rpm.common import constants, ids
+from pulp_rpm.common import checksum, constants, ids
 from pulp_rpm.common.constants import STATE_COMPLETE, STATE_RUNNING, STATE_FAILED
 from pulp_rpm.common.progress import SyncProgressReport
 
@@ -29,8 +28,6 @@ from pulp.plugins.conduits.mixins import UnitAssociationCriteria
 
 
 logger = logging.getLogger(__name__)
-# How many bytes we want to read into RAM at a time when validating a download checksum
-VALIDATION_CHUNK_SIZE = 32 * 1024 * 1024
 
 
 class ISOSyncRun(listener.DownloadEventListener):
@@ -278,30 +275,21 @@ class ISOSyncRun(listener.DownloadEventListener):
         :param iso: A dictionary describing the ISO file we want to validate
         :type  iso: dict
         """
-        with open(iso['destination']) as destination_file:
-            # Validate the size, if we know what it should be
-            if 'size' in iso:
-                # seek to the end to find the file size with tell()
-                destination_file.seek(0, 2)
-                size = destination_file.tell()
-                if size != iso['size']:
-                    raise ValueError(_('Downloading <%(name)s> failed validation. '
-                        'The manifest specified that the file should be %(expected)s bytes, but '
-                        'the downloaded file is %(found)s bytes.') % {'name': iso['name'],
-                            'expected': iso['size'], 'found': size})
-
-            # Validate the checksum, if we know what it should be
-            if 'checksum' in iso:
-                destination_file.seek(0)
-                hasher = hashlib.sha256()
-                bits = destination_file.read(VALIDATION_CHUNK_SIZE)
-                while bits:
-                    hasher.update(bits)
-                    bits = destination_file.read(VALIDATION_CHUNK_SIZE)
-                # Verify that, son!
-                if hasher.hexdigest() != iso['checksum']:
-                    raise ValueError(
-                        _('Downloading <%(name)s> failed checksum validation. The manifest '
-                          'specified the checksum to be %(c)s, but it was %(f)s.') % {
-                            'name': iso['name'], 'c': iso['checksum'],
-                            'f': hasher.hexdigest()})
+        # Validate the size, if we know what it should be
+        if 'size' in iso:
+            size = os.path.getsize(iso['destination'])
+            if size != iso['size']:
+                raise ValueError(_('Downloading <%(name)s> failed validation. '
+                    'The manifest specified that the file should be %(expected)s bytes, but '
+                    'the downloaded file is %(found)s bytes.') % {'name': iso['name'],
+                        'expected': iso['size'], 'found': size})
+
+        # Validate the checksum, if we know what it should be
+        if 'checksum' in iso:
+            found = checksum.file_checksum(iso['destination'], 'sha256')
+            # Verify that, son!
+            if found != iso['checksum']:
+                raise ValueError(
+                    _('Downloading <%(name)s> failed checksum validation. The manifest '
+                      'specified the checksum to be %(c)s, but it was %(f)s.') % {
+                        'name': iso['name'], 'c': iso['checksum'], 'f': found})
@@ -0,0 +1,443 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2013 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+
+"""
+Per repository index of the packages, provides, requires and files of its rpm
+units, built from the primary xml snippet stored on each unit. The dependency
+solver answers its queries from the index instead of generating the repo
+metadata and loading it into a yum package sack.
+
+The index lives in a sqlite database in the repo working directory and is
+brought up to date with the repo's units each time it is used: only the ids
+and stored repodata digests of the units are looked up and compared with the
+digests recorded when they were indexed, units no longer in the repo are dropped
+and only the units added or whose snippets changed since the last use are
+fetched and parsed. Updates hold an exclusive lock on the database, so
+concurrent dependency resolutions against the same repo apply them one at a
+time.
+
+Files are indexed from the filelists snippet of each unit, the same file
+lists yum resolves file requirements from; units stored without one fall back
+to the files listed in their primary snippet.
+"""
+
+import os
+import re
+import sqlite3
+import time
+
+from rpmUtils.miscutils import rangeCompare
+
+from pulp.server.db.model.criteria import UnitAssociationCriteria
+from pulp_rpm.common.ids import TYPE_ID_RPM
+from pulp_rpm.yum_plugin import sqlitedb, util
+
+_LOG = util.getLogger(__name__)
+
+INDEX_FILE_NAME = "dependency_index.db"
+INDEX_VERSION = 4
+# Seconds to wait for another process's update of the index to finish
+LOCK_TIMEOUT = 600
+
+TABLES = ["db_info", "packages", "provides", "requires", "files"]
+
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS db_info (dbversion INTEGER)",
+    "CREATE TABLE IF NOT EXISTS packages (pkgKey INTEGER PRIMARY KEY, unit_id TEXT, name TEXT, "
+        "epoch TEXT, version TEXT, release TEXT, arch TEXT, checksumtype TEXT, checksum TEXT, digest TEXT)",
+    "CREATE TABLE IF NOT EXISTS provides (name TEXT, flags TEXT, epoch TEXT, version TEXT, release TEXT, "
+        "pkgKey INTEGER)",
+    "CREATE TABLE IF NOT EXISTS requires (name TEXT, flags TEXT, epoch TEXT, version TEXT, release TEXT, "
+        "pkgKey INTEGER)",
+    "CREATE TABLE IF NOT EXISTS files (name TEXT, pkgKey INTEGER)",
+    "CREATE INDEX IF NOT EXISTS packageunit ON packages (unit_id)",
+    "CREATE INDEX IF NOT EXISTS packagename ON packages (name)",
+    "CREATE INDEX IF NOT EXISTS providesname ON provides (name)",
+    "CREATE INDEX IF NOT EXISTS pkgprovides ON provides (pkgKey)",
+    "CREATE INDEX IF NOT EXISTS pkgrequires ON requires (pkgKey)",
+    "CREATE INDEX IF NOT EXISTS filenames ON files (name)",
+    "CREATE INDEX IF NOT EXISTS pkgfiles ON files (pkgKey)",
+]
+
+PACKAGE_FIELDS = "pkgKey, name, epoch, version, release, arch, checksumtype, checksum"
+UNIT_FIELDS = ['id', 'name', 'epoch', 'version', 'release', 'arch', 'checksumtype', 'checksum', 'repodata',
+               util.REPODATA_DIGEST]
+
+# requirements the solver treats as file names, same as yum's depsolver
+FILENAME_MATCH = re.compile('[/*?]|\[[^]]*/[^]]*\]').match
+GLOB_CHARACTERS = re.compile('[*?[]')
+# sqlite limits the number of parameters of a statement
+QUERY_CHUNK = 500
+
+
+def index_path(repo):
+    """
+    @param repo: repository the index belongs to
+    @type  repo: pulp.plugins.model.Repository
+
+    @return path of the repository's dependency index
+    @rtype str
+    """
+    return os.path.join(repo.working_dir, INDEX_FILE_NAME)
+
+
+def unit_digest(unit):
+    """
+    @param unit: rpm unit, with the stored digest of its repodata or the repodata in its metadata
+    @type  unit: pulp.plugins.model.Unit
+
+    @return digest of the unit's snippets, see util.get_repodata_digest
+    @rtype str
+    """
+    repodata_digest = unit.metadata.get(util.REPODATA_DIGEST)
+    if repodata_digest is None:
+        repodata_digest = util.get_repodata_digest(unit.metadata.get('repodata'))
+    return repodata_digest
+
+
+def _chunks(items, size=QUERY_CHUNK):
+    items = list(items)
+    for index in range(0, len(items), size):
+        yield items[index:index + size]
+
+
+class IndexedPackage(object):
+    """
+    Package of the dependency index; carries the attributes of a yum package
+    object the dependency solver's results are read through.
+    """
+    def __init__(self, pkg_key, name, epoch, version, release, arch, checksumtype, checksum):
+        self.pkg_key = pkg_key
+        self.name = name
+        self.epoch = epoch
+        self.version = version
+        self.release = release
+        self.arch = arch
+        self.checksums = [(checksumtype, checksum, 1)]
+
+    def __repr__(self):
+        return "<IndexedPackage %s>" % self.compactPrint()
+
+    def compactPrint(self):
+        if self.epoch and self.epoch != '0':
+            evr = "%s:%s-%s" % (self.epoch, self.version, self.release)
+        else:
+            evr = "%s-%s" % (self.version, self.release)
+        return "%s.%s %s" % (self.name, self.arch, evr)
+
+    def match_names(self):
+        """
+        @return the package name formats the package is matched by
+        @rtype set
+        """
+        n, e, v, r, a = self.name, self.epoch or '0', self.version, self.release, self.arch
+        return set([n, "%s.%s" % (n, a), "%s-%s-%s.%s" % (n, v, r, a), "%s-%s" % (n, v),
+                    "%s-%s-%s" % (n, v, r), "%s:%s-%s-%s.%s" % (e, n, v, r, a),
+                    "%s-%s:%s-%s.%s" % (n, e, v, r, a)])
+
+
+class DependencyIndex(object):
+    """
+    Sqlite index of the dependency data of a repository's rpm units
+    """
+    def __init__(self, path):
+        """
+        @param path: path of the index database; it is created when missing
+        @type  path: str
+        """
+        self.path = path
+        parent = os.path.dirname(path)
+        if parent and not os.path.isdir(parent):
+            os.makedirs(parent)
+        self._in_transaction = False
+        self.connection = self._open()
+        self._packages = {}
+
+    def _connect(self):
+        # transactions are begun explicitly, see _write
+        connection = sqlite3.connect(self.path, timeout=LOCK_TIMEOUT, isolation_level=None)
+        connection.text_factory = str
+        # the index is rebuilt from the repo's units when lost, durability is not needed
+        connection.execute("PRAGMA synchronous = OFF")
+        return connection
+
+    def _open(self):
+        try:
+            connection = self._connect()
+            connection.execute("BEGIN IMMEDIATE")
+        except sqlite3.OperationalError:
+            raise
+        except sqlite3.DatabaseError:
+            # not a database: start over
+            _LOG.warn("Replacing unreadable dependency index %s" % self.path)
+            os.unlink(self.path)
+            connection = self._connect()
+            connection.execute("BEGIN IMMEDIATE")
+        try:
+            try:
+                version = connection.execute("SELECT dbversion FROM db_info").fetchone()
+            except sqlite3.OperationalError:
+                version = None
+            if version is None or version[0] != INDEX_VERSION:
+                # missing or from another index version: start over
+                for table in TABLES:
+                    connection.execute("DROP TABLE IF EXISTS %s" % table)
+                for statement in SCHEMA:
+                    connection.execute(statement)
+                connection.execute("INSERT INTO db_info VALUES (?)", (INDEX_VERSION,))
+            connection.execute("COMMIT")
+        except:
+            connection.execute("ROLLBACK")
+            connection.close()
+            raise
+        return connection
+
+    def _write(self, method, *args):
+        """
+        Runs method in a write transaction. The database lock is taken when the
+        transaction begins, so updates from several processes are applied one after
+        the other rather than interleaved; calls made within a transaction join it.
+        """
+        if self._in_transaction:
+            return method(*args)
+        self.connection.execute("BEGIN IMMEDIATE")
+        self._in_transaction = True
+        try:
+            try:
+                result = method(*args)
+            except:
+                self.connection.execute("ROLLBACK")
+                raise
+            self.connection.execute("COMMIT")
+            return result
+        finally:
+            self._in_transaction = False
+
+    def close(self):
+        self.connection.close()
+
+    # -- maintenance ----------------------------------------------------------
+
+    def unit_ids(self):
+        """
+        @return ids of the units in the index
+        @rtype set
+        """
+        return set([row[0] for row in self.connection.execute("SELECT DISTINCT unit_id FROM packages")])
+
+    def unit_digests(self):
+        """
+        @return digest of the snippets each unit in the index was indexed from, keyed by unit id
+        @rtype {str:str}
+        """
+        return dict(self.connection.execute("SELECT unit_id, digest FROM packages"))
+
+    def add_units(self, units):
+        """
+        @param units: rpm units to index; their metadata needs the repodata primary snippet
+        @type  units: iterable of pulp.plugins.model.Unit
+
+        @return number of units added
+        @rtype int
+        """
+        return self._write(self._add_units, units)
+
+    def _add_units(self, units):
+        added = 0
+        for unit in units:
+            key = unit.unit_key
+            # sqlite assigns the key, unique even with several writers
+            cursor = self.connection.execute("INSERT INTO packages VALUES (NULL, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (unit.id, key['name'], key['epoch'], key['version'], key['release'], key['arch'],
+                 key['checksumtype'], key['checksum'], unit_digest(unit)))
+            pkg_key = cursor.lastrowid
+            added += 1
+            repodata = unit.metadata.get('repodata') or {}
+            packages = sqlitedb.parse_snippets("primary", repodata.get('primary'))
+            if not packages:
+                _LOG.debug("No primary metadata for %s; indexing its self provide only" % key)
+                self.connection.execute("INSERT INTO provides VALUES (?, ?, ?, ?, ?, ?)",
+                    (key['name'], 'EQ', key['epoch'], key['version'], key['release'], pkg_key))
+                continue
+            format = packages[0].find(sqlitedb._tag(sqlitedb.COMMON_NS, "format"))
+            if format is None:
+                continue
+            for dep_type in ("provides", "requires"):
+                deps = format.find(sqlitedb._tag(sqlitedb.RPM_NS, dep_type))
+                if deps is None:
+                    continue
+                rows = [(entry.get("name"), entry.get("flags"), entry.get("epoch"), entry.get("ver"),
+                         entry.get("rel"), pkg_key)
+                        for entry in deps.findall(sqlitedb._tag(sqlitedb.RPM_NS, "entry"))]
+                self.connection.executemany("INSERT INTO %s VALUES (?, ?, ?, ?, ?, ?)" % dep_type, rows)
+            # primary only lists the files yum considers commonly required
+            files = format.findall(sqlitedb._tag(sqlitedb.COMMON_NS, "file"))
+            filelists = sqlitedb.parse_snippets("filelists", repodata.get('filelists'))
+            if filelists:
+                files = filelists[0].findall(sqlitedb._tag(sqlitedb.FILELISTS_NS, "file"))
+            self.connection.executemany("INSERT INTO files VALUES (?, ?)",
+                                        [(f.text, pkg_key) for f in files if f.text])
+        return added
+
+    def remove_units(self, unit_ids):
+        """
+        @param unit_ids: ids of the units to drop from the index
+        @type  unit_ids: iterable of str
+        """
+        self._write(self._remove_units, unit_ids)
+        self._packages = {}
+
+    def _remove_units(self, unit_ids):
+        for chunk in _chunks(unit_ids):
+            markers = ",".join(["?"] * len(chunk))
+            pkg_keys = "SELECT pkgKey FROM packages WHERE unit_id IN (%s)" % markers
+            for table in ("provides", "requires", "files"):
+                self.connection.execute("DELETE FROM %s WHERE pkgKey IN (%s)" % (table, pkg_keys), chunk)
+            self.connection.execute("DELETE FROM packages WHERE unit_id IN (%s)" % markers, chunk)
+
+    def update(self, conduit, limit=500):
+        """
+        Brings the index up to date with the rpm units of the repository.
+
+        @param conduit: conduit the repository's units are looked up through
+        @type  conduit: pulp.plugins.conduits.mixins.SearchUnitsMixin
+
+        @param limit: number of units to fetch per query
+        @type  limit: int
+        """
+        start = time.time()
+        # unit id -> stored digest of its snippets; the units are paged through by
+        # unit key, each page starting after the last unit of the previous one
+        current_digests = {}
+        unit_fields = ['id', util.REPODATA_DIGEST] + list(util.RPM_SORT_FIELDS)
+        unit_sort = [(field, 1) for field in util.RPM_SORT_FIELDS]
+        unit_filters = None
+        while True:
+            criteria = UnitAssociationCriteria(type_ids=[TYPE_ID_RPM], unit_fields=unit_fields,
+                unit_filters=unit_filters, unit_sort=unit_sort, limit=limit)
+            units = conduit.get_units(criteria)
+            for u in units:
+                current_digests[u.id] = u.metadata.get(util.REPODATA_DIGEST)
+            if len(units) < limit:
+                break
+            unit_filters = util.form_seek_filter(units[-1].unit_key)
+        # the indexed digests are read and reconciled under one lock, so a concurrent
+        # update cannot add or remove the same units in between
+        added, removed = self._write(self._reconcile, current_digests, conduit, limit)
+        end = time.time()
+        _LOG.info("Dependency index updated in %s seconds: %s units indexed, %s added, %s removed" % \
+                  (end - start, len(current_digests), added, removed))
+
+    def _reconcile(self, current_digests, conduit, limit):
+        indexed_digests = self.unit_digests()
+        indexed_ids = set(indexed_digests)
+        current_ids = set(current_digests)
+        # a unit whose snippets were rewritten in place is indexed again
+        changed_ids = set([unit_id for unit_id in indexed_ids & current_ids
+                           if indexed_digests[unit_id] != current_digests[unit_id]])
+        removed_ids = (indexed_ids - current_ids) | changed_ids
+        added_ids = (current_ids - indexed_ids) | changed_ids
+        if removed_ids:
+            self.remove_units(removed_ids)
+        added = 0
+        for chunk in _chunks(added_ids, limit):
+            criteria = UnitAssociationCriteria(type_ids=[TYPE_ID_RPM], unit_fields=UNIT_FIELDS,
+                unit_filters={'_id' : {'$in' : chunk}})
+            wanted = set(chunk)
+            added += self.add_units([u for u in conduit.get_units(criteria) if u.id in wanted])
+        return added, len(removed_ids)
+
+    # -- queries --------------------------------------------------------------
+
+    def _get_packages(self, pkg_keys):
+        packages = []
+        missing = [k for k in pkg_keys if k not in self._packages]
+        for chunk in _chunks(missing):
+            query = "SELECT %s FROM packages WHERE pkgKey IN (%s)" % (PACKAGE_FIELDS, ",".join(["?"] * len(chunk)))
+            for row in self.connection.execute(query, chunk):
+                self._packages[row[0]] = IndexedPackage(*row)
+        for k in pkg_keys:
+            if k in self._packages:
+                packages.append(self._packages[k])
+        return packages
+
+    def match_packages(self, patterns):
+        """
+        Looks up packages by any of the formats: name, name.arch, name-ver-rel.arch,
+        name-ver, name-ver-rel, epoch:name-ver-rel.arch, name-epoch:ver-rel.arch
+
+        @param patterns: package names
+        @type  patterns: [str]
+
+        @return matching packages
+        @rtype [IndexedPackage]
+        """
+        # a package name is a pattern up to one of its '-' or '.', after any leading epoch
+        candidate_names = set()
+        for pattern in patterns:
+            if ':' in pattern and pattern.split(':', 1)[0].isdigit():
+                pattern = pattern.split(':', 1)[1]
+            candidate_names.add(pattern)
+            for index, c in enumerate(pattern):
+                if c in '-.':
+                    candidate_names.add(pattern[:index])
+        wanted = set(patterns)
+        pkg_keys = []
+        for chunk in _chunks(candidate_names):
+            query = "SELECT pkgKey FROM packages WHERE name IN (%s) ORDER BY pkgKey" % ",".join(["?"] * len(chunk))
+            pkg_keys.extend([row[0] for row in self.connection.execute(query, chunk)])
+        return [p for p in self._get_packages(pkg_keys) if p.match_names() & wanted]
+
+    def requires(self, package):
+        """
+        @param package: indexed package
+        @type  package: IndexedPackage
+
+        @return requirements of the package as yum (name, flags, (epoch, version, release)) tuples
+        @rtype [()]
+        """
+        rows = self.connection.execute("SELECT name, flags, epoch, version, release FROM requires WHERE pkgKey = ?",
+                                       (package.pkg_key,))
+        return [(name, flags, (epoch, version, release)) for name, flags, epoch, version, release in rows]
+
+    def what_provides(self, name, flags, version):
+        """
+        @param name: capability or file name required
+        @type  name: str
+
+        @param flags: comparison flag of the requirement, such as EQ or GE; None when unversioned
+        @type  flags: str
+
+        @param version: (epoch, version, release) of the requirement
+        @type  version: ()
+
+        @return packages satisfying the requirement
+        @rtype [IndexedPackage]
+        """
+        if FILENAME_MATCH(name):
+            operator = "="
+            if GLOB_CHARACTERS.search(name):
+                operator = "GLOB"
+            query = "SELECT pkgKey FROM files WHERE name %s ? UNION SELECT pkgKey FROM provides WHERE name %s ?" % \
+                    (operator, operator)
+            pkg_keys = sorted([row[0] for row in self.connection.execute(query, (name, name))])
+            return self._get_packages(pkg_keys)
+        pkg_keys = []
+        rows = self.connection.execute(
+            "SELECT pkgKey, flags, epoch, version, release FROM provides WHERE name = ? ORDER BY pkgKey", (name,))
+        for pkg_key, p_flags, p_epoch, p_version, p_release in rows:
+            if pkg_key in pkg_keys:
+                continue
+            if rangeCompare((name, flags, version), (name, p_flags, (p_epoch, p_version, p_release))):
+                pkg_keys.append(pkg_key)
+        return self._get_packages(pkg_keys)
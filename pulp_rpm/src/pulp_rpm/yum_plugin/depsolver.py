@@ -15,6 +15,8 @@
 
 import re
 import shutil
+from collections import deque
+
 import yum
 from yum.misc import prco_tuple_to_string
 from yum.packageSack import ListPackageSack
@@ -24,10 +26,28 @@ from yum.repos import RepoStorage
 import util
 log = util.getLogger(__name__)
 
+regex_filename_match = re.compile('[/*?]|\[[^]]*/[^]]*\]').match
+
 class DepSolver:
-    def __init__(self, repos, pkgs=None):
+    def __init__(self, repos, pkgs=None, index=None):
+        """
+        @param repos: repositories to solve dependencies in
+        @type  repos: [pulp.plugins.model.Repository]
+
+        @param pkgs: names of the packages to solve dependencies for
+        @type  pkgs: [str]
+
+        @param index: dependency index to answer queries from; when not given the
+                      published metadata of the repos is loaded into a yum package sack
+        @type  index: pulp_rpm.yum_plugin.depindex.DependencyIndex
+        """
         self.pkgs = pkgs or []
         self.repos = repos
+        self.index = index
+        # requirement -> packages satisfying it
+        self._satisfiers = {}
+        if self.index is not None:
+            return
         self._repostore = RepoStorage(self)
         self.setup()
         self.loadPackages()
@@ -54,6 +74,9 @@ class DepSolver:
         """
          clean up the repo metadata cache from /var/lib/pulp/working/<repoid>/cache/
         """
+        if self.index is not None:
+            self.index.close()
+            return
         for repo in self.repos:
             cachedir = "%s/cache" % str(repo.working_dir)
             shutil.rmtree(cachedir)
@@ -66,14 +89,9 @@ class DepSolver:
          name, name.arch, name-ver-rel.arch, name-ver, name-ver-rel,
          epoch:name-ver-rel.arch, name-epoch:ver-rel.arch
         """
-        ematch, match, unmatch = parsePackages(self._repostore.pkgSack, self.pkgs)
-        pkgs = []
-        for po in ematch + match:
-            pkgs.append(po)
-        results = self.__locateDeps(pkgs)
-        return results
+        return self.__locateDeps(self.__matchPackages(self.pkgs))
 
-    def getRecursiveDepList(self):
+    def getRecursiveDepList(self, pkgs=None):
         """
          Get dependency list and suggested packages for package names provided.
          The dependency lookup is recursive. All available packages in the repo
@@ -81,51 +99,87 @@ class DepSolver:
          The package name format could be any of the following:
          name, name.arch, name-ver-rel.arch, name-ver, name-ver-rel,
          epoch:name-ver-rel.arch, name-epoch:ver-rel.arch
-         returns a dictionary of {'n-v-r.a' : [n,v,e,r,a],...}
+
+         The closure of all the packages is computed in one traversal: every
+         package is expanded once and every requirement is looked up once, the
+         providers found are memoized for the life of the solver.
+
+         @param pkgs: package names to compute the closure of; defaults to the
+                      packages the solver was created with
+         @type  pkgs: [str]
+
+         returns a dictionary of {package : {requirement : [providers]}}, the
+         same structure getDependencylist returns
         """
-        solved = []
-        to_solve = self.pkgs
+        if pkgs is None:
+            pkgs = self.pkgs
         all_results = {}
-        while to_solve:
-            log.debug("Solving %s \n\n" % to_solve)
-            results = self.getDependencylist()
+        visited = set()
+        queue = deque(self.__matchPackages(pkgs))
+        while queue:
+            pkg = queue.popleft()
+            pkg_id = self.__packageId(pkg)
+            if pkg_id in visited:
+                continue
+            visited.add(pkg_id)
+            results = self.__locateDeps([pkg])
             all_results.update(results)
-            found = self.processResults(results)[0]
-            solved += to_solve
-            to_solve = []
-            for dep, pkgs in found.items():
-                for pkg in pkgs:
-                    name, version, epoch, release, arch, checksumtype, checksum = pkg
-                    ndep = "%s-%s-%s.%s" % (name, version, release, arch)
-                    solved = list(set(solved))
-                    if ndep not in solved:
-                        to_solve.append(ndep)
-            self.pkgs = to_solve
-#        log.debug("difference:: %s \n\n" % list(set(to_solve) - set(solved)))
+            for satisfiers in results[pkg].values():
+                for po in satisfiers:
+                    if self.__packageId(po) not in visited:
+                        queue.append(po)
+        log.debug("Solved the closure of %s packages: %s packages" % (len(pkgs), len(visited)))
         return all_results
 
+    def __packageId(self, po):
+        return (po.name, po.epoch, po.version, po.release, po.arch)
+
+    def __matchPackages(self, names):
+        if self.index is not None:
+            return self.index.match_packages(names)
+        ematch, match, unmatch = parsePackages(self._repostore.pkgSack, names)
+        return ematch + match
+
+    def __requires(self, pkg):
+        if self.index is not None:
+            reqs = self.index.requires(pkg)
+        else:
+            reqs = list(pkg.requires)
+        reqs.sort()
+        return reqs
+
     def __locateDeps(self, pkgs):
         results = {}
-        regex_filename_match = re.compile('[/*?]|\[[^]]*/[^]]*\]').match
         for pkg in pkgs:
             results[pkg] = {}
-            reqs = pkg.requires
-            reqs.sort()
             pkgresults = results[pkg]
-            for req in reqs:
+            for req in self.__requires(pkg):
                 (r, f, v) = req
                 if r.startswith('rpmlib('):
                     continue
-                satisfiers = []
-                for po in self.__whatProvides(r, f, v):
-                    # verify this po indeed provides the dep,
-                    # el5 version could give some false positives
-                    if regex_filename_match(r) or \
-                       po.checkPrco('provides', (r, f, v)):
-                        satisfiers.append(po)
-                pkgresults[req] = satisfiers
+                pkgresults[req] = self.__satisfiers(req)
         return results
 
+    def __satisfiers(self, req):
+        """
+         Packages satisfying a requirement; looked up once per requirement
+        """
+        if req in self._satisfiers:
+            return self._satisfiers[req]
+        (r, f, v) = req
+        if self.index is not None:
+            satisfiers = self.index.what_provides(r, f, v)
+        else:
+            satisfiers = []
+            for po in self.__whatProvides(r, f, v):
+                # verify this po indeed provides the dep,
+                # el5 version could give some false positives
+                if regex_filename_match(r) or \
+                   po.checkPrco('provides', (r, f, v)):
+                    satisfiers.append(po)
+        self._satisfiers[req] = satisfiers
+        return satisfiers
+
     def __whatProvides(self, name, flags, version):
         try:
             return ListPackageSack(self._repostore.pkgSack.searchProvides((name, flags, version)))
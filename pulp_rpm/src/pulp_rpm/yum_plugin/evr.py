@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2013 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+
+"""
+Epoch, version and release comparison following rpm's rpmvercmp.
+
+A version or release string is tokenized once into a sort key, and the keys compare
+the same way rpmvercmp compares the strings. Keys are cached per string, so comparing
+many packages against each other only parses each distinct string once, and lists
+of packages can be sorted or searched for the newest with the builtin sort and max.
+"""
+import re
+
+# Token ordering, lowest first. A '~' sorts before the end of the string, a '^' sorts
+# after the end of the string but before any further segment, and numeric segments
+# are newer than alphabetic ones.
+_TILDE = (0,)
+_END = (1,)
+_CARET = (2,)
+_ALPHA = 3
+_NUMERIC = 4
+
+# Characters other than ASCII letters, digits, '~' and '^' only separate segments
+_TOKEN_RE = re.compile(r"[0-9]+|[a-zA-Z]+|~|\^")
+
+# Keys are cached per string; the cache is dropped once it holds this many strings
+MAX_CACHED_KEYS = 100000
+_key_cache = {}
+
+
+def _tokenize(value):
+    """
+    @param value version or release string
+    @type value str
+
+    @return sort key for the string
+    @rtype tuple
+    """
+    tokens = []
+    for token in _TOKEN_RE.findall(value):
+        if token == "~":
+            tokens.append(_TILDE)
+        elif token == "^":
+            tokens.append(_CARET)
+        elif token.isdigit():
+            tokens.append((_NUMERIC, int(token)))
+        else:
+            tokens.append((_ALPHA, token))
+    tokens.append(_END)
+    return tuple(tokens)
+
+
+def vercmp_key(value):
+    """
+    @param value version or release string
+    @type value str
+
+    @return sort key for the string; two keys compare the way rpmvercmp compares the strings
+    @rtype tuple
+    """
+    try:
+        return _key_cache[value]
+    except KeyError:
+        pass
+    key = _tokenize(value)
+    if len(_key_cache) >= MAX_CACHED_KEYS:
+        _key_cache.clear()
+    _key_cache[value] = key
+    return key
+
+
+def rpmvercmp(a, b):
+    """
+    @param a version or release string
+    @type a str
+
+    @param b version or release string
+    @type b str
+
+    @return 1 if a is newer than b, 0 if they are equal, -1 if b is newer
+    @rtype int
+    """
+    return cmp(vercmp_key(a), vercmp_key(b))
+
+
+def evr_key(epoch, version, release):
+    """
+    A None epoch is treated as 0 and the other values are compared as strings, the
+    same as rpmUtils.miscutils.compareEVR.
+
+    @param epoch rpm epoch
+    @type epoch str
+
+    @param version rpm version
+    @type version str
+
+    @param release rpm release
+    @type release str
+
+    @return sort key for the epoch, version and release
+    @rtype tuple
+    """
+    if epoch is None:
+        epoch = "0"
+    return (vercmp_key(str(epoch)), vercmp_key(str(version)), vercmp_key(str(release)))
+
+
+def rpm_evr_key(rpm):
+    """
+    @param rpm represents rpm metadata
+    @type rpm dict with keywords: epoch, version, release
+
+    @return sort key for the epoch, version and release of the rpm, see evr_key
+    @rtype tuple
+    """
+    return evr_key(rpm["epoch"], rpm["version"], rpm["release"])
+
+
+def compare_evr(a, b):
+    """
+    Drop-in replacement for rpmUtils.miscutils.compareEVR
+
+    @param a epoch, version and release
+    @type a (str, str, str)
+
+    @param b epoch, version and release
+    @type b (str, str, str)
+
+    @return 1 if a is newer than b, 0 if they are equal, -1 if b is newer
+    @rtype int
+    """
+    return cmp(evr_key(*a), evr_key(*b))
+
+
+def sort_rpms(rpms, key=None, reverse=False):
+    """
+    @param rpms rpms to sort
+    @type rpms list
+
+    @param key returns the rpm metadata of an item, such as the unit key of a unit;
+               defaults to treating the items as rpm metadata
+    @type key callable
+
+    @param reverse sort the newest rpms first
+    @type reverse bool
+
+    @return the rpms ordered oldest to newest by epoch, version and release
+    @rtype list
+    """
+    if key is None:
+        return sorted(rpms, key=rpm_evr_key, reverse=reverse)
+    return sorted(rpms, key=lambda item: rpm_evr_key(key(item)), reverse=reverse)
+
+
+def newest_rpms(rpms, key=None):
+    """
+    @param rpms rpms to search
+    @type rpms iterable
+
+    @param key returns the rpm metadata of an item, such as the unit key of a unit;
+               defaults to treating the items as rpm metadata
+    @type key callable
+
+    @return the newest item for each name and arch; of rpms with the same
+            epoch, version and release the first one is kept
+    @rtype {(str, str): object}
+    """
+    newest = {}
+    newest_keys = {}
+    for item in rpms:
+        rpm = item if key is None else key(item)
+        name_arch = (rpm["name"], rpm["arch"])
+        item_key = rpm_evr_key(rpm)
+        if name_arch not in newest or item_key > newest_keys[name_arch]:
+            newest[name_arch] = item
+            newest_keys[name_arch] = item_key
+    return newest
@@ -11,21 +11,24 @@
 # have received a copy of GPLv2 along with this software; if not, see
 # http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
 
-import commands
 import gzip
+import json
 import os
+import Queue
 import shlex
 import shutil
 import subprocess
 import threading
 import signal
 import time
+import zlib
+from cStringIO import StringIO
 
 import rpmUtils
 from createrepo import MetaDataGenerator, MetaDataConfig
 from createrepo import yumbased, GzipFile
 
-from pulp_rpm.yum_plugin import util
+from pulp_rpm.yum_plugin import repomd, sqlitedb, util
 from pulp.common.util import encode_unicode, decode_unicode
 import yum
 from pulp.server.db.model.criteria import UnitAssociationCriteria
@@ -40,6 +43,28 @@ CREATE_REPO_PROCESS_LOOKUP = {}
 CREATE_REPO_PROCESS_LOOKUP_LOCK = threading.Lock()
 DEFAULT_CHECKSUM = "sha256"
 
+# Package level xml files built from the per unit 'repodata' snippets
+UNIT_METADATA_FTYPES = ("primary", "filelists", "other")
+XML_HEADERS = {
+    "primary" : """<?xml version="1.0" encoding="UTF-8"?>\n <metadata xmlns="http://linux.duke.edu/metadata/common"
+xmlns:rpm="http://linux.duke.edu/metadata/rpm" packages="%s"> \n""",
+    "filelists" : """<?xml version="1.0" encoding="UTF-8"?>
+<filelists xmlns="http://linux.duke.edu/metadata/filelists" packages="%s"> \n""",
+    "other" : """<?xml version="1.0" encoding="UTF-8"?>
+<otherdata xmlns="http://linux.duke.edu/metadata/other" packages="%s"> \n""",
+}
+XML_FOOTERS = {
+    "primary" : """\n </metadata>""",
+    "filelists" : """\n </filelists>""",
+    "other" : """\n </otherdata>""",
+}
+# Incremental publish keeps the compressed snippets of the last publish in a directory next to the
+# repo dir, named after it with this suffix; the repo dir itself is published over http/https
+UNIT_METADATA_CACHE_DIR_SUFFIX = ".repodata_units"
+UNIT_METADATA_CACHE_VERSION = 3
+# Number of pending snippet batches a package xml writer thread will buffer
+XML_WRITER_QUEUE_SIZE = 8
+
 class CreateRepoError(Exception):
     pass
 
@@ -165,26 +190,31 @@ def __get_groups_xml_info(repo_dir):
     return groups_xml_path
 
 
-def modify_repo(repodata_dir, new_file, remove=False):
+def modify_repo(repodata_dir, new_file, remove=False, checksum_type="sha256"):
     """
-     run modifyrepo to add a new file to repodata directory
+     add a new file to, or remove a file type from, the repodata directory; works like modifyrepo
 
      @param repodata_dir: repodata directory path
      @type repodata_dir: string
 
-     @param new_file: new file type to add or remove
+     @param new_file: new file to add, or file type to remove
      @type new_file: string
+
+     @param checksum_type: checksum type of the new repomd entry
+     @type checksum_type: string
     """
-    if remove:
-        cmd = "modifyrepo --remove %s %s" % (new_file, repodata_dir)
-    else:
-        cmd = "modifyrepo %s %s" % (new_file, repodata_dir)
-    status, out = commands.getstatusoutput(cmd)
-    if status != 0:
-        _LOG.error("modifyrepo on %s failed" % repodata_dir)
-        raise ModifyRepoError(out)
-    _LOG.info("modifyrepo with %s on %s finished" % (new_file, repodata_dir))
-    return status, out
+    editor = repomd.RepomdEditor(repodata_dir, checksum_type=checksum_type)
+    try:
+        if remove:
+            editor.remove(repomd.get_mdtype(new_file))
+        else:
+            editor.add(new_file)
+        editor.save()
+    except Exception, e:
+        _LOG.error("modifying repodata on %s failed" % repodata_dir)
+        raise ModifyRepoError(str(e))
+    _LOG.info("modify repodata with %s on %s finished" % (new_file, repodata_dir))
+    return 0, ""
 
 
 def _create_repo(dir, groups=None, checksum_type="sha256"):
@@ -268,6 +298,7 @@ def create_repo(dir, groups=None, checksum_type="sha256", skip_metadata_types=[]
         repodata_file = os.path.join(backup_repo_dir, "repomd.xml")
         ftypes = util.get_repomd_filetypes(repodata_file)
         base_ftypes = ['primary', 'primary_db', 'filelists_db', 'filelists', 'other', 'other_db', 'group', 'group_gz']
+        repomd_editor = repomd.RepomdEditor(current_repo_dir, checksum_type=checksum_type)
         for ftype in ftypes:
             if ftype in base_ftypes:
                 # no need to process these again
@@ -280,14 +311,14 @@ def create_repo(dir, groups=None, checksum_type="sha256", skip_metadata_types=[]
             renamed_filetype_path = os.path.join(os.path.dirname(filetype_path), \
                                          ftype + '.' + '.'.join(os.path.basename(filetype_path).split('.')[1:]))
             os.rename(filetype_path,  renamed_filetype_path)
-            if renamed_filetype_path.endswith('.gz'):
-                # if file is gzipped, decompress before passing to modifyrepo
-                data = gzip.open(renamed_filetype_path).read().decode("utf-8", "replace")
-                renamed_filetype_path = '.'.join(renamed_filetype_path.split('.')[:-1])
-                open(renamed_filetype_path, 'w').write(data.encode("UTF-8"))
             if os.path.isfile(renamed_filetype_path):
                 _LOG.info("Modifying repo for %s metadata" % ftype)
-                modify_repo(current_repo_dir, renamed_filetype_path)
+                repomd_editor.add(renamed_filetype_path)
+        # compress the collected files and update repomd.xml before the backup is removed
+        try:
+            repomd_editor.save()
+        except repomd.RepomdError, e:
+            raise ModifyRepoError(str(e))
     finally:
         if backup_repo_dir:
             shutil.rmtree(backup_repo_dir)
@@ -402,6 +433,392 @@ def change_location_tag(primary_xml_snippet, relpath):
 
 
 
+def gzip_member(data, compresslevel=9):
+    """
+    Compresses data into a single, self contained gzip member. Members can be
+    concatenated and still read back as one gzip stream.
+
+    @param data: bytes to compress
+    @type data: str
+
+    @param compresslevel: gzip compression level
+    @type compresslevel: int
+
+    @return compressed gzip member
+    @rtype str
+    """
+    buf = StringIO()
+    f = gzip.GzipFile(filename="", mode="wb", compresslevel=compresslevel, fileobj=buf, mtime=0)
+    try:
+        f.write(data)
+    finally:
+        f.close()
+    return buf.getvalue()
+
+
+class PackageXmlWriter(object):
+    """
+    Writes one of the gzipped package level xml files on its own thread, so the
+    primary, filelists and other files are compressed concurrently.
+
+    When the package count is known up front the header is written first. Otherwise
+    the body is compressed to a temporary file and, once the count is known, copied
+    as is behind a separately compressed header member; gzip readers treat the
+    concatenated members as a single stream, so nothing is compressed twice.
+    """
+    def __init__(self, ftype, xml_path, temp_xml_path, compresslevel=9):
+        """
+        @param ftype: one of UNIT_METADATA_FTYPES
+        @type  ftype: str
+
+        @param xml_path: path of the xml.gz file to write
+        @type  xml_path: str
+
+        @param temp_xml_path: path the body is written to when the package count is not known up front
+        @type  temp_xml_path: str
+
+        @param compresslevel: gzip compression level
+        @type  compresslevel: int
+        """
+        self.ftype = ftype
+        self.xml_path = xml_path
+        self.temp_xml_path = temp_xml_path
+        self.compresslevel = compresslevel
+        self.unit_count = None
+        self.error = None
+        self._queue = Queue.Queue(maxsize=XML_WRITER_QUEUE_SIZE)
+        self._thread = None
+        self._file = None
+        self._gzip_file = None
+
+    def open(self, unit_count=None):
+        """
+        @param unit_count: number of packages the file will hold, if known
+        @type  unit_count: int
+        """
+        self.unit_count = unit_count
+        if unit_count is None:
+            self._file = open(self.temp_xml_path, "wb")
+        else:
+            self._file = open(self.xml_path, "wb")
+            self._file.write(gzip_member(XML_HEADERS[self.ftype] % unit_count, self.compresslevel))
+        self._gzip_file = GzipFile(filename="", mode="wb", compresslevel=self.compresslevel, fileobj=self._file)
+        self._thread = threading.Thread(target=self._run, name="%s-xml-writer" % self.ftype)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def write(self, data):
+        """
+        Queues data to be compressed; blocks while the writer is XML_WRITER_QUEUE_SIZE batches behind
+
+        @param data: utf-8 encoded xml
+        @type  data: str
+        """
+        if self.error is not None:
+            raise self.error
+        self._queue.put(data)
+
+    def close(self, unit_count):
+        """
+        Writes the footer, waits for all queued data to be compressed and, if the body
+        was written to the temporary file, writes the final file with its header.
+
+        @param unit_count: number of packages written
+        @type  unit_count: int
+        """
+        self._queue.put(XML_FOOTERS[self.ftype])
+        self._queue.put(None)
+        self._thread.join()
+        if self.error is not None:
+            raise self.error
+        if self.unit_count is not None:
+            return
+        out_f = open(self.xml_path, "wb")
+        try:
+            out_f.write(gzip_member(XML_HEADERS[self.ftype] % unit_count, self.compresslevel))
+            in_f = open(self.temp_xml_path, "rb")
+            try:
+                shutil.copyfileobj(in_f, out_f, 1024*1024)
+            finally:
+                in_f.close()
+        finally:
+            out_f.close()
+        os.unlink(self.temp_xml_path)
+
+    def abort(self):
+        """
+        Stops the writer thread without finishing the file
+        """
+        if self._thread is not None and self._thread.isAlive():
+            self._queue.put(None)
+            self._thread.join()
+
+    def _run(self):
+        try:
+            try:
+                while True:
+                    data = self._queue.get()
+                    if data is None:
+                        break
+                    self._gzip_file.write(data)
+            except Exception, e:
+                _LOG.exception("Error occurred writing %s xml" % self.ftype)
+                self.error = e
+                # keep draining so write and close never block on a dead writer
+                while self._queue.get() is not None:
+                    pass
+        finally:
+            try:
+                self._gzip_file.close()
+            finally:
+                self._file.close()
+
+
+def get_unit_metadata_cache_dir(repodir):
+    """
+    @param repodir: repository dir where the repodata directory is created/exists
+    @type  repodir: str
+
+    @return directory of the unit metadata cache of the repo; it is outside of repodir
+            so the cache is not published with the repo
+    @rtype str
+    """
+    return os.path.normpath(repodir) + UNIT_METADATA_CACHE_DIR_SUFFIX
+
+
+class UnitMetadataCache(object):
+    """
+    Keeps the compressed per unit primary, filelists and other snippets of the
+    last publish so the next publish only has to compress the units that were
+    added or whose snippets changed. Each ftype has a members file holding one
+    gzip member per unit; the index maps every unit id to the repodata digest
+    stored on the unit (see util.get_repodata_digest) and to the offset and
+    length of its members, in the order they are written to the xml files.
+
+    Members and index are written under a new generation on each update; the
+    index is renamed into place last, so an interrupted update leaves the
+    previous generation intact.
+    """
+    def __init__(self, cache_dir, checksum_type):
+        """
+        @param cache_dir: directory the cache is kept in, see get_unit_metadata_cache_dir
+        @type  cache_dir: str
+
+        @param checksum_type: checksum type used in the cached snippets
+        @type  checksum_type: str
+        """
+        self.cache_dir = cache_dir
+        self.index_path = os.path.join(self.cache_dir, "index.json")
+        self.checksum_type = checksum_type
+        self.generation = 0
+        # [(unit_id, snippet digest, {ftype: (offset, length)})]
+        self.entries = []
+
+    def members_path(self, ftype, generation=None):
+        if generation is None:
+            generation = self.generation
+        return os.path.join(self.cache_dir, "%s.%s.members" % (ftype, generation))
+
+    def load(self):
+        """
+        Reads the index of the last publish. An index from another version, for another
+        checksum type or with missing members files is ignored.
+
+        @return True if a usable index was loaded
+        @rtype bool
+        """
+        self.generation = 0
+        self.entries = []
+        if not os.path.isfile(self.index_path):
+            return False
+        try:
+            f = open(self.index_path, "r")
+            try:
+                index = json.load(f)
+            finally:
+                f.close()
+        except Exception, e:
+            _LOG.warn("Unable to read unit metadata cache index %s: %s" % (self.index_path, e))
+            return False
+        if index.get("version") != UNIT_METADATA_CACHE_VERSION or index.get("checksum_type") != self.checksum_type:
+            _LOG.info("Unit metadata cache at %s is stale; ignoring it" % self.cache_dir)
+            return False
+        generation = index["generation"]
+        for ftype in UNIT_METADATA_FTYPES:
+            path = self.members_path(ftype, generation)
+            if not os.path.isfile(path) or os.path.getsize(path) != index["sizes"][ftype]:
+                _LOG.info("Unit metadata cache members %s missing or truncated; ignoring cache" % path)
+                return False
+        self.generation = generation
+        self.entries = [(unit_id, digest, dict([(ftype, tuple(r)) for ftype, r in ranges.items()]))
+                        for unit_id, digest, ranges in index["units"]]
+        return True
+
+    def unit_digests(self):
+        """
+        @return repodata digest of each unit in the cache, keyed by unit id
+        @rtype {str:str}
+        """
+        return dict([(unit_id, digest) for unit_id, digest, ranges in self.entries])
+
+    @property
+    def unit_count(self):
+        return len(self.entries)
+
+    def update(self, new_units, removed_unit_ids, is_cancelled=None):
+        """
+        Writes a new generation holding the cached members minus removed_unit_ids, which
+        are copied without recompressing, followed by members compressed from new_units.
+
+        @param new_units: iterable of rpm units, with 'repodata' metadata, to add
+        @type  new_units: iterable of AssociatedUnit
+
+        @param removed_unit_ids: ids of units to drop from the cache
+        @type  removed_unit_ids: set
+
+        @param is_cancelled: callable returning True once the publish has been cancelled
+        @type  is_cancelled: function
+        """
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        generation = self.generation + 1
+        out_files = dict([(ftype, open(self.members_path(ftype, generation), "wb"))
+                          for ftype in UNIT_METADATA_FTYPES])
+        entries = []
+        try:
+            retained = [e for e in self.entries if e[0] not in removed_unit_ids]
+            for ftype in UNIT_METADATA_FTYPES:
+                self._copy_members(ftype, [ranges[ftype] for unit_id, digest, ranges in retained],
+                                   out_files[ftype])
+            offsets = dict([(ftype, 0) for ftype in UNIT_METADATA_FTYPES])
+            for unit_id, digest, ranges in retained:
+                new_ranges = {}
+                for ftype in UNIT_METADATA_FTYPES:
+                    new_ranges[ftype] = (offsets[ftype], ranges[ftype][1])
+                    offsets[ftype] += ranges[ftype][1]
+                entries.append((unit_id, digest, new_ranges))
+            for unit in new_units:
+                if is_cancelled and is_cancelled():
+                    _LOG.warn("cancelling merge unit metadata")
+                    raise CancelException()
+                if not unit.metadata.has_key('repodata'):
+                    _LOG.debug("No repodata found for the unit; continue")
+                    continue
+                try:
+                    members = dict([(ftype, gzip_member(unit.metadata['repodata'][ftype].encode('utf-8')))
+                                    for ftype in UNIT_METADATA_FTYPES])
+                    digest = unit.metadata.get(util.REPODATA_DIGEST) or \
+                        util.get_repodata_digest(unit.metadata['repodata'])
+                except Exception, e:
+                    _LOG.error("Error occurred compressing metadata of unit %s; Exception: %s" % (unit.id, e))
+                    continue
+                new_ranges = {}
+                for ftype in UNIT_METADATA_FTYPES:
+                    out_files[ftype].write(members[ftype])
+                    new_ranges[ftype] = (offsets[ftype], len(members[ftype]))
+                    offsets[ftype] += len(members[ftype])
+                entries.append((unit.id, digest, new_ranges))
+        except:
+            for ftype, f in out_files.items():
+                f.close()
+                os.unlink(self.members_path(ftype, generation))
+            raise
+        for f in out_files.values():
+            f.close()
+        index = {"version" : UNIT_METADATA_CACHE_VERSION, "checksum_type" : self.checksum_type,
+                 "generation" : generation, "sizes" : offsets, "units" : entries}
+        temp_index_path = self.index_path + ".tmp"
+        f = open(temp_index_path, "w")
+        try:
+            json.dump(index, f)
+        finally:
+            f.close()
+        os.rename(temp_index_path, self.index_path)
+        for ftype in UNIT_METADATA_FTYPES:
+            old_path = self.members_path(ftype)
+            if os.path.exists(old_path):
+                os.unlink(old_path)
+        self.generation = generation
+        self.entries = entries
+
+    def _copy_members(self, ftype, ranges, out_f):
+        """
+        Copies the given byte ranges of the current members file to out_f,
+        coalescing adjacent ranges into a single read.
+        """
+        if not ranges:
+            return
+        in_f = open(self.members_path(ftype), "rb")
+        try:
+            start, length = ranges[0]
+            for offset, size in ranges[1:]:
+                if offset == start + length:
+                    length += size
+                    continue
+                self._copy_range(in_f, start, length, out_f)
+                start, length = offset, size
+            self._copy_range(in_f, start, length, out_f)
+        finally:
+            in_f.close()
+
+    def _copy_range(self, in_f, start, length, out_f):
+        in_f.seek(start)
+        while length > 0:
+            data = in_f.read(min(length, 1024*1024))
+            if not data:
+                raise GenerateYumMetadataException("Unit metadata cache %s is truncated" % in_f.name)
+            out_f.write(data)
+            length -= len(data)
+
+    def iter_snippets(self, batch_size):
+        """
+        Reads the cached members back, in the order they are written to the xml files.
+
+        @param batch_size: number of units per batch
+        @type  batch_size: int
+
+        @return generator of the concatenated primary, filelists and other snippets
+                of each batch of units
+        @rtype generator of (str, str, str)
+        """
+        in_files = dict([(ftype, open(self.members_path(ftype), "rb")) for ftype in UNIT_METADATA_FTYPES])
+        try:
+            for index in range(0, len(self.entries), batch_size):
+                snippets = dict([(ftype, []) for ftype in UNIT_METADATA_FTYPES])
+                for unit_id, digest, ranges in self.entries[index:index + batch_size]:
+                    for ftype in UNIT_METADATA_FTYPES:
+                        offset, length = ranges[ftype]
+                        in_files[ftype].seek(offset)
+                        # each member is a complete gzip stream
+                        snippets[ftype].append(zlib.decompress(in_files[ftype].read(length), 16 + zlib.MAX_WBITS))
+                yield tuple(["".join(snippets[ftype]) for ftype in UNIT_METADATA_FTYPES])
+        finally:
+            for f in in_files.values():
+                f.close()
+
+    def write_xml(self, ftype, output_path):
+        """
+        Writes the gzipped xml for ftype: a header member, the cached unit members and a footer member.
+
+        @param ftype: one of UNIT_METADATA_FTYPES
+        @type  ftype: str
+
+        @param output_path: path of the xml.gz file to write
+        @type  output_path: str
+        """
+        out_f = open(output_path, "wb")
+        try:
+            out_f.write(gzip_member(XML_HEADERS[ftype] % self.unit_count))
+            in_f = open(self.members_path(ftype), "rb")
+            try:
+                shutil.copyfileobj(in_f, out_f, 1024*1024)
+            finally:
+                in_f.close()
+            out_f.write(gzip_member(XML_FOOTERS[ftype]))
+        finally:
+            out_f.close()
+
+
 class YumMetadataGenerator(object):
     """
     Yum metadata generator using per package snippet approach
@@ -442,10 +859,6 @@ class YumMetadataGenerator(object):
         self.setup_temp_working_dir()
         self.metadata_conf = self.setup_metadata_conf()
 
-        self.primary_xml = None
-        self.filelists_xml = None
-        self.other_xml = None
-
         self.temp_primary_xml_path = os.path.join(self.temp_working_dir, "temp_primary.xml.gz")
         self.temp_filelists_xml_path = os.path.join(self.temp_working_dir, "temp_filelists.xml.gz")
         self.temp_other_xml_path =  os.path.join(self.temp_working_dir, "temp_other.xml.gz")
@@ -454,6 +867,15 @@ class YumMetadataGenerator(object):
         self.filelists_xml_path = os.path.join(self.temp_working_dir, "filelists.xml.gz")
         self.other_xml_path =  os.path.join(self.temp_working_dir, "other.xml.gz")
 
+        self.primary_xml = PackageXmlWriter("primary", self.primary_xml_path, self.temp_primary_xml_path)
+        self.filelists_xml = PackageXmlWriter("filelists", self.filelists_xml_path, self.temp_filelists_xml_path)
+        self.other_xml = PackageXmlWriter("other", self.other_xml_path, self.temp_other_xml_path)
+        # sqlite databases filled from the same snippets; None leaves them to createrepo
+        self.package_databases = None
+        # collects the extra metadata files merged into repomd.xml by save_repomd
+        self.repomd_editor = repomd.RepomdEditor(os.path.join(self.repodir, "repodata"),
+                                                 checksum_type=self.checksum_type)
+
 
     def setup_temp_working_dir(self):
         """
@@ -497,89 +919,39 @@ class YumMetadataGenerator(object):
         conf.sumtype = self.checksum_type
         return conf
 
-    def init_xml(self):
-        self.primary_xml= GzipFile(self.temp_primary_xml_path, 'w', compresslevel=9)
-        self.filelists_xml= GzipFile(self.temp_filelists_xml_path, 'w', compresslevel=9)
-        self.other_xml= GzipFile(self.temp_other_xml_path, 'w', compresslevel=9)
-
-    def prepend_text(self, input_path, output_path, text, gzip=True):
+    def init_xml(self, unit_count=None):
         """
-        @param input_path: path to input file we want to prepend 'text' to
-        @type input_path: str
-
-        @param output_path: output path that will be 'text' plus contents of file referred to with 'input_path'
-        @type output_path: str
-
-        @param text: text blob to prepend to file
-        @type text: str
+        Starts the primary, filelists and other xml writers
 
-        @param gzip: True will gzip file contents
-        @type gzip: bool
-        @return:
+        @param unit_count: number of units that will be merged, if known; lets the
+                           writers put the xml headers in place before any snippet
+        @type  unit_count: int
         """
-        if gzip:
-            in_f = GzipFile(input_path, 'r', compresslevel=9)
-            out_f = GzipFile(output_path, 'w', compresslevel=9)
-        else:
-            in_f = open(input_path, 'w')
-            out_f = open(output_path, 'w')
-
+        for xml_writer in (self.primary_xml, self.filelists_xml, self.other_xml):
+            xml_writer.open(unit_count)
         try:
-            out_f.write(text)
-            while True:
-                data = in_f.read(size=1024*1024)
-                if not data:
-                    break
-                out_f.write(data)
-        finally:
-            in_f.close()
-            out_f.close()
-
-    def _close_primary_xml(self):
-        """
-        All the data should be written at this point; invoke this to
-        close the primary xml gzipped file
-        """
-        self.primary_xml.write("""\n </metadata>""")
-        self.primary_xml.close()
+            self.package_databases = sqlitedb.PackageDatabases(self.temp_working_dir)
+        except Exception, e:
+            _LOG.exception("Unable to create sqlite databases; leaving them to createrepo")
+            self.package_databases = None
 
-        blob = """<?xml version="1.0" encoding="UTF-8"?>\n <metadata xmlns="http://linux.duke.edu/metadata/common"
-xmlns:rpm="http://linux.duke.edu/metadata/rpm" packages="%s"> \n""" % self.unit_count
-        self.prepend_text(self.temp_primary_xml_path, self.primary_xml_path, blob)
-
-
-    def _close_filelists_xml(self):
-        """
-        All the data should be written at this point; invoke this to
-        close the filelists xml gzipped file
-        """
-        self.filelists_xml.write("""\n </filelists>""")
-        self.filelists_xml.close()
-
-        blob = """<?xml version="1.0" encoding="UTF-8"?>
-<filelists xmlns="http://linux.duke.edu/metadata/filelists" packages="%s"> \n""" % self.unit_count
-        self.prepend_text(self.temp_filelists_xml_path, self.filelists_xml_path, blob)
-
-    def _close_other_xml(self):
+    def close_xml(self):
         """
-        All the data should be written at this point; invoke this to
-        close the other xml gzipped file
+        Closes all open xml writers, waiting for pending snippets to be compressed
+        @return:
         """
-        self.other_xml.write("""\n </otherdata>""")
-        self.other_xml.close()
-
-        blob = """<?xml version="1.0" encoding="UTF-8"?>
-<otherdata xmlns="http://linux.duke.edu/metadata/other" packages="%s"> \n""" % self.unit_count
-        self.prepend_text(self.temp_other_xml_path, self.other_xml_path, blob)
+        for xml_writer in (self.primary_xml, self.filelists_xml, self.other_xml):
+            xml_writer.close(self.unit_count)
 
-    def close_xml(self):
+    def abort_xml(self):
         """
-        Closes all open xml file handles
-        @return:
+        Stops all xml writers, discarding pending snippets
         """
-        self._close_primary_xml()
-        self._close_filelists_xml()
-        self._close_other_xml()
+        for xml_writer in (self.primary_xml, self.filelists_xml, self.other_xml):
+            xml_writer.abort()
+        if self.package_databases is not None:
+            self.package_databases.abort()
+            self.package_databases = None
 
     def merge_unit_metadata(self, units):
         """
@@ -596,6 +968,8 @@ xmlns:rpm="http://linux.duke.edu/metadata/rpm" packages="%s"> \n""" % self.unit_
             _LOG.warn("cancelling merge unit metadata")
             raise CancelException()
         start = time.time()
+        # snippets are handed to the writer threads a batch at a time
+        primary, filelists, other = [], [], []
         try:
             for unit in units:
                 if self.is_cancelled:
@@ -603,20 +977,107 @@ xmlns:rpm="http://linux.duke.edu/metadata/rpm" packages="%s"> \n""" % self.unit_
                     raise CancelException()
                 if unit.metadata.has_key('repodata'):
                     try:
-                        self.primary_xml.write(unit.metadata['repodata']['primary'].encode('utf-8'))
-                        self.filelists_xml.write(unit.metadata['repodata']['filelists'].encode('utf-8'))
-                        self.other_xml.write(unit.metadata['repodata']['other'].encode('utf-8'))
+                        snippets = (unit.metadata['repodata']['primary'].encode('utf-8'),
+                                    unit.metadata['repodata']['filelists'].encode('utf-8'),
+                                    unit.metadata['repodata']['other'].encode('utf-8'))
                     except Exception, e:
                         _LOG.error("Error occurred writing metadata to file; Exception: %s" % e)
                         continue
+                    primary.append(snippets[0])
+                    filelists.append(snippets[1])
+                    other.append(snippets[2])
                 else:
                     _LOG.debug("No repodata found for the unit; continue")
                     continue
+            primary, filelists, other = "".join(primary), "".join(filelists), "".join(other)
+            self.primary_xml.write(primary)
+            self.filelists_xml.write(filelists)
+            self.other_xml.write(other)
+            if self.package_databases is not None:
+                try:
+                    self.package_databases.add_snippets(primary, filelists, other)
+                except Exception, e:
+                    _LOG.exception("Error adding units to the sqlite databases; leaving them to createrepo")
+                    self.package_databases.abort()
+                    self.package_databases = None
         finally:
             self.unit_count += len(units)
             end = time.time()
         _LOG.info("per unit metadata merge completed in %s seconds" % (end - start))
 
+    def merge_unit_metadata_incremental(self, publish_conduit, limit=500):
+        """
+        Builds the primary, filelists and other xmls and the sqlite databases from the
+        unit metadata cache of the last publish. Only the ids and repodata digests of the
+        repo's rpm and srpm units are looked up to compare them with the cache; units not
+        in the cache or whose digest changed are fetched and compressed, cached members of
+        units no longer in the repo are dropped, and the rest are reused as is. Without a
+        usable cache every unit is compressed and the cache is seeded for the next publish.
+
+        @param publish_conduit: publish conduit
+        @type publish_conduit: pulp.plugins.conduits.repo_publish.RepoPublishConduit
+
+        @param limit: number of units to fetch per query
+        @type  limit: int
+        """
+        start = time.time()
+        cache = UnitMetadataCache(get_unit_metadata_cache_dir(self.repodir), self.checksum_type)
+        cache.load()
+        cached_digests = cache.unit_digests()
+        current_ids = set()
+        changed_ids = set()
+        for type_id in [TYPE_ID_RPM, TYPE_ID_SRPM]:
+            for units in _iter_unit_pages(publish_conduit, type_id, ['id', util.REPODATA_DIGEST], limit):
+                for u in units:
+                    current_ids.add(u.id)
+                    if u.id in cached_digests and u.metadata.get(util.REPODATA_DIGEST) != cached_digests[u.id]:
+                        changed_ids.add(u.id)
+        cached_ids = set(cached_digests)
+        # a changed unit is dropped from the cache and compressed again
+        removed_ids = (cached_ids - current_ids) | changed_ids
+        added_ids = list((current_ids - cached_ids) | changed_ids)
+        _LOG.info("Incremental metadata merge: %s cached units, %s added, %s changed, %s removed" % \
+                  (len(cached_ids), len(added_ids) - len(changed_ids), len(changed_ids),
+                   len(removed_ids) - len(changed_ids)))
+
+        def new_units():
+            unit_fields = ['id', 'name', 'version', 'release', 'arch', 'epoch',
+                           '_storage_path', "checksum", "checksumtype", "repodata", util.REPODATA_DIGEST]
+            for index in range(0, len(added_ids), limit):
+                criteria = UnitAssociationCriteria(type_ids=[TYPE_ID_RPM, TYPE_ID_SRPM], unit_fields=unit_fields,
+                    unit_filters={'_id' : {'$in' : added_ids[index:index + limit]}})
+                for unit in publish_conduit.get_units(criteria):
+                    yield unit
+        cache.update(new_units(), removed_ids, is_cancelled=lambda: self.is_cancelled)
+        self.unit_count = cache.unit_count
+        cache.write_xml("primary", self.primary_xml_path)
+        cache.write_xml("filelists", self.filelists_xml_path)
+        cache.write_xml("other", self.other_xml_path)
+        self._fill_package_databases(cache, limit)
+        end = time.time()
+        _LOG.info("incremental unit metadata merge of %s units completed in %s seconds" % (self.unit_count, end - start))
+
+    def _fill_package_databases(self, cache, limit):
+        """
+        Fills the sqlite databases from the cached snippets, so createrepo does not
+        parse the xml files again; on error they are left to createrepo.
+        """
+        try:
+            self.package_databases = sqlitedb.PackageDatabases(self.temp_working_dir)
+            for primary, filelists, other in cache.iter_snippets(limit):
+                if self.is_cancelled:
+                    _LOG.warn("cancelling merge unit metadata")
+                    raise CancelException()
+                self.package_databases.add_snippets(primary, filelists, other)
+        except CancelException:
+            self.abort_xml()
+            raise
+        except Exception, e:
+            _LOG.exception("Unable to fill the sqlite databases from the unit metadata cache; leaving them to createrepo")
+            if self.package_databases is not None:
+                self.package_databases.abort()
+                self.package_databases = None
+
     def merge_custom_repodata(self):
         """
         merge any repodata preserved on the repo scratchpad
@@ -625,8 +1086,6 @@ xmlns:rpm="http://linux.duke.edu/metadata/rpm" packages="%s"> \n""" % self.unit_
         if not self.custom_metadata:
             # nothing found on scratchpad
             return False
-        current_repo_dir = os.path.join(self.repodir, "repodata")
-
         for ftype, fxml in self.custom_metadata.items():
             if ftype in self.skip:
                 continue
@@ -646,7 +1105,7 @@ xmlns:rpm="http://linux.duke.edu/metadata/rpm" packages="%s"> \n""" % self.unit_
             # merge the xml we just wrote with repodata
             if os.path.isfile(ftype_xml_path):
                 _LOG.info("Modifying repo for %s metadata" % ftype)
-                modify_repo(current_repo_dir, ftype_xml_path)
+                self.repomd_editor.add(ftype_xml_path)
         return True
 
     def merge_comps_xml(self):
@@ -657,9 +1116,8 @@ xmlns:rpm="http://linux.duke.edu/metadata/rpm" packages="%s"> \n""" % self.unit_
             # no group xml formed nothing to do
             _LOG.info("comps xml path does not exist; skipping merge")
             return
-        repodata_working_dir = os.path.join(self.repodir, "repodata")
         _LOG.info("Modifying repo for %s metadata" % "comps")
-        modify_repo(repodata_working_dir, self.group_xml_path)
+        self.repomd_editor.add(self.group_xml_path)
 
     def merge_updateinfo_xml(self):
         """
@@ -669,15 +1127,14 @@ xmlns:rpm="http://linux.duke.edu/metadata/rpm" packages="%s"> \n""" % self.unit_
             # no updateinfo xml formed, nothing to do
             _LOG.info("updateinfo xml path does not exist; skipping merge")
             return
-        repodata_working_dir = os.path.join(self.repodir, "repodata")
         _LOG.info("Modifying repo for %s metadata" % "updateinfo")
-        modify_repo(repodata_working_dir, self.updateinfo_xml_path)
+        self.repomd_editor.add(self.updateinfo_xml_path)
 
     def merge_other_filetypes_from_backup(self):
         """
         Merges any other filetypes in the backed up repodata that needs to be included
         back into the repodata. This is where the presto, updateinfo and comps xmls are
-        looked up in old repomd.xml and merged back to the new using modifyrepo.
+        looked up in old repomd.xml and merged back to the new repomd.xml.
         primary, filelists and other xmls are excluded from the process.
         """
         _LOG.info("Performing merge on other file types")
@@ -705,23 +1162,61 @@ xmlns:rpm="http://linux.duke.edu/metadata/rpm" packages="%s"> \n""" % self.unit_
                 renamed_filetype_path = os.path.join(os.path.dirname(filetype_path),\
                     ftype + '.' + '.'.join(os.path.basename(filetype_path).split('.')[1:]))
                 os.rename(filetype_path,  renamed_filetype_path)
-                if renamed_filetype_path.endswith('.gz'):
-                    # if file is gzipped, decompress before passing to modifyrepo
-                    data = gzip.open(renamed_filetype_path).read().decode("utf-8", "replace")
-                    renamed_filetype_path = '.'.join(renamed_filetype_path.split('.')[:-1])
-                    open(renamed_filetype_path, 'w').write(data.encode("UTF-8"))
                 if os.path.isfile(renamed_filetype_path):
                     _LOG.info("Modifying repo for %s metadata" % ftype)
-                    modify_repo(current_repo_dir, renamed_filetype_path)
+                    self.repomd_editor.add(renamed_filetype_path)
+            # the backup is removed below, so the collected files have to be merged now
+            self.save_repomd()
         finally:
             if self.backup_repodata_dir:
                 shutil.rmtree(self.backup_repodata_dir)
 
+    def close_package_databases(self):
+        """
+        Finishes the sqlite databases filled during the unit metadata merge. On
+        success createrepo is told not to build them from the xml files again.
+
+        @return repomd data entries of the databases, empty if createrepo has to build them
+        @rtype [{}]
+        """
+        if self.package_databases is None:
+            return []
+        try:
+            xml_checksums = {}
+            for ftype, xml_path in (("primary", self.primary_xml_path), ("filelists", self.filelists_xml_path),
+                                    ("other", self.other_xml_path)):
+                xml_checksums[ftype] = util.get_file_checksum(filename=xml_path, hashtype=self.checksum_type)
+            entries = self.package_databases.close(xml_checksums, self.checksum_type,
+                unique_md_filenames=getattr(self.metadata_conf, "unique_md_filenames", False))
+        except Exception, e:
+            _LOG.exception("Unable to finish sqlite databases; leaving them to createrepo")
+            self.package_databases.abort()
+            return []
+        finally:
+            self.package_databases = None
+        self.metadata_conf.database = 0
+        return [entries[ftype] for ftype in UNIT_METADATA_FTYPES]
+
+    def save_repomd(self):
+        """
+        Compresses the metadata files collected by the merge_* calls and writes them to repomd.xml in one pass
+        """
+        try:
+            self.repomd_editor.save()
+        except repomd.RepomdError, e:
+            raise ModifyRepoError(str(e))
+
     def final_repodata_move(self):
         # setup the yum config to do the final steps of generating sqlite db files
         try:
+            database_entries = self.close_package_databases()
             mdgen = MetaDataGenerator(self.metadata_conf)
             mdgen.doRepoMetadata()
+            if database_entries:
+                database_editor = repomd.RepomdEditor(self.temp_working_dir, checksum_type=self.checksum_type)
+                for entry in database_entries:
+                    database_editor.add_entry(entry)
+                database_editor.save()
             # do the final move to the repodata location from .repodata
             mdgen.doFinalMove()
         except:
@@ -737,8 +1232,12 @@ xmlns:rpm="http://linux.duke.edu/metadata/rpm" packages="%s"> \n""" % self.unit_
         # backup existing repodata dir
         self._backup_existing_repodata()
         # extract the per rpm unit metadata and merge to create package xml data
-        self.init_xml()
-        self.merge_unit_metadata(units)
+        self.init_xml(len(units))
+        try:
+            self.merge_unit_metadata(units)
+        except:
+            self.abort_xml()
+            raise
         self.close_xml()
 
         self.final_repodata_move()
@@ -747,6 +1246,74 @@ xmlns:rpm="http://linux.duke.edu/metadata/rpm" packages="%s"> \n""" % self.unit_
         self.merge_updateinfo_xml()
         # merge any custom metadata stored on the scratchpad, this includes prestodelta
         self.merge_custom_repodata()
+        self.save_repomd()
+
+
+def _iter_unit_pages(publish_conduit, type_id, unit_fields, limit):
+    """
+    Pages through the units of a type sorted by their unit key. Each page starts after
+    the unit key of the last unit of the previous page, see util.form_seek_filter.
+
+    @param publish_conduit: publish conduit
+    @type publish_conduit: pulp.plugins.conduits.repo_publish.RepoPublishConduit
+
+    @param type_id: rpm or srpm
+    @type  type_id: str
+
+    @param unit_fields: unit fields to fetch; the unit key fields are always fetched
+    @type  unit_fields: [str]
+
+    @param limit: number of units to fetch per query
+    @type  limit: int
+
+    @return generator of pages of units
+    @rtype generator of [AssociatedUnit]
+    """
+    unit_fields = list(unit_fields) + [f for f in util.RPM_SORT_FIELDS if f not in unit_fields]
+    unit_sort = [(field, 1) for field in util.RPM_SORT_FIELDS]
+    unit_filters = None
+    while True:
+        criteria = UnitAssociationCriteria(type_ids=[type_id], unit_fields=unit_fields,
+            unit_filters=unit_filters, unit_sort=unit_sort, limit=limit)
+        units = publish_conduit.get_units(criteria)
+        if not units:
+            break
+        yield units
+        if len(units) < limit:
+            break
+        unit_filters = util.form_seek_filter(units[-1].unit_key)
+
+
+def _generate_package_xmls(metadata_generator, publish_conduit, limit):
+    """
+    Writes the primary, filelists and other xmls from the snippets of every rpm and srpm unit in the repo
+
+    @param metadata_generator: generator the xmls are written with
+    @type  metadata_generator: YumMetadataGenerator
+
+    @param publish_conduit: publish conduit
+    @type publish_conduit: pulp.plugins.conduits.repo_publish.RepoPublishConduit
+
+    @param limit: number of units to fetch per query
+    @type  limit: int
+    """
+    metadata_generator.init_xml()
+    unit_count = 0
+    unit_fields = ['id', 'name', 'version', 'release', 'arch', 'epoch',
+                   '_storage_path', "checksum", "checksumtype" , "repodata"]
+    try:
+        # RPMs & SRPMs processed independently so we can use criteria to limit fields for returned results
+        for type_id in [TYPE_ID_RPM, TYPE_ID_SRPM]:
+            for units in _iter_unit_pages(publish_conduit, type_id, unit_fields, limit):
+                _LOG.info("generate_yum_metadata processing %s units of type %s, %s total units have already been processed" % \
+                          (len(units), type_id, unit_count))
+                unit_count += len(units)
+                metadata_generator.merge_unit_metadata(units)
+    except:
+        metadata_generator.abort_xml()
+        raise
+    _LOG.info("generate_yum_metadata finished processing %s units" % (unit_count))
+    metadata_generator.close_xml()
 
 
 def generate_yum_metadata(repo_dir, publish_conduit, config, progress_callback=None,
@@ -808,25 +1375,10 @@ def generate_yum_metadata(repo_dir, publish_conduit, config, progress_callback=N
             _LOG.warn("cancel metadata generation")
             raise CancelException()
 
-        create_yum_metadata.init_xml()
-        unit_count = 0
-        for type_id in [TYPE_ID_RPM, TYPE_ID_SRPM]:
-            skip = 0
-            # RPMs & SRPMs processed independently so we can use criteria to limit fields for returned results
-            while True:
-                criteria = UnitAssociationCriteria(type_ids=type_id,
-                    unit_fields=['id', 'name', 'version', 'release', 'arch', 'epoch',
-                                 '_storage_path', "checksum", "checksumtype" , "repodata"], limit=limit, skip=skip)
-                units = publish_conduit.get_units(criteria)
-                if not units:
-                    break
-                _LOG.info("generate_yum_metadata processing %s units of type %s, %s total units have already been processed" % \
-                          (len(units), type_id, unit_count))
-                skip += len(units)
-                unit_count += len(units)
-                create_yum_metadata.merge_unit_metadata(units)
-        _LOG.info("generate_yum_metadata finished processing %s units" % (unit_count))
-        create_yum_metadata.close_xml()
+        if config.get('incremental_publish'):
+            create_yum_metadata.merge_unit_metadata_incremental(publish_conduit, limit=limit)
+        else:
+            _generate_package_xmls(create_yum_metadata, publish_conduit, limit)
 
         create_yum_metadata.final_repodata_move()
         # lookup and merge updateinfo, comps and other metadata
@@ -834,6 +1386,7 @@ def generate_yum_metadata(repo_dir, publish_conduit, config, progress_callback=N
         create_yum_metadata.merge_updateinfo_xml()
         # merge any custom metadata stored on the scratchpad, this includes prestodelta
         create_yum_metadata.merge_custom_repodata()
+        create_yum_metadata.save_repomd()
 
     except CancelException, ce:
         metadata_progress_status = {"state" : "CANCELED"}
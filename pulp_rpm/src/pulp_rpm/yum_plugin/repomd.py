@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2013 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+
+"""
+In process replacement for modifyrepo. Extra metadata files are collected,
+compressed and checksummed concurrently, and repomd.xml is rewritten once.
+repomd.xml is read and written with yum's repoMDObject, as modifyrepo does.
+"""
+
+import gzip
+import hashlib
+import os
+import threading
+
+from yum.repoMDObject import RepoMD, RepoData
+
+from pulp_rpm.yum_plugin import util
+
+_LOG = util.getLogger(__name__)
+
+
+class RepomdError(Exception):
+    pass
+
+
+def get_mdtype(path):
+    """
+    Metadata type a file is added as, following modifyrepo: the file name up to the first '.'
+
+    @param path: path to the metadata file
+    @type  path: str
+
+    @return metadata type
+    @rtype str
+    """
+    return os.path.basename(path).split('.')[0]
+
+
+def repo_data(entry):
+    """
+    @param entry: repomd data entry with type, checksum_type, checksum, location, timestamp, size
+                  and optionally open_checksum, open_size and database_version
+    @type  entry: {}
+
+    @return repomd.xml data element of the entry
+    @rtype yum.repoMDObject.RepoData
+    """
+    data = RepoData()
+    data.type = entry["type"]
+    data.checksum = (entry["checksum_type"], entry["checksum"])
+    if entry.get("open_checksum"):
+        data.openchecksum = (entry["checksum_type"], entry["open_checksum"])
+    data.location = (None, entry["location"])
+    data.timestamp = str(entry["timestamp"])
+    data.size = str(entry["size"])
+    if entry.get("open_size") is not None:
+        data.opensize = str(entry["open_size"])
+    if entry.get("database_version") is not None:
+        data.dbversion = str(entry["database_version"])
+    return data
+
+
+def _new_hash(checksum_type):
+    if checksum_type in ['sha', 'SHA']:
+        checksum_type = 'sha1'
+    return hashlib.new(checksum_type)
+
+
+class RepomdEditor(object):
+    """
+    Collects changes to a repodata directory and applies them with a single
+    rewrite of repomd.xml. Files added with add() are compressed and checksummed
+    on their own threads when save() is called.
+    """
+    def __init__(self, repodata_dir, checksum_type="sha256", unique_md_filenames=True):
+        """
+        @param repodata_dir: repodata directory holding repomd.xml
+        @type  repodata_dir: str
+
+        @param checksum_type: checksum type of the new entries
+        @type  checksum_type: str
+
+        @param unique_md_filenames: prefix added files with their checksum, as modifyrepo does
+        @type  unique_md_filenames: bool
+        """
+        self.repodata_dir = repodata_dir
+        self.repomd_path = os.path.join(repodata_dir, "repomd.xml")
+        self.checksum_type = checksum_type
+        self.unique_md_filenames = unique_md_filenames
+        # mdtype -> path of a file still to be compressed
+        self.files = {}
+        # mdtype -> prepared repomd data entry
+        self.entries = {}
+        self.removed = set()
+
+    def add(self, path, mdtype=None):
+        """
+        Queues a metadata file, plain or gzipped, to be added; replaces any existing entry of its type
+
+        @param path: path to the metadata file
+        @type  path: str
+
+        @param mdtype: metadata type, defaults to get_mdtype(path)
+        @type  mdtype: str
+        """
+        if not os.path.isfile(path):
+            raise RepomdError("%s not found" % path)
+        mdtype = mdtype or get_mdtype(path)
+        self.files[mdtype] = path
+        self.entries.pop(mdtype, None)
+        self.removed.discard(mdtype)
+
+    def add_entry(self, entry):
+        """
+        Queues an entry for a file already in the repodata directory, such as the sqlite databases
+
+        @param entry: repomd data entry, see repo_data
+        @type  entry: {}
+        """
+        self.entries[entry["type"]] = entry
+        self.files.pop(entry["type"], None)
+        self.removed.discard(entry["type"])
+
+    def remove(self, mdtype):
+        """
+        Queues removal of the entry, and its file, of the given type
+
+        @param mdtype: metadata type
+        @type  mdtype: str
+        """
+        self.files.pop(mdtype, None)
+        self.entries.pop(mdtype, None)
+        self.removed.add(mdtype)
+
+    def has_changes(self):
+        return bool(self.files or self.entries or self.removed)
+
+    def save(self):
+        """
+        Compresses and checksums the queued files concurrently, then rewrites repomd.xml once
+        """
+        if not self.has_changes():
+            return
+        repomd = RepoMD("repomd", self.repomd_path)
+        results = {}
+        workers = []
+        for mdtype, path in self.files.items():
+            worker = threading.Thread(target=self._prepare_file, args=(mdtype, path, results),
+                                      name="repomd-%s" % mdtype)
+            worker.start()
+            workers.append(worker)
+        for worker in workers:
+            worker.join()
+        entries = dict(self.entries)
+        for mdtype in self.files:
+            result = results.get(mdtype)
+            if isinstance(result, Exception) or result is None:
+                raise RepomdError("Unable to add %s metadata from %s: %s" % (mdtype, self.files[mdtype], result))
+            entries[mdtype] = result
+
+        stale_locations = []
+        for mdtype in set(entries.keys()) | self.removed:
+            data = repomd.repoData.pop(mdtype, None)
+            if data is not None and data.location[1]:
+                stale_locations.append(data.location[1])
+        for mdtype, entry in entries.items():
+            repomd.repoData[mdtype] = repo_data(entry)
+        new_repomd = repomd.dump_xml()
+        temp_repomd_path = self.repomd_path + ".tmp"
+        f = open(temp_repomd_path, "w")
+        try:
+            f.write(new_repomd)
+        finally:
+            f.close()
+        os.rename(temp_repomd_path, self.repomd_path)
+        new_locations = set([e["location"] for e in entries.values()])
+        for location in stale_locations:
+            if location in new_locations:
+                continue
+            stale_path = os.path.join(os.path.dirname(self.repodata_dir), location)
+            if os.path.isfile(stale_path):
+                os.unlink(stale_path)
+        _LOG.info("Updated %s; added %s, removed %s" % (self.repomd_path, sorted(entries.keys()), sorted(self.removed)))
+        self.files = {}
+        self.entries = {}
+        self.removed = set()
+
+    def _prepare_file(self, mdtype, path, results):
+        """
+        Writes the gzipped copy of a metadata file into the repodata dir and records its repomd entry
+        """
+        try:
+            if path.endswith(".gz"):
+                in_f = gzip.open(path, "rb")
+                mdname = os.path.basename(path)
+            else:
+                in_f = open(path, "rb")
+                mdname = os.path.basename(path) + ".gz"
+            dest_path = os.path.join(self.repodata_dir, mdname)
+            temp_path = dest_path + ".%s.tmp" % threading.currentThread().getName()
+            open_hash = _new_hash(self.checksum_type)
+            open_size = 0
+            try:
+                out_f = gzip.GzipFile(temp_path, "wb", compresslevel=9)
+                try:
+                    while True:
+                        data = in_f.read(1024*1024)
+                        if not data:
+                            break
+                        open_hash.update(data)
+                        open_size += len(data)
+                        out_f.write(data)
+                finally:
+                    out_f.close()
+            finally:
+                in_f.close()
+            checksum = util.get_file_checksum(filename=temp_path, hashtype=self.checksum_type)
+            if self.unique_md_filenames:
+                dest_path = os.path.join(self.repodata_dir, "%s-%s" % (checksum, mdname))
+            os.rename(temp_path, dest_path)
+            stat = os.stat(dest_path)
+            results[mdtype] = {"type" : mdtype, "checksum_type" : self.checksum_type, "checksum" : checksum,
+                "open_checksum" : open_hash.hexdigest(), "location" : "repodata/%s" % os.path.basename(dest_path),
+                "timestamp" : int(stat.st_mtime), "size" : stat.st_size, "open_size" : open_size}
+        except Exception, e:
+            _LOG.exception("Unable to prepare %s metadata from %s" % (mdtype, path))
+            results[mdtype] = e
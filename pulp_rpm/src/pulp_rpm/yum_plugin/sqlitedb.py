@@ -0,0 +1,366 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2013 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+
+"""
+Builds the primary, filelists and other sqlite databases of a yum repo from the
+per unit repodata snippets while they are merged into the xml files, instead of
+having createrepo parse the finished xml files again.
+
+The schema matches the one yum-metadata-parser writes for database version 10.
+"""
+
+import bz2
+import os
+import sqlite3
+import time
+
+try:
+    from xml.etree import cElementTree as ElementTree
+except ImportError:
+    from xml.etree import ElementTree
+
+from pulp_rpm.yum_plugin import util
+
+_LOG = util.getLogger(__name__)
+
+DATABASE_VERSION = 10
+
+COMMON_NS = "http://linux.duke.edu/metadata/common"
+RPM_NS = "http://linux.duke.edu/metadata/rpm"
+FILELISTS_NS = "http://linux.duke.edu/metadata/filelists"
+OTHER_NS = "http://linux.duke.edu/metadata/other"
+
+# Snippets are stored without namespace declarations; batches of them are parsed wrapped in these
+SNIPPET_WRAPPERS = {
+    "primary" : ('<metadata xmlns="%s" xmlns:rpm="%s">' % (COMMON_NS, RPM_NS), '</metadata>'),
+    "filelists" : ('<filelists xmlns="%s">' % FILELISTS_NS, '</filelists>'),
+    "other" : ('<otherdata xmlns="%s">' % OTHER_NS, '</otherdata>'),
+}
+
+DEPENDENCY_TYPES = ("provides", "requires", "conflicts", "obsoletes")
+
+PRIMARY_SCHEMA = [
+    "CREATE TABLE db_info (dbversion INTEGER, checksum TEXT)",
+    "CREATE TABLE packages (pkgKey INTEGER PRIMARY KEY, pkgId TEXT, name TEXT, arch TEXT, "
+        "version TEXT, epoch TEXT, release TEXT, summary TEXT, description TEXT, url TEXT, "
+        "time_file INTEGER, time_build INTEGER, rpm_license TEXT, rpm_vendor TEXT, rpm_group TEXT, "
+        "rpm_buildhost TEXT, rpm_sourcerpm TEXT, rpm_header_start INTEGER, rpm_header_end INTEGER, "
+        "rpm_packager TEXT, size_package INTEGER, size_installed INTEGER, size_archive INTEGER, "
+        "location_href TEXT, location_base TEXT, checksum_type TEXT)",
+    "CREATE TABLE files (name TEXT, type TEXT, pkgKey INTEGER)",
+    "CREATE TABLE requires (name TEXT, flags TEXT, epoch TEXT, version TEXT, release TEXT, pkgKey INTEGER, "
+        "pre BOOLEAN DEFAULT FALSE)",
+    "CREATE TABLE provides (name TEXT, flags TEXT, epoch TEXT, version TEXT, release TEXT, pkgKey INTEGER)",
+    "CREATE TABLE conflicts (name TEXT, flags TEXT, epoch TEXT, version TEXT, release TEXT, pkgKey INTEGER)",
+    "CREATE TABLE obsoletes (name TEXT, flags TEXT, epoch TEXT, version TEXT, release TEXT, pkgKey INTEGER)",
+]
+PRIMARY_INDEXES = [
+    "CREATE INDEX packagename ON packages (name)",
+    "CREATE INDEX packageId ON packages (pkgId)",
+    "CREATE INDEX filenames ON files (name)",
+    "CREATE INDEX pkgfiles ON files (pkgKey)",
+    "CREATE INDEX pkgrequires on requires (pkgKey)",
+    "CREATE INDEX requiresname ON requires (name)",
+    "CREATE INDEX pkgprovides on provides (pkgKey)",
+    "CREATE INDEX providesname ON provides (name)",
+    "CREATE INDEX pkgconflicts on conflicts (pkgKey)",
+    "CREATE INDEX pkgobsoletes on obsoletes (pkgKey)",
+    "CREATE TRIGGER removals AFTER DELETE ON packages BEGIN "
+        "DELETE FROM files WHERE pkgKey = old.pkgKey; "
+        "DELETE FROM requires WHERE pkgKey = old.pkgKey; "
+        "DELETE FROM provides WHERE pkgKey = old.pkgKey; "
+        "DELETE FROM conflicts WHERE pkgKey = old.pkgKey; "
+        "DELETE FROM obsoletes WHERE pkgKey = old.pkgKey; END",
+]
+FILELISTS_SCHEMA = [
+    "CREATE TABLE db_info (dbversion INTEGER, checksum TEXT)",
+    "CREATE TABLE packages (pkgKey INTEGER PRIMARY KEY, pkgId TEXT)",
+    "CREATE TABLE filelist (pkgKey INTEGER, dirname TEXT, filenames TEXT, filetypes TEXT)",
+]
+FILELISTS_INDEXES = [
+    "CREATE INDEX keyfile ON filelist (pkgKey)",
+    "CREATE INDEX pkgId ON packages (pkgId)",
+    "CREATE INDEX dirnames ON filelist (dirname)",
+    "CREATE TRIGGER remove_filelist AFTER DELETE ON packages BEGIN "
+        "DELETE FROM filelist WHERE pkgKey = old.pkgKey; END",
+]
+OTHER_SCHEMA = [
+    "CREATE TABLE db_info (dbversion INTEGER, checksum TEXT)",
+    "CREATE TABLE packages (pkgKey INTEGER PRIMARY KEY, pkgId TEXT)",
+    "CREATE TABLE changelog (pkgKey INTEGER, author TEXT, date INTEGER, changelog TEXT)",
+]
+OTHER_INDEXES = [
+    "CREATE INDEX keychange ON changelog (pkgKey)",
+    "CREATE INDEX pkgId ON packages (pkgId)",
+    "CREATE TRIGGER remove_changelogs AFTER DELETE ON packages BEGIN "
+        "DELETE FROM changelog WHERE pkgKey = old.pkgKey; END",
+]
+
+# filelist.filetypes holds one character per file
+FILE_TYPE_CODES = {"file" : "f", "dir" : "d", "ghost" : "g"}
+
+
+def _tag(namespace, name):
+    return "{%s}%s" % (namespace, name)
+
+
+def _int(value):
+    if value is None or value == "":
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+
+def _text(element):
+    if element is None:
+        return None
+    return element.text
+
+
+def parse_snippets(ftype, data):
+    """
+    @param ftype: one of primary, filelists or other
+    @type  ftype: str
+
+    @param data: utf-8 encoded, concatenated <package> snippets of ftype
+    @type  data: str
+
+    @return the parsed <package> elements
+    @rtype [Element]
+    """
+    if not data:
+        return []
+    head, tail = SNIPPET_WRAPPERS[ftype]
+    return list(ElementTree.fromstring(head + data + tail))
+
+
+class PackageDatabases(object):
+    """
+    Writes the primary, filelists and other sqlite databases of a repo from the
+    repodata snippets of its units. Rows are inserted a batch at a time with
+    executemany; indexes and triggers are only created once every unit has been
+    added, and the databases are finally bzip2 compressed next to the xml files.
+    """
+    def __init__(self, working_dir):
+        """
+        @param working_dir: directory the databases are created and compressed in
+        @type  working_dir: str
+        """
+        self.working_dir = working_dir
+        self.paths = {}
+        self.connections = {}
+        self.package_counts = {}
+        for ftype, schema in (("primary", PRIMARY_SCHEMA), ("filelists", FILELISTS_SCHEMA), ("other", OTHER_SCHEMA)):
+            path = os.path.join(working_dir, "%s.sqlite" % ftype)
+            if os.path.exists(path):
+                os.unlink(path)
+            connection = sqlite3.connect(path)
+            # the databases are rebuilt from scratch on failure, durability is not needed
+            connection.execute("PRAGMA synchronous = OFF")
+            connection.execute("PRAGMA journal_mode = OFF")
+            for statement in schema:
+                connection.execute(statement)
+            self.paths[ftype] = path
+            self.connections[ftype] = connection
+            self.package_counts[ftype] = 0
+
+    def add_snippets(self, primary, filelists, other):
+        """
+        Adds a batch of packages to the databases
+
+        @param primary: concatenated primary xml snippets of the batch
+        @type  primary: str
+
+        @param filelists: concatenated filelists xml snippets of the batch
+        @type  filelists: str
+
+        @param other: concatenated other xml snippets of the batch
+        @type  other: str
+        """
+        self._add_primary(parse_snippets("primary", primary))
+        self._add_filelists(parse_snippets("filelists", filelists))
+        self._add_other(parse_snippets("other", other))
+
+    def _next_keys(self, ftype, count):
+        first = self.package_counts[ftype] + 1
+        self.package_counts[ftype] += count
+        return range(first, first + count)
+
+    def _add_primary(self, packages):
+        packages_rows = []
+        files_rows = []
+        dependency_rows = dict([(dep_type, []) for dep_type in DEPENDENCY_TYPES])
+        for pkg_key, package in zip(self._next_keys("primary", len(packages)), packages):
+            version = package.find(_tag(COMMON_NS, "version"))
+            checksum = package.find(_tag(COMMON_NS, "checksum"))
+            time_info = package.find(_tag(COMMON_NS, "time"))
+            size = package.find(_tag(COMMON_NS, "size"))
+            location = package.find(_tag(COMMON_NS, "location"))
+            format = package.find(_tag(COMMON_NS, "format"))
+            if format is None:
+                format = ElementTree.Element(_tag(COMMON_NS, "format"))
+            header_range = format.find(_tag(RPM_NS, "header-range"))
+            if header_range is None:
+                header_range = ElementTree.Element(_tag(RPM_NS, "header-range"))
+            packages_rows.append((pkg_key, checksum.text, _text(package.find(_tag(COMMON_NS, "name"))),
+                _text(package.find(_tag(COMMON_NS, "arch"))), version.get("ver"), version.get("epoch"),
+                version.get("rel"), _text(package.find(_tag(COMMON_NS, "summary"))),
+                _text(package.find(_tag(COMMON_NS, "description"))), _text(package.find(_tag(COMMON_NS, "url"))),
+                _int(time_info.get("file")), _int(time_info.get("build")),
+                _text(format.find(_tag(RPM_NS, "license"))), _text(format.find(_tag(RPM_NS, "vendor"))),
+                _text(format.find(_tag(RPM_NS, "group"))), _text(format.find(_tag(RPM_NS, "buildhost"))),
+                _text(format.find(_tag(RPM_NS, "sourcerpm"))),
+                _int(header_range.get("start")), _int(header_range.get("end")),
+                _text(package.find(_tag(COMMON_NS, "packager"))),
+                _int(size.get("package")), _int(size.get("installed")), _int(size.get("archive")),
+                location.get("href"), location.get("{http://www.w3.org/XML/1998/namespace}base"),
+                checksum.get("type")))
+            for dep_type in DEPENDENCY_TYPES:
+                deps = format.find(_tag(RPM_NS, dep_type))
+                if deps is None:
+                    continue
+                for entry in deps.findall(_tag(RPM_NS, "entry")):
+                    row = (entry.get("name"), entry.get("flags"), entry.get("epoch"), entry.get("ver"),
+                           entry.get("rel"), pkg_key)
+                    if dep_type == "requires":
+                        if entry.get("pre") in ("1", "true", "TRUE"):
+                            row += ("TRUE",)
+                        else:
+                            row += ("FALSE",)
+                    dependency_rows[dep_type].append(row)
+            for f in format.findall(_tag(COMMON_NS, "file")):
+                files_rows.append((f.text, f.get("type", "file"), pkg_key))
+        connection = self.connections["primary"]
+        connection.executemany("INSERT INTO packages VALUES (%s)" % ",".join(["?"] * 26), packages_rows)
+        connection.executemany("INSERT INTO files VALUES (?, ?, ?)", files_rows)
+        for dep_type, rows in dependency_rows.items():
+            if dep_type == "requires":
+                connection.executemany("INSERT INTO requires VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            else:
+                connection.executemany("INSERT INTO %s VALUES (?, ?, ?, ?, ?, ?)" % dep_type, rows)
+
+    def _add_filelists(self, packages):
+        packages_rows = []
+        filelist_rows = []
+        for pkg_key, package in zip(self._next_keys("filelists", len(packages)), packages):
+            packages_rows.append((pkg_key, package.get("pkgid")))
+            # files are stored grouped by directory, in the order they are listed
+            dirs = {}
+            dir_order = []
+            for f in package.findall(_tag(FILELISTS_NS, "file")):
+                if not f.text:
+                    continue
+                dirname, filename = os.path.split(f.text)
+                if dirname not in dirs:
+                    dirs[dirname] = ([], [])
+                    dir_order.append(dirname)
+                dirs[dirname][0].append(filename)
+                dirs[dirname][1].append(FILE_TYPE_CODES.get(f.get("type", "file"), "f"))
+            for dirname in dir_order:
+                filenames, filetypes = dirs[dirname]
+                filelist_rows.append((pkg_key, dirname, "/".join(filenames), "".join(filetypes)))
+        connection = self.connections["filelists"]
+        connection.executemany("INSERT INTO packages VALUES (?, ?)", packages_rows)
+        connection.executemany("INSERT INTO filelist VALUES (?, ?, ?, ?)", filelist_rows)
+
+    def _add_other(self, packages):
+        packages_rows = []
+        changelog_rows = []
+        for pkg_key, package in zip(self._next_keys("other", len(packages)), packages):
+            packages_rows.append((pkg_key, package.get("pkgid")))
+            for changelog in package.findall(_tag(OTHER_NS, "changelog")):
+                changelog_rows.append((pkg_key, changelog.get("author"), _int(changelog.get("date")),
+                                       changelog.text))
+        connection = self.connections["other"]
+        connection.executemany("INSERT INTO packages VALUES (?, ?)", packages_rows)
+        connection.executemany("INSERT INTO changelog VALUES (?, ?, ?, ?)", changelog_rows)
+
+    def close(self, xml_checksums, checksum_type, unique_md_filenames=False):
+        """
+        Creates the indexes, records the checksum of the matching xml file in db_info,
+        compresses the databases and removes the uncompressed files.
+
+        @param xml_checksums: checksum of the compressed primary, filelists and other xml files
+        @type  xml_checksums: {str:str}
+
+        @param checksum_type: checksum type used in repomd.xml
+        @type  checksum_type: str
+
+        @param unique_md_filenames: prefix the compressed file names with their checksum
+        @type  unique_md_filenames: bool
+
+        @return repomd data entries of the compressed databases, keyed by ftype
+        @rtype {str:{}}
+        """
+        start = time.time()
+        entries = {}
+        for ftype, indexes in (("primary", PRIMARY_INDEXES), ("filelists", FILELISTS_INDEXES), ("other", OTHER_INDEXES)):
+            connection = self.connections[ftype]
+            for statement in indexes:
+                connection.execute(statement)
+            connection.execute("INSERT INTO db_info VALUES (?, ?)", (DATABASE_VERSION, xml_checksums[ftype]))
+            connection.commit()
+            connection.close()
+            path = self.paths[ftype]
+            open_checksum = util.get_file_checksum(filename=path, hashtype=checksum_type)
+            open_size = os.path.getsize(path)
+            compressed_path = path + ".bz2"
+            compress_file(path, compressed_path)
+            os.unlink(path)
+            checksum = util.get_file_checksum(filename=compressed_path, hashtype=checksum_type)
+            if unique_md_filenames:
+                unique_path = os.path.join(self.working_dir, "%s-%s" % (checksum, os.path.basename(compressed_path)))
+                os.rename(compressed_path, unique_path)
+                compressed_path = unique_path
+            compressed_stat = os.stat(compressed_path)
+            entries[ftype] = {"type" : "%s_db" % ftype, "checksum_type" : checksum_type,
+                "checksum" : checksum, "open_checksum" : open_checksum,
+                "location" : "repodata/%s" % os.path.basename(compressed_path),
+                "timestamp" : int(compressed_stat.st_mtime), "size" : compressed_stat.st_size,
+                "open_size" : open_size, "database_version" : DATABASE_VERSION}
+        _LOG.info("sqlite databases of %s packages finished in %s seconds" % \
+                  (self.package_counts["primary"], time.time() - start))
+        return entries
+
+    def abort(self):
+        """
+        Closes and removes the databases
+        """
+        for ftype, connection in self.connections.items():
+            try:
+                connection.close()
+            except sqlite3.Error:
+                pass
+            if os.path.exists(self.paths[ftype]):
+                os.unlink(self.paths[ftype])
+
+
+def compress_file(input_path, output_path, buffer_size=1024*1024):
+    """
+    bzip2 compresses input_path to output_path
+    """
+    in_f = open(input_path, "rb")
+    try:
+        out_f = bz2.BZ2File(output_path, "wb", compresslevel=9)
+        try:
+            while True:
+                data = in_f.read(buffer_size)
+                if not data:
+                    break
+                out_f.write(data)
+        finally:
+            out_f.close()
+    finally:
+        in_f.close()
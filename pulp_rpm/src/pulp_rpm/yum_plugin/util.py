@@ -13,6 +13,8 @@
 import commands
 import hashlib
 import shutil
+import sqlite3
+import threading
 import traceback
 import urlparse
 import yum
@@ -20,8 +22,11 @@ import time
 import os
 import logging
 import gettext
-import rpmUtils
 from M2Crypto import X509
+
+from pulp_rpm.common import checksum
+from pulp_rpm.yum_plugin import evr
+
 _ = gettext.gettext
 
 LOG_PREFIX_NAME="pulp.plugins"
@@ -30,6 +35,15 @@ def getLogger(name):
     return logging.getLogger(log_name)
 _LOG = getLogger(__name__)
 
+# Erratum metadata field holding get_errata_package_keys of its pkglist
+ERRATUM_PACKAGE_KEYS = "pkglist_name_arch"
+# Rpm metadata field holding get_repodata_digest of its repodata snippets
+REPODATA_DIGEST = "repodata_digest"
+# Snippets stored in the repodata of an rpm unit
+REPODATA_FTYPES = ("primary", "filelists", "other")
+# Unit key fields in the order rpm units are paged through, see form_seek_filter
+RPM_SORT_FIELDS = ("name", "epoch", "version", "release", "arch", "checksumtype", "checksum")
+
 def get_repomd_filetypes(repomd_path):
     """
     @param repomd_path: path to repomd.xml
@@ -125,20 +139,19 @@ def get_file_checksum(filename=None, fd=None, file=None, buffer_size=None, hasht
     """
     Compute a file's checksum.
     """
-    if hashtype in ['sha', 'SHA']:
-        hashtype = 'sha1'
+    if filename is None and fd is None and file is None:
+        raise Exception("no file specified")
+    if file is None and fd is None:
+        return checksum.file_checksum(filename, hashtype)
+    hashtype = checksum.normalize_checksum_type(hashtype)
 
     if buffer_size is None:
         buffer_size = 65536
 
-    if filename is None and fd is None and file is None:
-        raise Exception("no file specified")
     if file:
         f = file
-    elif fd is not None:
-        f = os.fdopen(os.dup(fd), "r")
     else:
-        f = open(filename, "r")
+        f = os.fdopen(os.dup(fd), "r")
     # Rewind it
     f.seek(0, 0)
     m = hashlib.new(hashtype)
@@ -187,31 +200,196 @@ def verify_exists(file_path, checksum=None, checksum_type="sha256", size=None, v
     @param size size of the file
     @type size int
 
-    @param verify_options dict of checksum of size verify options
+    @param verify_options dict of checksum of size verify options; an optional "cache"
+                          VerificationCache skips re-hashing files verified before
     @type size dict
 
     @return True if all checks pass; else False
     @rtype bool
     """
-    _LOG.debug("Verify path [%s] exists" % file_path)
-    if not os.path.exists(file_path):
-        # file path not found
-        return False
+    return verify_files([(file_path, checksum, checksum_type, size)], verify_options)[0]
+
+
+def verify_files(files, verify_options={}):
+    """
+    Batch form of verify_exists. Existence, size and verification cache checks are
+    done first; the files still needing a checksum are then hashed concurrently by
+    the shared checksum service, each file read once whatever the number of
+    checksum types it is verified against. Files failing a check are removed.
+
+    @param files list of (file_path, checksum, checksum_type, size) tuples
+    @type files [(str, str, str, int)]
+
+    @param verify_options dict of checksum of size verify options; an optional "cache"
+                          VerificationCache skips re-hashing files verified before
+    @type verify_options dict
+
+    @return result of the checks of each file, in the order of files
+    @rtype [bool]
+    """
     verify_size = verify_options.get("size") or False
-    # compute the size
-    if verify_size and size is not None:
-        f_stat = os.stat(file_path)
-        if int(size) and f_stat.st_size != int(size):
-            cleanup_file(file_path)
-            return False
     verify_checksum = verify_options.get("checksum") or False
-    # compute checksum
-    if verify_checksum and checksum is not None:
-        computed_checksum = get_file_checksum(filename=file_path, hashtype=checksum_type)
-        if computed_checksum != checksum:
+    verify_cache = verify_options.get("cache")
+    results = [True] * len(files)
+    # file_path -> indexes into files still needing a checksum
+    pending = {}
+    stats = {}
+    for index, (file_path, expected_checksum, checksum_type, size) in enumerate(files):
+        _LOG.debug("Verify path [%s] exists" % file_path)
+        if not os.path.exists(file_path):
+            # file path not found
+            results[index] = False
+            continue
+        if verify_size and size is not None:
+            f_stat = os.stat(file_path)
+            if int(size) and f_stat.st_size != int(size):
+                cleanup_file(file_path)
+                results[index] = False
+                continue
+        if not verify_checksum or expected_checksum is None:
+            continue
+        if file_path not in stats:
+            stats[file_path] = os.stat(file_path)
+        if verify_cache is not None and \
+                verify_cache.lookup(file_path, checksum_type, stats[file_path]) == expected_checksum:
+            # unchanged since it was last verified
+            continue
+        pending.setdefault(file_path, []).append(index)
+    if not pending:
+        return results
+    requests = [(file_path, set([files[i][2] for i in indexes])) for file_path, indexes in pending.items()]
+    for file_path, computed in checksum.get_service().checksums(requests):
+        if isinstance(computed, Exception):
+            _LOG.error("Unable to compute checksum of [%s]: %s" % (file_path, computed))
+            valid = False
+        else:
+            valid = True
+            for index in pending[file_path]:
+                if computed[files[index][2]] != files[index][1]:
+                    valid = False
+        if not valid:
+            for index in pending[file_path]:
+                results[index] = False
+            if verify_cache is not None:
+                verify_cache.discard(file_path)
             cleanup_file(file_path)
-            return False
-    return True
+        elif verify_cache is not None:
+            for index in pending[file_path]:
+                checksum_type = files[index][2]
+                verify_cache.record(file_path, checksum_type, stats[file_path], computed[checksum_type])
+    return results
+
+
+class VerificationCache(object):
+    """
+    Persistent record of the files whose checksum has been verified, keyed by path and
+    checksum type. An entry is only trusted while the file's inode, size and mtime are
+    unchanged, and, when max_age is set, for max_age seconds after the verification so
+    content is periodically re-hashed.
+
+    The cache is a sqlite database; records are committed every commit_interval
+    changes and on close().
+    """
+    def __init__(self, db_path, max_age=None, commit_interval=500):
+        """
+        @param db_path: path of the cache database, created if missing
+        @type  db_path: str
+
+        @param max_age: seconds a verification is trusted for; None trusts it until the file changes
+        @type  max_age: int
+
+        @param commit_interval: number of changes between commits
+        @type  commit_interval: int
+        """
+        self.db_path = db_path
+        self.max_age = max_age
+        self.commit_interval = commit_interval
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(db_path, check_same_thread=False)
+        self._connection.execute("CREATE TABLE IF NOT EXISTS verified (path TEXT, checksumtype TEXT, "
+            "inode INTEGER, size INTEGER, mtime_ns INTEGER, digest TEXT, verified_at INTEGER, "
+            "PRIMARY KEY (path, checksumtype))")
+        self._connection.commit()
+
+    def _signature(self, f_stat):
+        return f_stat.st_ino, f_stat.st_size, int(round(f_stat.st_mtime * 1000000000))
+
+    def lookup(self, file_path, checksum_type, f_stat):
+        """
+        @param file_path: path of the file
+        @type  file_path: str
+
+        @param checksum_type: checksum type of the digest
+        @type  checksum_type: str
+
+        @param f_stat: current os.stat of the file
+        @type  f_stat: posix.stat_result
+
+        @return digest recorded at the last verification, None if the file changed since or was never verified
+        @rtype str
+        """
+        self._lock.acquire()
+        try:
+            row = self._connection.execute("SELECT inode, size, mtime_ns, digest, verified_at FROM verified "
+                "WHERE path = ? AND checksumtype = ?", (decode_path(file_path), checksum_type)).fetchone()
+        finally:
+            self._lock.release()
+        if row is None:
+            return None
+        inode, size, mtime_ns, digest, verified_at = row
+        if (inode, size, mtime_ns) != self._signature(f_stat):
+            return None
+        if self.max_age is not None and time.time() - verified_at > self.max_age:
+            return None
+        return digest
+
+    def record(self, file_path, checksum_type, f_stat, digest):
+        """
+        Records a successful verification of file_path; f_stat is the stat taken before hashing
+        """
+        inode, size, mtime_ns = self._signature(f_stat)
+        self._lock.acquire()
+        try:
+            self._connection.execute("INSERT OR REPLACE INTO verified VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (decode_path(file_path), checksum_type, inode, size, mtime_ns, digest, int(time.time())))
+            self._changed()
+        finally:
+            self._lock.release()
+
+    def discard(self, file_path):
+        """
+        Forgets every verification of file_path
+        """
+        self._lock.acquire()
+        try:
+            self._connection.execute("DELETE FROM verified WHERE path = ?", (decode_path(file_path),))
+            self._changed()
+        finally:
+            self._lock.release()
+
+    def _changed(self):
+        self._pending += 1
+        if self._pending >= self.commit_interval:
+            self._connection.commit()
+            self._pending = 0
+
+    def close(self):
+        self._lock.acquire()
+        try:
+            self._connection.commit()
+            self._connection.close()
+        finally:
+            self._lock.release()
+
+
+def decode_path(file_path):
+    """
+    sqlite only accepts unicode or ascii str; paths may hold utf-8 encoded names
+    """
+    if isinstance(file_path, str):
+        return file_path.decode("utf-8", "replace")
+    return file_path
 
 def cleanup_file(file_path):
     try:
@@ -358,12 +536,66 @@ def is_rpm_newer(a, b):
         return False
     if a["arch"] != b["arch"]:
         return False
-    value = rpmUtils.miscutils.compareEVR(
-            (a["epoch"], a["version"], a["release"]), 
-            (b["epoch"], b["version"], b["release"]))
-    if value > 0:
-        return True
-    return False
+    return evr.rpm_evr_key(a) > evr.rpm_evr_key(b)
+
+def form_package_key(item):
+    """
+    @param item: represents rpm metadata
+    @type item: dict with keywords: name, arch
+
+    @return "name arch" of the rpm; avoids "." since it is stored in mongo
+    @rtype: str
+    """
+    return "%s %s" % (item['name'], item['arch'])
+
+def get_errata_package_keys(pkglist):
+    """
+    @param pkglist: pkglist of an erratum
+    @type pkglist: list of dict
+
+    @return sorted "name arch" of each package the erratum lists, stored on the erratum
+            under ERRATUM_PACKAGE_KEYS so errata can be looked up by installed package
+    @rtype: [str]
+    """
+    keys = set()
+    for collection in pkglist or []:
+        for pkg in collection.get('packages', []):
+            keys.add(form_package_key(pkg))
+    return sorted(keys)
+
+def get_repodata_digest(repodata):
+    """
+    @param repodata: primary, filelists and other xml snippets of an rpm
+    @type repodata: dict
+
+    @return sha1 hex digest of the snippets, stored on the rpm unit under REPODATA_DIGEST
+            so a changed unit can be found without reading its snippets
+    @rtype: str
+    """
+    digest = hashlib.sha1()
+    for ftype in REPODATA_FTYPES:
+        snippet = (repodata or {}).get(ftype) or ""
+        if isinstance(snippet, unicode):
+            snippet = snippet.encode('utf-8')
+        digest.update(snippet)
+        digest.update("\0")
+    return digest.hexdigest()
+
+def form_seek_filter(unit_key):
+    """
+    @param unit_key: unit key of the last unit of a page sorted by RPM_SORT_FIELDS
+    @type unit_key: dict
+
+    @return unit filter matching the units sorted after unit_key, so the next page is
+            found through the index rather than by skipping over the earlier pages
+    @rtype: dict
+    """
+    clauses = []
+    for index, field in enumerate(RPM_SORT_FIELDS):
+        clause = dict([(f, unit_key[f]) for f in RPM_SORT_FIELDS[:index]])
+        clause[field] = {'$gt' : unit_key[field]}
+        clauses.append(clause)
+    return {'$or' : clauses}
 
 def encode_string_to_utf8(data):
     if not data:
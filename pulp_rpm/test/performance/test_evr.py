@@ -0,0 +1,90 @@
+# Copyright (c) 2013 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+
+import random
+import sys
+import os
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)) + "/../../src/")
+
+from rpmUtils.miscutils import compareEVR
+from pulp_rpm.yum_plugin import evr
+from gofer.metrics import Timer
+
+
+def generate_rpms(n_rpms, n_names=500, seed=0):
+    rnd = random.Random(seed)
+    rpms = []
+    for i in range(n_rpms):
+        version = "%d.%d.%d" % (rnd.randint(0, 3), rnd.randint(0, 20), rnd.randint(0, 50))
+        if rnd.random() < 0.1:
+            version += rnd.choice(["~rc1", "~beta2"])
+        rpms.append({
+            "name" : "pkg_%d" % rnd.randint(0, n_names),
+            "epoch" : rnd.choice(["0", "0", "0", "1"]),
+            "version" : version,
+            "release" : "%d.el6_%d" % (rnd.randint(1, 30), rnd.randint(0, 4)),
+            "arch" : rnd.choice(["noarch", "x86_64"]),
+        })
+    return rpms
+
+
+def compare_evr_cmp(a, b):
+    return compareEVR((a["epoch"], a["version"], a["release"]), (b["epoch"], b["version"], b["release"]))
+
+
+def newest_by_compare_evr(rpms):
+    newest = {}
+    for rpm in rpms:
+        name_arch = (rpm["name"], rpm["arch"])
+        if name_arch not in newest or compare_evr_cmp(rpm, newest[name_arch]) > 0:
+            newest[name_arch] = rpm
+    return newest
+
+
+class TestEVRBenchmark(unittest.TestCase):
+    """
+    Compares the evr sort keys against rpmUtils.miscutils.compareEVR
+    """
+
+    def run_timed(self, label, fn, *args):
+        timer = Timer()
+        timer.start()
+        result = fn(*args)
+        timer.stop()
+        print '%s: %s' % (label, timer)
+        return result
+
+    def test_sort(self):
+        rpms = generate_rpms(50000)
+        print 'Sorting %d rpms ....' % len(rpms)
+        expected = self.run_timed('compareEVR', sorted, rpms, compare_evr_cmp)
+        evr._key_cache.clear()
+        result = self.run_timed('evr keys', evr.sort_rpms, rpms)
+        self.assertEquals([evr.rpm_evr_key(r) for r in result], [evr.rpm_evr_key(r) for r in expected])
+
+    def test_newest(self):
+        rpms = generate_rpms(200000)
+        print 'Finding the newest of %d rpms ....' % len(rpms)
+        expected = self.run_timed('compareEVR', newest_by_compare_evr, rpms)
+        evr._key_cache.clear()
+        result = self.run_timed('evr keys', evr.newest_rpms, rpms)
+        self.assertEquals(result, expected)
+
+    def test_pairwise(self):
+        rpms = generate_rpms(2000)
+        pairs = [(a, b) for a in rpms[:200] for b in rpms]
+        print 'Comparing %d pairs ....' % len(pairs)
+        expected = self.run_timed('compareEVR', lambda: [compare_evr_cmp(a, b) for a, b in pairs])
+        evr._key_cache.clear()
+        result = self.run_timed('evr keys', lambda: [cmp(evr.rpm_evr_key(a), evr.rpm_evr_key(b)) for a, b in pairs])
+        self.assertEquals(result, expected)
@@ -106,14 +106,26 @@ def get_sync_conduit(type_id=None, existing_units=None, pkg_dir=None):
         if existing_units:
             for u in existing_units:
                 if u.type_id == type_id:
-                    if u.unit_key['id'] == criteria['filters']['id']:
+                    id_filter = criteria['filters']['id']
+                    if isinstance(id_filter, dict) and u.unit_key['id'] in id_filter['$in']:
+                        ret_val.append(u)
+                    elif u.unit_key['id'] == id_filter:
                         ret_val.append(u)
         return ret_val
 
+    scratchpad = {}
+    def get_scratchpad():
+        return scratchpad.get('value')
+
+    def set_scratchpad(value):
+        scratchpad['value'] = value
+
     sync_conduit = mock.Mock(spec=RepoSyncConduit)
     sync_conduit.init_unit.side_effect = side_effect
     sync_conduit.get_units.side_effect = get_units
     sync_conduit.search_all_units.side_effect = search_all_units
+    sync_conduit.get_scratchpad.side_effect = get_scratchpad
+    sync_conduit.set_scratchpad.side_effect = set_scratchpad
 
     return sync_conduit
 
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2013 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+
+import mock
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)) + "/../../src/")
+
+import rpm_support_base
+from pulp_rpm.common import checksum
+
+
+class TestChecksum(rpm_support_base.PulpRPMTests):
+
+    def setUp(self):
+        super(TestChecksum, self).setUp()
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        super(TestChecksum, self).tearDown()
+        shutil.rmtree(self.temp_dir)
+
+    def _write(self, name, data):
+        path = os.path.join(self.temp_dir, name)
+        f = open(path, "wb")
+        try:
+            f.write(data)
+        finally:
+            f.close()
+        return path
+
+    def test_file_checksums(self):
+        # larger than the read buffer, smaller than the mmap threshold
+        data = os.urandom(checksum.BUFFER_SIZE + checksum.BUFFER_SIZE / 2)
+        path = self._write("test.rpm", data)
+        expected = {"sha" : hashlib.sha1(data).hexdigest(), "sha256" : hashlib.sha256(data).hexdigest(),
+                    "md5" : hashlib.md5(data).hexdigest()}
+        self.assertEquals(checksum.file_checksums(path, expected.keys()), expected)
+        # read through mmap, in blocks that do not divide the file evenly
+        with mock.patch("pulp_rpm.common.checksum.MMAP_THRESHOLD", 1):
+            with mock.patch("pulp_rpm.common.checksum.MMAP_BLOCK_SIZE", checksum.BUFFER_SIZE / 3):
+                self.assertEquals(checksum.file_checksums(path, expected.keys()), expected)
+        self.assertEquals(checksum.file_checksum(path, "sha256"), expected["sha256"])
+
+    def test_file_checksum_empty_file(self):
+        path = self._write("empty", "")
+        self.assertEquals(checksum.file_checksum(path), hashlib.sha256("").hexdigest())
+
+    def test_checksum_service(self):
+        requests = []
+        expected = {}
+        for i in range(10):
+            data = "content %s" % i
+            path = self._write("file-%s" % i, data)
+            requests.append((path, ["sha256"]))
+            expected[path] = {"sha256" : hashlib.sha256(data).hexdigest()}
+        missing = os.path.join(self.temp_dir, "missing")
+        requests.append((missing, ["sha256"]))
+        service = checksum.ChecksumService(workers=3)
+        try:
+            results = dict(service.checksums(requests))
+        finally:
+            service.close()
+        self.assertTrue(isinstance(results.pop(missing), IOError))
+        self.assertEquals(results, expected)
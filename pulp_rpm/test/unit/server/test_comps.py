@@ -179,6 +179,30 @@ class TestComps(rpm_support_base.PulpRPMTests):
         self.assertEqual(summary["num_orphaned_categories"], 0)
         self.assertTrue(summary["time_total_sec"] > 0)
 
+    def test_sync_groups_unchanged_metadata(self):
+        ic = ImporterComps()
+        repo_src_dir = os.path.join(self.data_dir, "pulp_unittest")
+        feed_url = "file://%s" % (repo_src_dir)
+        config = importer_mocks.get_basic_config(feed_url=feed_url)
+        repo = mock.Mock(spec=Repository)
+        repo.id = "test_sync_groups_unchanged_metadata"
+        repo.working_dir = self.working_dir
+        self.simulate_sync(repo, repo_src_dir)
+
+        sync_conduit = importer_mocks.get_sync_conduit(pkg_dir=self.pkg_dir)
+        status, summary, details = ic.sync(repo, sync_conduit, config)
+        self.assertTrue(status)
+        self.assertEqual(summary["num_new_groups"], 3)
+        self.assertFalse("unchanged" in summary)
+        # the comps checksums in repomd.xml are the same on the next sync, nothing is parsed
+        get_available = mock.Mock(side_effect=comps.get_available)
+        with mock.patch("yum_importer.comps.get_available", get_available):
+            status, summary, details = ic.sync(repo, sync_conduit, config)
+        self.assertTrue(status)
+        self.assertTrue(summary["unchanged"])
+        self.assertEqual(summary["num_new_groups"], 0)
+        self.assertEqual(get_available.call_count, 0)
+
     def test_get_groups_metadata_file(self):
         repodata_dir = os.path.join(self.data_dir, "simple_repo_no_comps")
         md_file, md_type = comps.get_groups_metadata_file(repodata_dir)
@@ -0,0 +1,194 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2013 Red Hat, Inc.
+#
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+
+import mock
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)) + "/../../../plugins/importers/")
+import constants
+import rpm_support_base
+from pulp.plugins.model import Unit
+from pulp_rpm.common.ids import TYPE_ID_RPM
+from pulp_rpm.yum_plugin import depindex, depsolver, util
+
+
+def _unit(unit_id, name, metadata):
+    unit_key = {'name' : name, 'version' : '0.0.309', 'release' : '1.fc17', 'epoch' : '0', 'arch' : 'noarch',
+                'checksumtype' : 'sha256', 'checksum' : '%s-checksum' % name}
+    metadata = dict(metadata)
+    metadata[util.REPODATA_DIGEST] = util.get_repodata_digest(metadata.get('repodata'))
+    unit = Unit(TYPE_ID_RPM, unit_key, metadata, '')
+    unit.id = unit_id
+    return unit
+
+
+class TestDependencyIndex(rpm_support_base.PulpRPMTests):
+
+    def setUp(self):
+        super(TestDependencyIndex, self).setUp()
+        self.temp_dir = tempfile.mkdtemp()
+        self.server_unit = _unit('a', 'pulp-server', constants.PULP_SERVER_RPM_METADATA)
+        self.rpm_server_unit = _unit('b', 'pulp-rpm-server', constants.PULP_RPM_SERVER_RPM_METADATA)
+        self.index = depindex.DependencyIndex(os.path.join(self.temp_dir, "working", depindex.INDEX_FILE_NAME))
+
+    def tearDown(self):
+        super(TestDependencyIndex, self).tearDown()
+        self.index.close()
+        shutil.rmtree(self.temp_dir)
+
+    def get_conduit(self, units):
+        def get_units(criteria):
+            if criteria.unit_filters and '$or' in criteria.unit_filters:
+                # seeking past the last unit
+                return []
+            return units
+        conduit = mock.Mock()
+        conduit.get_units.side_effect = get_units
+        return conduit
+
+    def test_update(self):
+        conduit = self.get_conduit([self.server_unit, self.rpm_server_unit])
+        self.index.update(conduit)
+        self.assertEquals(self.index.unit_ids(), set(['a', 'b']))
+        # unchanged units are not fetched again once they are indexed
+        conduit.get_units.reset_mock()
+        self.index.update(conduit)
+        self.index.update(conduit, limit=1)
+        # only the ids and digests are looked up, a page at a time
+        self.assertEquals(conduit.get_units.call_count, 3)
+        for call in conduit.get_units.call_args_list:
+            self.assertFalse('repodata' in call[0][0].unit_fields)
+        self.assertEquals(conduit.get_units.call_args_list[2][0][0].unit_filters,
+                          util.form_seek_filter(self.rpm_server_unit.unit_key))
+
+        # units unassociated from the repo are dropped, and with them what they provide
+        self.index.update(self.get_conduit([self.rpm_server_unit]))
+        self.assertEquals(self.index.unit_ids(), set(['b']))
+        self.assertEquals(self.index.what_provides('pulp-server', None, (None, None, None)), [])
+
+        # the index persists
+        self.index.close()
+        self.index = depindex.DependencyIndex(self.index.path)
+        self.assertEquals(self.index.unit_ids(), set(['b']))
+
+    def test_update_rewritten_unit(self):
+        self.index.update(self.get_conduit([self.server_unit, self.rpm_server_unit]))
+        self.assertEquals(self.index.what_provides('/usr/share/pulp/rewritten', None, (None, None, None)), [])
+        # the repodata of a unit is rewritten in place, keeping its id
+        metadata = dict(constants.PULP_SERVER_RPM_METADATA)
+        metadata['repodata'] = dict(metadata['repodata'])
+        metadata['repodata']['filelists'] = '<package pkgid="pulp-server-checksum" name="pulp-server" arch="noarch">' \
+            '<version epoch="0" ver="0.0.309" rel="1.fc17"/><file>/usr/share/pulp/rewritten</file></package>'
+        rewritten_unit = _unit('a', 'pulp-server', metadata)
+        self.index.update(self.get_conduit([rewritten_unit, self.rpm_server_unit]))
+        self.assertEquals(self.index.unit_digests()['a'], depindex.unit_digest(rewritten_unit))
+        providers = self.index.what_provides('/usr/share/pulp/rewritten', None, (None, None, None))
+        self.assertEquals([p.name for p in providers], ['pulp-server'])
+        rows = self.index.connection.execute("SELECT unit_id FROM packages ORDER BY unit_id").fetchall()
+        self.assertEquals([row[0] for row in rows], ['a', 'b'])
+
+    def test_match_packages(self):
+        self.index.add_units([self.server_unit, self.rpm_server_unit])
+        for pattern in ['pulp-server', 'pulp-server.noarch', 'pulp-server-0.0.309-1.fc17.noarch',
+                        'pulp-server-0.0.309', 'pulp-server-0.0.309-1.fc17', '0:pulp-server-0.0.309-1.fc17.noarch',
+                        'pulp-server-0:0.0.309-1.fc17.noarch']:
+            packages = self.index.match_packages([pattern])
+            self.assertEquals([p.name for p in packages], ['pulp-server'])
+        self.assertEquals(self.index.match_packages(['pulp']), [])
+        self.assertEquals(self.index.match_packages(['pulp-server-0.0.310']), [])
+
+    def test_what_provides(self):
+        self.index.add_units([self.server_unit, self.rpm_server_unit])
+        providers = self.index.what_provides('pulp-server', 'EQ', ('0', '0.0.309', None))
+        self.assertEquals([p.name for p in providers], ['pulp-server'])
+        self.assertEquals(providers[0].checksums, [('sha256', 'pulp-server-checksum', 1)])
+        self.assertEquals(self.index.what_provides('pulp-server', 'GT', ('0', '0.0.309', None)), [])
+        # file requirements are looked up in the package file lists
+        providers = self.index.what_provides('/usr/bin/pulp-migrate', None, (None, None, None))
+        self.assertEquals([p.name for p in providers], ['pulp-server'])
+
+    def test_depsolver(self):
+        self.index.add_units([self.server_unit, self.rpm_server_unit])
+        dsolve = depsolver.DepSolver([], pkgs=['pulp-rpm-server-0.0.309-1.fc17.noarch'], index=self.index)
+        solved, unsolved = dsolve.processResults(dsolve.getDependencylist())
+        self.assertEquals(solved['pulp-server = 0.0.309'],
+            [('pulp-server', '0', '0.0.309', '1.fc17', 'noarch', 'sha256', 'pulp-server-checksum')])
+        self.assertTrue('pulp-rpm-plugins = 0.0.309' in unsolved)
+
+    def test_depsolver_recursive(self):
+        self.index.add_units([self.server_unit, self.rpm_server_unit])
+        dsolve = depsolver.DepSolver([], pkgs=['pulp-rpm-server'], index=self.index)
+        what_provides = mock.Mock(side_effect=self.index.what_provides)
+        self.index.what_provides = what_provides
+        results = dsolve.getRecursiveDepList()
+        self.assertEquals(sorted([p.name for p in results]), ['pulp-rpm-server', 'pulp-server'])
+        requirements = set()
+        for reqs in results.values():
+            requirements.update(reqs.keys())
+        # each requirement is looked up once
+        self.assertEquals(what_provides.call_count, len(requirements))
+
+        # the closures of several packages share one traversal and the memoized lookups
+        what_provides.reset_mock()
+        results = dsolve.getRecursiveDepList(pkgs=['pulp-server', 'pulp-rpm-server'])
+        self.assertEquals(len(results), 2)
+        self.assertEquals(what_provides.call_count, 0)
+        solved, unsolved = dsolve.processResults(results)
+        self.assertTrue('pulp-server = 0.0.309' in solved)
+        self.assertTrue('mongodb' in unsolved)
+
+    def test_concurrent_update(self):
+        path = self.index.path
+        errors = []
+        def update():
+            index = depindex.DependencyIndex(path)
+            try:
+                try:
+                    index.update(self.get_conduit([self.server_unit, self.rpm_server_unit]))
+                except Exception, e:
+                    errors.append(e)
+            finally:
+                index.close()
+        threads = [threading.Thread(target=update) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEquals(errors, [])
+        # each unit is indexed once
+        rows = self.index.connection.execute("SELECT unit_id FROM packages ORDER BY unit_id").fetchall()
+        self.assertEquals([row[0] for row in rows], ['a', 'b'])
+
+    def test_filelists_files(self):
+        metadata = dict(constants.PULP_SERVER_RPM_METADATA)
+        metadata['repodata'] = dict(metadata['repodata'])
+        metadata['repodata']['filelists'] = '<package pkgid="pulp-server-checksum" name="pulp-server" arch="noarch">' \
+            '<version epoch="0" ver="0.0.309" rel="1.fc17"/><file>/usr/share/pulp/not-in-primary</file></package>'
+        self.index.add_units([_unit('a', 'pulp-server', metadata)])
+        providers = self.index.what_provides('/usr/share/pulp/not-in-primary', None, (None, None, None))
+        self.assertEquals([p.name for p in providers], ['pulp-server'])
+
+    def test_unreadable_index(self):
+        self.index.close()
+        f = open(self.index.path, "w")
+        f.write("not a database" * 100)
+        f.close()
+        self.index = depindex.DependencyIndex(self.index.path)
+        self.assertEquals(self.index.unit_ids(), set())
+
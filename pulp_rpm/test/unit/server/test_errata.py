@@ -136,10 +136,9 @@ class TestErrata(rpm_support_base.PulpRPMTests):
         self.assertEquals(details_2["num_security_errata"], 7)
         self.assertEquals(details_2["num_enhancement_errata"], 9)
 
-        # There should be the same number of calls to save_unit() as there are errata,
-        # because sync() calls it once for each of the 51 new erratum, and get_new_errata_units()
-        # also calls it once for the one errata that already existed
-        self.assertEqual(len(sync_conduit_2.save_unit.mock_calls), 52)
+        # sync() calls save_unit() once for each of the 51 new errata; the one errata that
+        # already existed is associated with the repo and unchanged, so it is not saved again
+        self.assertEqual(len(sync_conduit_2.save_unit.mock_calls), 51)
 
     def test_get_available_errata(self):
         errata_items_found = errata.get_available_errata(self.repo_dir)
@@ -195,6 +194,22 @@ class TestErrata(rpm_support_base.PulpRPMTests):
         # Assert that save_unit was called with the pre-existing errata
         self.assertEqual(sync_conduit.save_unit.mock_calls[0][1][0], existing_units[0])
 
+    def test_get_new_errata_units_skips_associated_units(self):
+        available_errata = errata.get_available_errata(self.repo_dir)
+        unit_key = {'id': "RHBA-2007:0112"}
+        metadata = {'updated' : "2007-03-14 00:00:00",
+                    'pkglist': [{'name': 'RHEL Virtualization (v. 5 for 32-bit x86)'}]}
+        existing_units = [Unit(TYPE_ID_ERRATA, unit_key, metadata, '')]
+        sync_conduit = importer_mocks.get_sync_conduit(existing_units=existing_units)
+        existing_errata = errata.get_existing_errata(sync_conduit)
+        new_errata, new_units, sync_conduit = errata.get_new_errata_units(available_errata,
+            sync_conduit, existing_errata=existing_errata)
+        self.assertEquals(len(new_errata), len(available_errata) - 1)
+        # the existing errata are looked up in one query
+        self.assertEqual(len(sync_conduit.search_all_units.mock_calls), 1)
+        # the unchanged erratum is already associated with the repo and is not saved again
+        self.assertEqual(len(sync_conduit.save_unit.mock_calls), 0)
+
     def test_update_errata_units(self):
         # existing errata is older than available; should purge and resync
         available_errata = errata.get_available_errata(self.repo_dir)
@@ -234,6 +249,44 @@ class TestErrata(rpm_support_base.PulpRPMTests):
         status, summary, details = importerErrata.sync(repo, sync_conduit, config)
         self.assertEquals(len(details['link_report']['linked_units']), 2)
 
+    def test_link_errata_rpm_units_lookup(self):
+        unit_key_a = {'name' :'patb', 'version' :'0.1', 'release' : '2', 'epoch':'0', 'arch' : 'noarch',
+                      'checksumtype' : 'sha', 'checksum': '017c12050a97cf6095892498750c2a39d2bf535e'}
+        unit_key_b = {'name' :'emoticons', 'version' :'0.1', 'release' :'2', 'epoch':'0','arch' : 'noarch',
+                      'checksumtype' :'sha', 'checksum' : '663c89b0d29bfd5479d8736b716d50eed9495dbb'}
+        rpm_units = [Unit(TYPE_ID_RPM, unit_key, {}, '') for unit_key in [unit_key_a, unit_key_b]]
+
+        def pinfo(unit_key):
+            info = dict(unit_key)
+            info['sum'] = (info.pop('checksumtype'), info.pop('checksum'))
+            return info
+        missing = pinfo(unit_key_b)
+        missing['version'] = '0.2'
+        no_sum = pinfo(unit_key_a)
+        del no_sum['sum']
+        # patb is listed in two collections of the erratum and linked once
+        pkglist = [{'packages' : [pinfo(unit_key_a), missing, no_sum]},
+                   {'packages' : [pinfo(unit_key_a), pinfo(unit_key_b)]}]
+        erratum = Unit(TYPE_ID_ERRATA, {'id' : 'RHEA-2010:9999'}, {'pkglist' : pkglist}, '')
+
+        sync_conduit = importer_mocks.get_sync_conduit(existing_units=rpm_units)
+        link_report = errata.link_errata_rpm_units(sync_conduit, {'RHEA-2010:9999' : erratum})
+        self.assertEquals(link_report['num_linked'], 2)
+        self.assertEquals(link_report['num_skipped'], 2)
+        self.assertEquals(link_report['missing_rpms'], [missing])
+        self.assertEquals(sync_conduit.link_unit.call_count, 2)
+        # the rpms are looked up once, projected to their unit key
+        self.assertEquals(sync_conduit.get_units.call_count, 1)
+        criteria = sync_conduit.get_units.call_args[0][0]
+        self.assertEquals(sorted(criteria.unit_fields), sorted(importer_rpm.RPM_UNIT_KEY))
+        self.assertEquals(criteria.unit_filters, {'name' : {'$in' : ['emoticons', 'patb']}})
+
+        # nothing to look up without errata
+        sync_conduit.get_units.reset_mock()
+        link_report = errata.link_errata_rpm_units(sync_conduit, {})
+        self.assertEquals(link_report['num_linked'], 0)
+        self.assertEquals(sync_conduit.get_units.call_count, 0)
+
     def test_link_errata_rpm_units_with_bad_data(self):
         # Tests against EPEL Fedora 6 errata info which lacks checksum info for package list entries
         repo_src_dir = os.path.join(self.data_dir, "test_epel_errata_info")
@@ -30,6 +30,7 @@ from pulp_rpm.yum_plugin import comps_util, util, updateinfo
 
 import profiler_mocks
 import rpm_support_base
+from rpm_errata_profiler import profiler
 from rpm_errata_profiler.profiler import RPMErrataProfiler
 
 class TestErrataProfiler(rpm_support_base.PulpRPMTests):
@@ -243,3 +244,149 @@ class TestErrataProfiler(rpm_support_base.PulpRPMTests):
 
 
 
+
+    def get_errata_unit(self, eid, rpms, updated="2010-01-01 00:00:00"):
+        pkglist = [{"packages" : rpms}]
+        return Unit(TYPE_ID_ERRATA, {"id" : eid}, {"pkglist" : pkglist, "updated" : updated}, None)
+
+    def test_units_applicable_fleet(self):
+        emoticons = self.create_profile_entry("emoticons", "0", "0.1", "2", "x86_64", "Test Vendor")
+        patb = self.create_profile_entry("patb", "0", "0.1", "2", "x86_64", "Test Vendor")
+        errata_units = [self.get_errata_unit("RHEA-2010:0001", [emoticons]),
+                        self.get_errata_unit("RHEA-2010:0002", [patb])]
+        test_repo = profiler_mocks.get_repo("test_repo_id")
+        conduit = profiler_mocks.get_profiler_conduit(existing_units=errata_units, repo_bindings=[test_repo])
+        unit_keys = [u.unit_key for u in errata_units] + [{"id" : "missing"}]
+        # same profile, listed in another order
+        consumer_copy = Consumer("copy", {TYPE_ID_RPM : list(reversed(self.profiles[TYPE_ID_RPM]))})
+        consumer_repos = [(self.test_consumer, ["test_repo_id"]), (consumer_copy, ["test_repo_id"]),
+                          (self.test_consumer_been_updated, ["test_repo_id"]),
+                          (self.test_consumer_i386, [])]
+
+        prof = RPMErrataProfiler()
+        cache = profiler.ApplicabilityCache()
+        reports = prof.units_applicable_fleet(consumer_repos, TYPE_ID_ERRATA, unit_keys, None, conduit,
+                                              cache=cache)
+        self.assertEquals(len(reports[self.consumer_id]), 2)
+        self.assertEquals(reports[self.consumer_id][0].details["applicable_rpms"],
+                          [{"unit_key" : {"name" : "emoticons.x86_64"}, "type_id" : TYPE_ID_RPM}])
+        self.assertTrue(reports["copy"] is reports[self.consumer_id])
+        self.assertEquals(reports[self.consumer_id_been_updated], [])
+        self.assertEquals(reports[self.consumer_id_i386], [])
+        # the errata are looked up once per profile, narrowed to its packages
+        self.assertEquals(conduit.get_units.call_count, 4)
+        for call in conduit.get_units.call_args_list:
+            criteria = call[0][1]
+            self.assertEquals(criteria.unit_filters[util.ERRATUM_PACKAGE_KEYS],
+                              {"$in" : ["emoticons x86_64", "patb x86_64"]})
+
+        # the cached results are used while the errata are unchanged, only the ids and
+        # updated dates of the errata are fetched
+        cached_reports = reports[self.consumer_id]
+        conduit.get_units.reset_mock()
+        reports = prof.units_applicable_fleet([(consumer_copy, ["test_repo_id"])], TYPE_ID_ERRATA, unit_keys,
+                                              None, conduit, cache=cache)
+        self.assertEquals(len(reports["copy"]), 2)
+        self.assertTrue(reports["copy"][0] is cached_reports[0])
+        self.assertEquals(conduit.get_units.call_count, 1)
+        self.assertEquals(conduit.get_units.call_args[0][1].unit_fields, ["id", "updated"])
+        # and computed again once an erratum is replaced by a newer one
+        patb_newer = self.create_profile_entry("patb", "0", "0.2", "1", "x86_64", "Test Vendor")
+        errata_units[1].metadata["pkglist"] = [{"packages" : [patb_newer]}]
+        errata_units[1].metadata["updated"] = "2010-02-01 00:00:00"
+        reports = prof.units_applicable_fleet([(consumer_copy, ["test_repo_id"])], TYPE_ID_ERRATA, unit_keys,
+                                              None, conduit, cache=cache)
+        self.assertEquals(len(reports["copy"]), 2)
+        self.assertFalse(reports["copy"][1] is cached_reports[1])
+        self.assertEquals(reports["copy"][1].details["upgrade_details"]["patb x86_64"]["available"], patb_newer)
+
+    def test_units_applicable_fleet_entry_order(self):
+        # the same kernels listed in opposite order; the last one listed is looked up
+        kernel_old = self.create_profile_entry("kernel", "0", "2.6.32", "1", "x86_64", "Test Vendor")
+        kernel_new = self.create_profile_entry("kernel", "0", "2.6.32", "2", "x86_64", "Test Vendor")
+        errata_units = [self.get_errata_unit("RHSA-2010:0001", [kernel_new])]
+        test_repo = profiler_mocks.get_repo("test_repo_id")
+        conduit = profiler_mocks.get_profiler_conduit(existing_units=errata_units, repo_bindings=[test_repo])
+        unit_keys = [u.unit_key for u in errata_units]
+        consumer_old = Consumer("old", {TYPE_ID_RPM : [kernel_new, kernel_old]})
+        consumer_new = Consumer("new", {TYPE_ID_RPM : [kernel_old, kernel_new]})
+        kernel_other = dict(kernel_old, vendor="Other Vendor")
+        consumer_other = Consumer("other", {TYPE_ID_RPM : [kernel_new, kernel_other]})
+
+        prof = RPMErrataProfiler()
+        cache = profiler.ApplicabilityCache()
+        consumer_repos = [(consumer_old, ["test_repo_id"]), (consumer_new, ["test_repo_id"]),
+                          (consumer_other, ["test_repo_id"])]
+        reports = prof.units_applicable_fleet(consumer_repos, TYPE_ID_ERRATA, unit_keys, None, conduit,
+                                              cache=cache)
+        self.assertEquals(len(reports["old"]), 1)
+        self.assertEquals(reports["new"], [])
+        self.assertEquals(len(reports["other"]), 1)
+        self.assertFalse(reports["other"] is reports["old"])
+        upgrade_details = reports["other"][0].details["upgrade_details"]
+        self.assertEquals([d["installed"]["vendor"] for d in upgrade_details.values()], ["Other Vendor"])
+        # the cached results of one order are not handed to the other
+        reports = prof.units_applicable_fleet([(consumer_new, ["test_repo_id"])], TYPE_ID_ERRATA, unit_keys,
+                                              None, conduit, cache=cache)
+        self.assertEquals(reports["new"], [])
+
+    def test_units_applicable_cached(self):
+        errata_obj = self.get_test_errata_object()
+        errata_unit = Unit(TYPE_ID_ERRATA, {"id":errata_obj["id"]}, errata_obj, None)
+        test_repo = profiler_mocks.get_repo("test_repo_id")
+        conduit = profiler_mocks.get_profiler_conduit(existing_units=[errata_unit], repo_bindings=[test_repo])
+        prof = RPMErrataProfiler()
+        with mock.patch.object(profiler, "_applicability_cache", profiler.ApplicabilityCache()):
+            report_list = prof.units_applicable(self.test_consumer, ["test_repo_id"], TYPE_ID_ERRATA,
+                                                [errata_unit.unit_key], None, conduit)
+            self.assertEquals(len(report_list), 1)
+            # another consumer with the same packages is handed the cached report
+            consumer_copy = Consumer("copy", {TYPE_ID_RPM : list(self.profiles[TYPE_ID_RPM])})
+            conduit.get_units.reset_mock()
+            cached_list = prof.units_applicable(consumer_copy, ["test_repo_id"], TYPE_ID_ERRATA,
+                                                [errata_unit.unit_key], None, conduit)
+            self.assertTrue(cached_list[0] is report_list[0])
+            self.assertEquals(conduit.get_units.call_count, 1)
+            self.assertEquals(conduit.get_units.call_args[0][1].unit_fields, ["id", "updated"])
+
+    def test_applicability_cache_max_entries(self):
+        cache = profiler.ApplicabilityCache(max_entries=2)
+        for key in ["a", "b", "c"]:
+            cache.update(key, {"RHEA-2010:0001" : None})
+        self.assertEquals(cache.get("a"), {})
+        self.assertEquals(cache.get("c"), {"RHEA-2010:0001" : None})
+
+    def test_translate_units_errata_query(self):
+        emoticons = self.create_profile_entry("emoticons", "0", "0.1", "2", "x86_64", "Test Vendor")
+        patb = self.create_profile_entry("patb", "0", "0.1", "2", "x86_64", "Test Vendor")
+        patb_installed = self.create_profile_entry("patb", "0", "0.0.1", "1", "x86_64", "Test Vendor")
+        errata_units = [self.get_errata_unit("RHEA-2010:0001", [emoticons, patb]),
+                        self.get_errata_unit("RHEA-2010:0002", [patb_installed])]
+        conduit = profiler_mocks.get_profiler_conduit(existing_units=errata_units, repo_bindings=["test_repo_id"])
+        units = [{"unit_key" : u.unit_key, "type_id" : TYPE_ID_ERRATA} for u in errata_units]
+        prof = RPMErrataProfiler()
+        translated_units = prof.translate_units(units, self.test_consumer, conduit)
+        self.assertEquals([u["unit_key"]["name"] for u in translated_units], ["emoticons.x86_64", "patb.x86_64"])
+        # the errata are looked up with one query, for those listing an installed package
+        self.assertEquals(conduit.get_units.call_count, 1)
+        criteria = conduit.get_units.call_args[0][1]
+        self.assertEquals(criteria.unit_filters,
+                          {"id" : {"$in" : ["RHEA-2010:0001", "RHEA-2010:0002"]},
+                           util.ERRATUM_PACKAGE_KEYS : {"$in" : ["emoticons x86_64", "patb x86_64"]}})
+        self.assertEquals(prof.translate_units(units, Consumer("test", {}), conduit), [])
+
+    def test_erratum_package_index(self):
+        emoticons = self.create_profile_entry("emoticons", "0", "0.1", "2", "x86_64", "Test Vendor")
+        patb = self.create_profile_entry("patb", "0", "0.1", "2", "x86_64", "Test Vendor")
+        package_index = profiler.ErratumPackageIndex()
+        package_index.add("RHEA-2010:0001", [patb, emoticons])
+        package_index.add("RHEA-2010:0002", [patb])
+        lookup = RPMErrataProfiler().form_lookup_table(self.profiles[TYPE_ID_RPM])
+        applicable = package_index.applicable(lookup)
+        self.assertEquals(sorted(applicable.keys()), ["RHEA-2010:0001", "RHEA-2010:0002"])
+        applicable_rpms, upgrade_details = applicable["RHEA-2010:0001"]
+        self.assertEquals(applicable_rpms, [patb, emoticons])
+        self.assertEquals(upgrade_details["patb x86_64"]["installed"]["version"], "0.0.1")
+        self.assertEquals(package_index.applicable(lookup, set(["RHEA-2010:0002"])).keys(), ["RHEA-2010:0002"])
+        self.assertEquals(package_index.applicable(RPMErrataProfiler().form_lookup_table(
+            self.profiles_been_updated[TYPE_ID_RPM])), {})
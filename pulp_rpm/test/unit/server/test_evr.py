@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2013 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)) + "/../../../src/")
+from pulp_rpm.yum_plugin import evr
+
+# (a, b, rpmvercmp(a, b)), from rpm's own rpmvercmp test cases
+RPMVERCMP_CASES = [
+    ("1.0", "1.0", 0),
+    ("1.0", "2.0", -1),
+    ("2.0.1", "2.0.1", 0),
+    ("2.0", "2.0.1", -1),
+    ("2.0.1a", "2.0.1a", 0),
+    ("2.0.1a", "2.0.1", 1),
+    ("5.5p1", "5.5p2", -1),
+    ("5.5p10", "5.5p1", 1),
+    ("10xyz", "10.1xyz", -1),
+    ("xyz10", "xyz10.1", -1),
+    ("xyz.4", "8", -1),
+    ("xyz.4", "2", -1),
+    ("5.5p2", "5.6p1", -1),
+    ("5.6p1", "6.5p1", -1),
+    ("6.0.rc1", "6.0", 1),
+    ("10b2", "10a1", 1),
+    ("1.0aa", "1.0a", 1),
+    ("10.0001", "10.1", 0),
+    ("10.0001", "10.0039", -1),
+    ("4.999.9", "5.0", -1),
+    ("20101121", "20101122", -1),
+    ("2_0", "2_0", 0),
+    ("2.0", "2_0", 0),
+    ("a", "a", 0),
+    ("a+", "a_", 0),
+    ("+", "_", 0),
+    ("1.0~rc1", "1.0~rc1", 0),
+    ("1.0~rc1", "1.0", -1),
+    ("1.0~rc1", "1.0~rc2", -1),
+    ("1.0~rc1~git123", "1.0~rc1", -1),
+    ("1.0^", "1.0^", 0),
+    ("1.0^", "1.0", 1),
+    ("1.0^git1", "1.0", 1),
+    ("1.0^git1", "1.0^git2", -1),
+    ("1.0^git1", "1.01", -1),
+    ("1.0^20160101", "1.0.1", -1),
+    ("1.0^20160101^git1", "1.0^20160101", 1),
+    ("1.0~rc1^git1", "1.0~rc1", 1),
+    ("1.0^git1~pre", "1.0^git1", -1),
+]
+
+
+class TestEVR(unittest.TestCase):
+
+    def test_rpmvercmp(self):
+        for a, b, expected in RPMVERCMP_CASES:
+            self.assertEquals(evr.rpmvercmp(a, b), expected, "%s %s" % (a, b))
+            self.assertEquals(evr.rpmvercmp(b, a), -expected, "%s %s" % (b, a))
+
+    def test_compare_evr(self):
+        self.assertEquals(evr.compare_evr(("0", "1.0", "1.el6"), ("0", "1.0", "1.el6")), 0)
+        self.assertEquals(evr.compare_evr((None, "1.0", "1.el6"), ("0", "1.0", "1.el6")), 0)
+        self.assertEquals(evr.compare_evr(("1", "1.0", "1.el6"), ("0", "2.0", "1.el6")), 1)
+        self.assertEquals(evr.compare_evr((0, "1.0", "1.el6"), (0, "1.0", "2.el6")), -1)
+
+    def test_sort_and_newest(self):
+        rpms = [{"name" : "pulp", "arch" : "noarch", "epoch" : "0", "version" : v, "release" : "1"}
+                for v in ["1.10", "1.9", "1.9^git1", "1.10~rc1"]]
+        self.assertEquals([r["version"] for r in evr.sort_rpms(rpms)], ["1.9", "1.9^git1", "1.10~rc1", "1.10"])
+        newest = evr.newest_rpms(rpms + [dict(rpms[0], arch="x86_64")])
+        self.assertEquals(newest[("pulp", "noarch")]["version"], "1.10")
+        self.assertEquals(newest[("pulp", "x86_64")]["version"], "1.10")
+
+    def test_key_cache(self):
+        orig = evr.MAX_CACHED_KEYS
+        evr.MAX_CACHED_KEYS = 2
+        try:
+            evr._key_cache.clear()
+            self.assertTrue(evr.vercmp_key("1.0") is evr.vercmp_key("1.0"))
+            evr.vercmp_key("2.0")
+            evr.vercmp_key("3.0")
+            self.assertEquals(len(evr._key_cache), 1)
+        finally:
+            evr.MAX_CACHED_KEYS = orig
+            evr._key_cache.clear()
@@ -390,6 +390,35 @@ class TestImportUnits(rpm_support_base.PulpRPMTests):
         for u in associated_units:
             self.assertTrue(u in [cat_a, grp_a])
 
+    def test_package_category_units_bulk_import(self):
+        repoA = mock.Mock(spec=Repository)
+        repoA.id = "test_pkg_cat_unit_copy"
+        repoB = mock.Mock(spec=Repository)
+        repoB.id = "repoB"
+        grp_a = self.create_dummy_pkg_group_unit(repoA.id, "group_a")
+        grp_b = self.create_dummy_pkg_group_unit(repoA.id, "group_b")
+        grp_b.metadata['mandatory_package_names'] = ["pkg_b"]
+        cat_a = self.create_dummy_pkg_category_unit(repoA.id, "cat_a", ["group_a"])
+        cat_b = self.create_dummy_pkg_category_unit(repoA.id, "cat_b", ["group_a", "group_b"])
+        rpms = []
+        for name, version in [("pkg_b", "1"), ("pkg_b", "2"), ("pkg_c", "1")]:
+            unit_key = {'name' : name, 'version' : version, 'release' : '1', 'epoch' : '0', 'arch' : 'noarch',
+                        'checksumtype' : 'sha256', 'checksum' : "%s-%s" % (name, version)}
+            rpms.append(Unit(TYPE_ID_RPM, unit_key, {}, ''))
+        conduit = importer_mocks.get_import_conduit([grp_a, grp_b, cat_a, cat_b] + rpms,
+            existing_units=[grp_a, grp_b, cat_a, cat_b] + rpms)
+        config = importer_mocks.get_basic_config()
+        importer = YumImporter()
+        # Test
+        importer.import_units(repoA, repoB, conduit, config, [cat_a, cat_b])
+        # Verify
+        # the groups of both categories and the packages of both groups are looked up once each
+        self.assertEqual(conduit.get_source_units.call_count, 2)
+        associated_units = [mock_call[0][0] for mock_call in conduit.associate_unit.call_args_list]
+        self.assertEqual(len(associated_units), 3)
+        for u in [grp_a, grp_b, rpms[1]]:
+            self.assertTrue(u in associated_units)
+
     def test_package_group_unit_import(self):
         # REPO A (source)
         repoA = mock.Mock(spec=Repository)
@@ -512,6 +541,28 @@ class TestImportUnits(rpm_support_base.PulpRPMTests):
         for u in verify_old_version_skipped:
             self.assertFalse(u in associated_units)
 
+    def test_blacklist_units(self):
+        unit_key_a = {'name' : 'pata', 'version' : '1', 'release' : '1', 'epoch' : '0', 'arch' : 'noarch',
+                      'checksumtype' : 'sha256', 'checksum' : 'a'}
+        unit_key_b = dict(unit_key_a, name='patb', checksum='b')
+        units = [Unit(TYPE_ID_RPM, unit_key_a, {'filename' : 'pata-1-1.noarch.rpm'}, ''),
+                 Unit(TYPE_ID_RPM, unit_key_b, {'filename' : 'patb-1-1.noarch.rpm'}, '')]
+        repoA = mock.Mock(spec=Repository)
+        repoA.id = "repoA"
+        repoB = mock.Mock(spec=Repository)
+        repoB.id = "repoB"
+        conduit = importer_mocks.get_import_conduit(units, existing_units=units)
+        conduit.get_source_units = mock.Mock(return_value=[units[1]])
+        config = importer_mocks.get_basic_config(blacklist=['patb', 'patc'])
+        importer = YumImporter()
+        importer.import_units(repoA, repoB, conduit, config, units)
+        # the patterns are looked up in a single query
+        self.assertEqual(conduit.get_source_units.call_count, 1)
+        criteria = conduit.get_source_units.call_args[1]['criteria']
+        self.assertEqual(criteria.unit_filters, {'filename' : {'$regex' : '(?:patb)|(?:patc)'}})
+        associated_units = [mock_call[0][0] for mock_call in conduit.associate_unit.call_args_list]
+        self.assertEqual(associated_units, [units[0]])
+
 
 class TestImportDependencies(rpm_support_base.PulpRPMTests):
 
@@ -624,4 +675,29 @@ class TestImportDependencies(rpm_support_base.PulpRPMTests):
         associated_units = [mock_call[0][0] for mock_call in conduit.associate_unit.call_args_list]
         self.assertEqual(len(associated_units), len(existing_units))
         for u in associated_units:
-            self.assertTrue(u in existing_units + units)
\ No newline at end of file
+            self.assertTrue(u in existing_units + units)
+
+    def test_import_resolves_dependencies_once(self):
+        # Setup
+        existing_units = self.existing_units()
+        repoA = mock.Mock(spec=Repository)
+        repoA.working_dir = "/tmp/test_resolve_deps"
+        repoA.id = "test_resolve_deps"
+        repoB = mock.Mock(spec=Repository)
+        repoB.working_dir = "/tmp/test_resolve_deps"
+        repoB.id = "repo_b"
+        units = [Unit(TYPE_ID_RPM, self.UNIT_KEY_A, {}, ''), Unit(TYPE_ID_RPM, self.UNIT_KEY_B, {}, '')]
+        conduit = importer_mocks.get_import_conduit(units, existing_units=existing_units)
+        config = importer_mocks.get_basic_config()
+        config.override_config['recursive'] = True
+        config.override_config['resolve_dependencies'] = True
+        importer = YumImporter()
+        importer.resolve_dependencies = mock.Mock(side_effect=importer.resolve_dependencies)
+        # Test
+        importer.import_units(repoA, repoB, conduit, config, units)
+        # Verify
+        self.assertEqual(importer.resolve_dependencies.call_count, 1)
+        self.assertEqual(len(importer.resolve_dependencies.call_args[0][1]), 2)
+        # the dependency between the imported units is not associated again
+        associated_units = [mock_call[0][0] for mock_call in conduit.associate_unit.call_args_list]
+        self.assertEqual(associated_units, units)
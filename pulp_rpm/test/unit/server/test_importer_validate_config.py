@@ -153,6 +153,21 @@ class TestValidateConfig(rpm_support_base.PulpRPMTests):
         state, msg = self.importer.validate_config(self.repo, config, [])
         self.assertTrue(state)
 
+    def test_config_verify_checksum_cache(self):
+        feed_url = "http://example.redhat.com/"
+        config = importer_mocks.get_basic_config(feed_url=feed_url, verify_checksum_cache="fake_bool")
+        state, msg = self.importer.validate_config(self.repo, config, [])
+        self.assertFalse(state)
+
+        config = importer_mocks.get_basic_config(feed_url=feed_url, verify_checksum_max_age=-1)
+        state, msg = self.importer.validate_config(self.repo, config, [])
+        self.assertFalse(state)
+
+        config = importer_mocks.get_basic_config(feed_url=feed_url, verify_checksum=True,
+            verify_checksum_cache=True, verify_checksum_max_age=30)
+        state, msg = self.importer.validate_config(self.repo, config, [])
+        self.assertTrue(state)
+
     def test_config_verify_size(self):
         feed_url = "http://example.redhat.com/"
         verify_size = "fake_bool"
@@ -248,3 +263,28 @@ class TestValidateConfig(rpm_support_base.PulpRPMTests):
         config = importer_mocks.get_basic_config(feed_url=feed_url, skip=skip_content_types)
         state, msg = self.importer.validate_config(self.repo, config, [])
         self.assertTrue(state)
+
+    def test_config_native_download(self):
+        feed_url = "http://example.redhat.com/"
+        config = importer_mocks.get_basic_config(feed_url=feed_url, native_download="fake_bool")
+        state, msg = self.importer.validate_config(self.repo, config, [])
+        self.assertFalse(state)
+
+        config = importer_mocks.get_basic_config(feed_url=feed_url, native_download=True,
+            max_downloads_per_host=4, max_in_flight_bytes=1024)
+        state, msg = self.importer.validate_config(self.repo, config, [])
+        self.assertTrue(state)
+
+        config = importer_mocks.get_basic_config(feed_url=feed_url, max_downloads_per_host=0)
+        state, msg = self.importer.validate_config(self.repo, config, [])
+        self.assertFalse(state)
+
+    def test_config_force_full_sync(self):
+        feed_url = "http://example.redhat.com/"
+        config = importer_mocks.get_basic_config(feed_url=feed_url, force_full_sync="fake_bool")
+        state, msg = self.importer.validate_config(self.repo, config, [])
+        self.assertFalse(state)
+
+        config = importer_mocks.get_basic_config(feed_url=feed_url, force_full_sync=True)
+        state, msg = self.importer.validate_config(self.repo, config, [])
+        self.assertTrue(state)
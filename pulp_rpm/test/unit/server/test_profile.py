@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2013 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)) + "/../../../src/")
+from pulp_rpm.common import profile
+
+
+class TestProfileHash(unittest.TestCase):
+
+    def entry(self, name, version, vendor="Test Vendor"):
+        return {"name" : name, "epoch" : 0, "version" : version, "release" : "1",
+                "arch" : "x86_64", "vendor" : vendor}
+
+    def test_profile_hash(self):
+        rpms = [self.entry("emoticons", "0.1"), self.entry("patb", "0.1")]
+        digest = profile.profile_hash(rpms)
+        # independent of the order of the entries and of fields other than the nevra
+        self.assertEquals(profile.profile_hash(list(reversed(rpms))), digest)
+        self.assertEquals(profile.profile_hash([self.entry("emoticons", "0.1", vendor="Other"),
+                                                self.entry("patb", "0.1")]), digest)
+        self.assertNotEquals(profile.profile_hash([self.entry("emoticons", "0.2"),
+                                                   self.entry("patb", "0.1")]), digest)
+        self.assertNotEquals(profile.profile_hash(rpms[:1]), digest)
+
+
+class TestRPMProfile(unittest.TestCase):
+
+    def entry(self, name, version, arch="x86_64"):
+        return {u"name" : name, u"epoch" : 0, u"version" : version, u"release" : u"1",
+                u"arch" : arch, u"vendor" : u"Test Vendor"}
+
+    def test_rpm_profile(self):
+        rpms = [self.entry(u"emoticons", u"0.1"), self.entry(u"kernel", u"2.6.32"),
+                self.entry(u"kernel", u"2.6.33"), self.entry(u"kernel", u"2.6.33", arch=u"i686")]
+        rpm_profile = profile.RPMProfile(rpms)
+        self.assertEquals(len(rpm_profile), 4)
+        self.assertEquals(rpm_profile.to_list(), rpms)
+        self.assertEquals(profile.profile_hash(rpm_profile), profile.profile_hash(rpms))
+        # the last package of a name and arch is the one looked up
+        self.assertEquals(sorted(rpm_profile.lookup.keys()), ["emoticons x86_64", "kernel i686", "kernel x86_64"])
+        installed = rpm_profile.lookup["kernel x86_64"]
+        self.assertEquals(installed["version"], "2.6.33")
+        self.assertEquals(installed.get("release"), "1")
+        self.assertEquals(installed.get("buildhost"), None)
+        self.assertRaises(KeyError, installed.__getitem__, "buildhost")
+
+    def test_shared_values(self):
+        first = profile.RPMProfile([self.entry(u"emoticons", u"0.1")])
+        second = profile.RPMProfile([self.entry(u"emoticons", u"0.1")])
+        self.assertTrue(first.packages[0].evr is second.packages[0].evr)
+        self.assertTrue(first.packages[0].name is second.packages[0].name)
+        self.assertEquals(first.packages[0], second.packages[0])
+        self.assertTrue(profile.intern_value("x86_64") is intern("x86_64"))
+
+    def test_shared_values_max(self):
+        orig = profile.MAX_SHARED_VALUES
+        profile.MAX_SHARED_VALUES = 2
+        try:
+            profile._shared.clear()
+            for version in [u"0.1", u"0.2", u"0.3"]:
+                profile.intern_value(version)
+            self.assertEquals(len(profile._shared), 1)
+        finally:
+            profile.MAX_SHARED_VALUES = orig
+            profile._shared.clear()
+
+    def test_load_rpm_profile(self):
+        rpms = [self.entry(u"emoticons", u"0.1")]
+        profiles = {"rpm" : rpms}
+        refcount = sys.getrefcount(rpms)
+        rpm_profile = profile.load_rpm_profile(profiles)
+        self.assertTrue(isinstance(rpm_profile, profile.RPMProfile))
+        self.assertEquals(rpm_profile.to_list(), rpms)
+        # the consumer profiles are left alone and the entries are not kept
+        self.assertTrue(profiles["rpm"] is rpms)
+        self.assertEquals(sys.getrefcount(rpms), refcount)
+        self.assertTrue(profile.load_rpm_profile({"rpm" : rpm_profile}) is rpm_profile)
+        self.assertEquals(profile.load_rpm_profile({}), None)
+
+
+class TestProfileDelta(unittest.TestCase):
+
+    def entry(self, name, version, release="1"):
+        return {"name" : name, "epoch" : 0, "version" : version, "release" : release,
+                "arch" : "x86_64", "vendor" : "Test Vendor"}
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.base = [self.entry("emoticons", "0.1"), self.entry("kernel", "2.6.32"),
+                     self.entry("kernel", "2.6.33"), self.entry("patb", "0.1")]
+        self.current = [self.entry("kernel", "2.6.33"), self.entry("emoticons", "0.1"),
+                        self.entry("kernel", "2.6.34"), self.entry("patb", "0.2")]
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_profile_delta(self):
+        delta = profile.profile_delta(self.base, self.current)
+        self.assertTrue(profile.is_profile_delta(delta))
+        self.assertFalse(profile.is_profile_delta(self.current))
+        self.assertEquals(delta[profile.DELTA_BASE_HASH], profile.profile_hash(self.base))
+        self.assertEquals(delta[profile.DELTA_ADDED], [self.entry("kernel", "2.6.34"), self.entry("patb", "0.2")])
+        self.assertEquals([e["version"] for e in delta[profile.DELTA_REMOVED]], ["2.6.32", "0.1"])
+        rpms = profile.apply_profile_delta(self.base, delta)
+        self.assertEquals(profile.profile_hash(rpms), profile.profile_hash(self.current))
+        # applies to the compact form of the stored profile too
+        rpms = profile.apply_profile_delta(profile.RPMProfile(self.base), delta)
+        self.assertEquals(profile.profile_hash(rpms), profile.profile_hash(self.current))
+        # not based on the stored profile
+        self.assertRaises(profile.InvalidProfileDelta, profile.apply_profile_delta, self.current, delta)
+
+    def test_profile_record(self):
+        record = profile.ProfileRecord(os.path.join(self.temp_dir, "consumer", "rpm_profile.json"))
+        self.assertEquals(record.load("consumer_a"), None)
+        # nothing recorded, the whole profile is uploaded
+        self.assertTrue(record.form_upload("consumer_a", self.base) is self.base)
+        record.save("consumer_a", self.base)
+        self.assertEquals(record.load("consumer_a"), self.base)
+        self.assertEquals(record.load("consumer_b"), None)
+        delta = record.form_upload("consumer_a", self.current)
+        self.assertEquals(profile.profile_hash(profile.apply_profile_delta(self.base, delta)),
+                          profile.profile_hash(self.current))
+        record.clear()
+        self.assertEquals(record.load("consumer_a"), None)
+
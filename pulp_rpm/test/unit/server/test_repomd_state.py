@@ -0,0 +1,61 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2013 Red Hat, Inc.
+#
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)) + "/../../../plugins/importers/")
+import importer_mocks
+import rpm_support_base
+from yum_importer import repomd_state
+
+
+class TestRepomdState(rpm_support_base.PulpRPMTests):
+
+    def setUp(self):
+        super(TestRepomdState, self).setUp()
+        self.data_dir = os.path.join(os.path.abspath(os.path.dirname(__file__)), "../data")
+        self.repo_dir = os.path.join(self.data_dir, "pulp_unittest")
+
+    def test_get_metadata_checksums(self):
+        checksums = repomd_state.get_metadata_checksums(self.repo_dir, ["group", "updateinfo", "missing"])
+        self.assertTrue(checksums["group"])
+        self.assertTrue(checksums["updateinfo"])
+        self.assertEquals(checksums["missing"], None)
+        self.assertEquals(repomd_state.get_metadata_checksums(self.data_dir, ["group"]), None)
+
+    def test_get_repomd_state(self):
+        repomd_xml = os.path.join(self.repo_dir, "repodata/repomd.xml")
+        self.assertEquals(repomd_state.get_repomd_revision(repomd_xml), "1283359366")
+        state = repomd_state.get_repomd_state(repomd_xml, ["primary", "group"])
+        self.assertEquals(state[repomd_state.REVISION_KEY], "1283359366")
+        self.assertEquals(state["group"], repomd_state.get_metadata_checksums(self.repo_dir, ["group"])["group"])
+        self.assertTrue(state["primary"])
+
+    def test_get_repomd_types(self):
+        repomd_xml = os.path.join(self.repo_dir, "repodata/repomd.xml")
+        self.assertEquals(repomd_state.get_repomd_types(repomd_xml),
+                          ["filelists", "group", "group_gz", "other", "primary", "updateinfo"])
+
+    def test_is_unchanged(self):
+        sync_conduit = importer_mocks.get_sync_conduit()
+        checksums = {"group" : "abc", "group_gz" : None}
+        self.assertFalse(repomd_state.is_unchanged(sync_conduit, checksums))
+        repomd_state.record_synced_checksums(sync_conduit, checksums)
+        repomd_state.record_synced_checksums(sync_conduit, {"updateinfo" : "def"})
+        self.assertTrue(repomd_state.is_unchanged(sync_conduit, checksums))
+        self.assertTrue(repomd_state.is_unchanged(sync_conduit, {"updateinfo" : "def"}))
+        self.assertFalse(repomd_state.is_unchanged(sync_conduit, {"group" : "changed", "group_gz" : None}))
+        self.assertFalse(repomd_state.is_unchanged(sync_conduit, {"primary" : "abc"}))
+        self.assertFalse(repomd_state.is_unchanged(sync_conduit, None))
@@ -76,3 +76,15 @@ class TestResolveDeps(rpm_support_base.PulpRPMTests):
         result = importer.resolve_dependencies(repo, units, conduit, config)
         self.assertEqual(len(list(itertools.chain(*result['resolved'].values()))), 1)
         self.assertEqual(len(list(itertools.chain(*result['unresolved'].values()))), 0)
+
+    @mock.patch("yum_importer.importer.depsolver.DepSolver")
+    @mock.patch("yum_importer.importer.depindex.DependencyIndex")
+    def test_resolve_deps_closes_index_on_error(self, mock_index_class, mock_depsolver_class):
+        repo = mock.Mock(spec=Repository)
+        repo.working_dir = self.working_dir
+        repo.id = "test_resolve_deps"
+        mock_depsolver_class.side_effect = Exception("solve failed")
+        importer = YumImporter()
+        self.assertRaises(Exception, importer.resolve_dependencies, repo, [], mock.Mock(),
+                          importer_mocks.get_basic_config())
+        mock_index_class.return_value.close.assert_called_once_with()
@@ -26,6 +26,7 @@ from pulp.server.managers.consumer.cud import ConsumerManager
 sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)) + "/../../../src/")
 sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)) + "/../../../plugins/profilers/")
 from pulp_rpm.common.ids import TYPE_ID_PROFILER_RPM_PKG, TYPE_ID_RPM, UNIT_KEY_RPM
+from pulp_rpm.common import profile
 from pulp_rpm.yum_plugin import comps_util, util, updateinfo
 
 import profiler_mocks
@@ -149,3 +150,41 @@ class TestRpmPkgProfiler(rpm_support_base.PulpRPMTests):
         report_list = prof.units_applicable(self.test_consumer_i386, ["test_repo_id"], TYPE_ID_RPM, example_rpms, None, conduit)
         self.assertTrue(report_list == [])
 
+
+    def test_units_applicable_bulk_lookup(self):
+        emoticons = self.create_profile_entry("emoticons", 0, "0.1", "2", "x86_64", "Test Vendor")
+        patb = self.create_profile_entry("patb", 0, "0.1", "2", "x86_64", "Test Vendor")
+        patb_old = self.create_profile_entry("patb", 0, "0.0.1", "1", "x86_64", "Test Vendor")
+        missing = self.create_profile_entry("bla-bla", 0, "0.1", "2", "x86_64", "Test Vendor")
+        existing_units = [Unit(TYPE_ID_RPM, unit_key, {}, None) for unit_key in [patb_old, emoticons, patb]]
+        repos = [profiler_mocks.get_repo("test_repo_a"), profiler_mocks.get_repo("test_repo_b")]
+        conduit = profiler_mocks.get_profiler_conduit(existing_units=existing_units, repo_bindings=repos)
+
+        prof = RPMPkgProfiler()
+        prof.form_lookup_table = mock.Mock(side_effect=prof.form_lookup_table)
+        report_list = prof.units_applicable(self.test_consumer, ["test_repo_a", "test_repo_b"], TYPE_ID_RPM,
+                                            [emoticons, missing, patb], None, conduit)
+        self.assertEquals([r.details.keys() for r in report_list], [["emoticons x86_64"], ["patb x86_64"]])
+        self.assertEquals(report_list[1].details["patb x86_64"]["available"]["version"], "0.1")
+        # one query per repo for all the keys, and the profile is indexed once
+        self.assertEquals(conduit.get_units.call_count, 2)
+        criteria = conduit.get_units.call_args[0][1]
+        self.assertEquals(criteria.unit_filters, {"name" : {"$in" : ["bla-bla"]}})
+        self.assertEquals(prof.form_lookup_table.call_count, 1)
+
+    def test_update_profile(self):
+        rpms = self.profiles[TYPE_ID_RPM]
+        updated = rpms[1:] + [self.create_profile_entry("patb", 0, "0.1", "2", "x86_64", "Test Vendor")]
+        delta = profile.profile_delta(rpms, updated)
+        self.assertEquals(len(delta[profile.DELTA_ADDED]), 1)
+        self.assertEquals(len(delta[profile.DELTA_REMOVED]), 1)
+
+        prof = RPMPkgProfiler()
+        self.assertEquals(prof.update_profile(self.test_consumer, TYPE_ID_RPM, delta, None), updated)
+        # whole profiles are stored as uploaded
+        self.assertTrue(prof.update_profile(self.test_consumer, TYPE_ID_RPM, updated, None) is updated)
+        # a delta that is not based on the stored profile is rejected
+        self.assertRaises(profile.InvalidProfileDelta, prof.update_profile,
+                          self.test_consumer_i386, TYPE_ID_RPM, delta, None)
+        self.assertRaises(profile.InvalidProfileDelta, prof.update_profile,
+                          Consumer("no_profile", {}), TYPE_ID_RPM, delta, None)
@@ -31,7 +31,7 @@ import importer_mocks
 import rpm_support_base
 
 from yum_importer.importer import YumImporter
-from yum_importer import importer_rpm
+from yum_importer import importer_rpm, repomd_state
 
 from pulp.plugins.model import Repository, Unit
 from pulp_rpm.common.ids import TYPE_ID_RPM, UNIT_KEY_RPM, TYPE_ID_IMPORTER_YUM
@@ -43,11 +43,13 @@ class TestRPMs(rpm_support_base.PulpRPMTests):
     def setUp(self):
         super(TestRPMs, self).setUp()
         self.saved_verify_exists = util.verify_exists
+        self.saved_verify_files = util.verify_files
         self.init()
 
     def tearDown(self):
         super(TestRPMs, self).tearDown()
         util.verify_exists = self.saved_verify_exists
+        util.verify_files = self.saved_verify_files
         self.clean()
 
     def init(self):
@@ -313,6 +315,82 @@ class TestRPMs(rpm_support_base.PulpRPMTests):
         for link in sym_links:
             self.assertTrue(os.path.islink(link))
 
+    def test_failed_metadata_closes_verification_cache(self):
+        feed_url = "file://%s/pulp_unittest/" % (self.data_dir)
+        repo = mock.Mock(spec=Repository)
+        repo.working_dir = self.working_dir
+        repo.id = "test_failed_metadata_closes_verification_cache"
+        sync_conduit = importer_mocks.get_sync_conduit(existing_units=[], pkg_dir=self.pkg_dir)
+        config = importer_mocks.get_basic_config(feed_url=feed_url, verify_checksum=True, force_full_sync=True)
+        grinder = mock.Mock()
+        grinder.setup.side_effect = Exception("metadata fetch failed")
+        cache_mock = mock.patch.object(util, "VerificationCache")
+        grinder_mock = mock.patch.object(importer_rpm, "get_yumRepoGrinder", return_value=grinder)
+        verification_cache = cache_mock.start()
+        grinder_mock.start()
+        try:
+            importerRPM = importer_rpm.ImporterRPM()
+            self.assertRaises(Exception, importerRPM.sync, repo, sync_conduit, config)
+            self.assertEquals(verification_cache.return_value.close.call_count, 1)
+        finally:
+            grinder_mock.stop()
+            cache_mock.stop()
+
+    def test_unchanged_repomd_skips_sync(self):
+        feed_url = "file://%s/pulp_unittest/" % (self.data_dir)
+        importer = YumImporter()
+        repo = mock.Mock(spec=Repository)
+        repo.working_dir = self.working_dir
+        repo.id = "test_unchanged_repomd_skips_sync"
+        sync_conduit = importer_mocks.get_sync_conduit(existing_units=[], pkg_dir=self.pkg_dir)
+        config = importer_mocks.get_basic_config(feed_url=feed_url)
+
+        def fetch_file(url, destination, config):
+            shutil.copy(url[len("file://"):], destination)
+            return True
+
+        fetch_mock = mock.patch("yum_importer.download.fetch_file", side_effect=fetch_file)
+        fetch_file_mock = fetch_mock.start()
+        try:
+            status, summary, details = importer._sync_repo(repo, sync_conduit, config)
+            self.assertTrue(status)
+            self.assertEquals(summary["packages"]["num_synced_new_rpms"], 3)
+            self.assertEquals(fetch_file_mock.call_args[0][0],
+                "file://%s/pulp_unittest/repodata/repomd.xml" % self.data_dir)
+            self.assertFalse(os.path.exists(os.path.join(self.working_dir, importer_rpm.FEED_REPOMD_FILENAME)))
+
+            # nothing changed upstream, the rest of the metadata is not fetched
+            importer.importer_rpm.yumRepoGrinder = None
+            status, summary, details = importer._sync_repo(repo, sync_conduit, config)
+            self.assertTrue(status)
+            self.assertTrue(summary["packages"]["unchanged"])
+            self.assertTrue(summary["errata"]["unchanged"])
+            self.assertTrue(summary["comps"]["unchanged"])
+            self.assertEquals(importer.importer_rpm.yumRepoGrinder, None)
+
+            config = importer_mocks.get_basic_config(feed_url=feed_url, force_full_sync=True)
+            status, summary, details = importer._sync_repo(repo, sync_conduit, config)
+            self.assertTrue(status)
+            self.assertFalse("unchanged" in summary["packages"])
+            self.assertFalse("unchanged" in summary["errata"])
+
+            # a change to any metadata type the feed lists, not only primary, means a full sync
+            repomd_xml = os.path.join(self.data_dir, "pulp_unittest", "repodata", "repomd.xml")
+            other_checksum = repomd_state.get_repomd_checksums(repomd_xml, ["other"])["other"]
+            def fetch_changed_other(url, destination, config):
+                data = open(url[len("file://"):]).read()
+                f = open(destination, "w")
+                f.write(data.replace(other_checksum, "0" * len(other_checksum)))
+                f.close()
+                return True
+            fetch_file_mock.side_effect = fetch_changed_other
+            config = importer_mocks.get_basic_config(feed_url=feed_url)
+            status, summary, details = importer._sync_repo(repo, sync_conduit, config)
+            self.assertTrue(status)
+            self.assertFalse("unchanged" in summary["packages"])
+        finally:
+            fetch_mock.stop()
+
     def test_validate_config(self):
         feed_url = "http://repos.fedorapeople.org/repos/pulp/pulp/demo_repos/pulp_unittest/"
         importer = YumImporter()
@@ -396,6 +474,38 @@ class TestRPMs(rpm_support_base.PulpRPMTests):
         for key in importer_rpm.PROGRESS_REPORT_FIELDS:
             self.assertTrue(key in updated_progress["content"])
 
+    def test_iter_existing_units_pages_by_key(self):
+        units = []
+        for name in ["pulp", "gofer", "grinder"]:
+            for version in ["0.1", "0.2"]:
+                unit_key = {"name" : name, "epoch" : "0", "version" : version, "release" : "1",
+                            "arch" : "noarch", "checksumtype" : "sha256", "checksum" : name + version}
+                units.append(Unit(TYPE_ID_RPM, unit_key, {}, None))
+        ordered = sorted(units, key=lambda u: importer_rpm.form_lookup_key(u.unit_key))
+
+        def matches(unit_key, unit_filters):
+            if unit_filters is None:
+                return True
+            for clause in unit_filters["$or"]:
+                for field, value in clause.items():
+                    if isinstance(value, dict):
+                        if not unit_key[field] > value["$gt"]:
+                            break
+                    elif unit_key[field] != value:
+                        break
+                else:
+                    return True
+            return False
+
+        def get_units(criteria):
+            self.assertFalse(criteria.skip)
+            return [u for u in ordered if matches(u.unit_key, criteria.unit_filters)][:criteria.limit]
+        sync_conduit = mock.Mock()
+        sync_conduit.get_units.side_effect = get_units
+        found = [u for key, u in importer_rpm.iter_existing_units(sync_conduit, TYPE_ID_RPM, batch_size=4)]
+        self.assertEquals(found, ordered)
+        self.assertEquals(sync_conduit.get_units.call_count, 2)
+
     def test_get_existing_units(self):
         unit_key = {}
         for k in UNIT_KEY_RPM:
@@ -485,13 +595,11 @@ class TestRPMs(rpm_support_base.PulpRPMTests):
     def test_get_missing_rpms_and_units(self):
         # 2 Existing RPMs, one is missing
         # Expecting return of the one missing rpm
-        # Fake out the verify_exists
-        def side_effect(arg, checksum=None, checksum_type="sha256", size=None, verify_options={}):
-            if arg == "rel_path_b":
-                return False
-            return True
-        util.verify_exists = mock.Mock()
-        util.verify_exists.side_effect = side_effect
+        # Fake out the verify_files
+        def side_effect(files, verify_options={}):
+            return [f[0] != "rel_path_b" for f in files]
+        util.verify_files = mock.Mock()
+        util.verify_files.side_effect = side_effect
 
         rpm_a = self.get_simple_rpm("test_value_a")
         rpm_b = self.get_simple_rpm("test_value_b")
@@ -514,6 +622,92 @@ class TestRPMs(rpm_support_base.PulpRPMTests):
         self.assertTrue(rpm_lookup_key_b in missing_units)
         self.assertEquals(missing_rpms[rpm_lookup_key_b], rpm_b)
 
+    def test_diff_rpms(self):
+        # Available: A, B, C (plus a duplicate of A); Existing: B, D
+        # Expecting A and C new, B existing and D orphaned
+        rpm_a = self.get_simple_rpm("test_value_a")
+        rpm_b = self.get_simple_rpm("test_value_b")
+        rpm_c = self.get_simple_rpm("test_value_c")
+        rpm_d = self.get_simple_rpm("test_value_d")
+        available = [rpm_c, rpm_a, rpm_b, dict(rpm_a)]
+        available.sort(key=importer_rpm.form_sort_key)
+        unit_b = Unit(TYPE_ID_RPM, importer_rpm.form_rpm_unit_key(rpm_b), "test_metadata", "rel_path_b")
+        unit_d = Unit(TYPE_ID_RPM, importer_rpm.form_rpm_unit_key(rpm_d), "test_metadata", "rel_path_d")
+        existing = [(importer_rpm.form_sort_key(u.unit_key), u) for u in (unit_b, unit_d)]
+        diff = list(importer_rpm.diff_rpms(available, existing))
+        self.assertEquals(len(diff), 4)
+        self.assertEquals(diff[0], (importer_rpm.DIFF_NEW, rpm_a, None))
+        self.assertEquals(diff[1], (importer_rpm.DIFF_EXISTING, rpm_b, unit_b))
+        self.assertEquals(diff[2], (importer_rpm.DIFF_NEW, rpm_c, None))
+        self.assertEquals(diff[3], (importer_rpm.DIFF_ORPHANED, None, unit_d))
+
+    def test_completed_rpm_saver(self):
+        # A new and a missing rpm download fine, a second new rpm fails verification
+        os.makedirs(self.pkg_dir)
+        rpms = {}
+        for value in ("new_a", "new_b", "missing_c"):
+            rpm = self.get_simple_rpm(value)
+            rpm["pkgpath"] = self.pkg_dir
+            rpm["checksumtype"] = "sha256"
+            rpm["size"] = len(value)
+            rpm_path = os.path.join(self.pkg_dir, rpm["filename"])
+            open(rpm_path, "w").write(value)
+            rpm["checksum"] = util.get_file_checksum(filename=rpm_path)
+            rpms[value] = rpm
+        rpms["new_b"]["checksum"] = "bad checksum"
+        keys = dict([(value, importer_rpm.form_lookup_key(rpm)) for value, rpm in rpms.items()])
+        unit_a = Unit(TYPE_ID_RPM, importer_rpm.form_rpm_unit_key(rpms["new_a"]), "test_metadata", "rel_path_a")
+        unit_b = Unit(TYPE_ID_RPM, importer_rpm.form_rpm_unit_key(rpms["new_b"]), "test_metadata", "rel_path_b")
+        rpm_info = {'new_rpms' : {keys["new_a"] : rpms["new_a"], keys["new_b"] : rpms["new_b"]},
+                    'new_rpm_units' : {keys["new_a"] : unit_a, keys["new_b"] : unit_b},
+                    'missing_rpms' : {keys["missing_c"] : rpms["missing_c"]}}
+        sync_conduit = mock.Mock()
+        saver = importer_rpm.CompletedRpmSaver(sync_conduit, rpm_info, {"checksum" : True, "size" : True})
+        for rpm in rpms.values():
+            saver.item_finished(rpm, True)
+        # items that are not rpms are ignored
+        saver.item_finished({"pkgpath" : self.pkg_dir, "filename" : "images/boot.iso"}, True)
+        self.assertEquals(saver.verified_keys, set([keys["new_a"], keys["missing_c"]]))
+        self.assertEquals(saver.saved_keys, set([keys["new_a"]]))
+        sync_conduit.save_unit.assert_called_once_with(unit_a)
+
+        # the rpms verified while downloading are not verified again
+        util.verify_files = mock.Mock(side_effect=lambda files, verify_options={}: [False] * len(files))
+        new_units = dict(rpm_info['new_rpm_units'])
+        not_synced = importer_rpm.verify_download(rpm_info['missing_rpms'], rpm_info['new_rpms'], new_units,
+                                                  verified_keys=saver.verified_keys)
+        self.assertEquals(not_synced.keys(), [keys["new_b"]])
+        self.assertEquals(new_units.keys(), [keys["new_a"]])
+        self.assertEquals(util.verify_files.call_args[0][0][0][1], "bad checksum")
+
+    def test_diff_rpms_unsorted_input(self):
+        rpm_a = self.get_simple_rpm("test_value_a")
+        rpm_b = self.get_simple_rpm("test_value_b")
+        diff = importer_rpm.diff_rpms([rpm_b, rpm_a], [])
+        self.assertRaises(importer_rpm.DiffOrderError, list, diff)
+
+    def test_setup_rpms_streams_existing_units(self):
+        # 2 Existing RPMs, one still available upstream and one orphaned; 1 new RPM upstream
+        util.verify_files = mock.Mock(side_effect=lambda files, verify_options={}: [True] * len(files))
+        rpm_a = self.get_simple_rpm("test_value_a")
+        rpm_b = self.get_simple_rpm("test_value_b")
+        rpm_c = self.get_simple_rpm("test_value_c")
+        unit_a = Unit(TYPE_ID_RPM, importer_rpm.form_rpm_unit_key(rpm_a), "test_metadata", "rel_path_a")
+        unit_b = Unit(TYPE_ID_RPM, importer_rpm.form_rpm_unit_key(rpm_b), "test_metadata", "rel_path_b")
+        sync_conduit = importer_mocks.get_sync_conduit(existing_units=[unit_b, unit_a], pkg_dir=self.pkg_dir)
+        repo = mock.Mock(spec=Repository)
+        repo.id = "test_setup_rpms"
+        importerRPM = importer_rpm.ImporterRPM()
+        importerRPM.yumRepoGrinder = mock.Mock()
+        importerRPM.yumRepoGrinder.getRPMItems.return_value = [rpm_c, rpm_a]
+        rpm_info = importerRPM._setup_rpms(repo, sync_conduit, {}, [])
+        self.assertEquals(rpm_info['num_available_rpms'], 2)
+        self.assertEquals(rpm_info['num_existing_rpm_units'], 2)
+        self.assertEquals(rpm_info['new_rpms'].keys(), [importer_rpm.form_lookup_key(rpm_c)])
+        self.assertEquals(rpm_info['new_rpm_units'].keys(), [importer_rpm.form_lookup_key(rpm_c)])
+        self.assertEquals(rpm_info['orphaned_rpm_units'].values(), [unit_b])
+        self.assertEquals(len(rpm_info['missing_rpms']), 0)
+
     def test_remove_packages(self):
         feed_url = "http://repos.fedorapeople.org/repos/pulp/pulp/demo_repos/pulp_unittest/"
         repo = mock.Mock(spec=Repository)
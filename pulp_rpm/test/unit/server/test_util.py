@@ -16,8 +16,11 @@ import os
 import shutil
 import sys
 import tempfile
+import time
 import unittest
 
+import mock
+
 sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)) + "/../../src/")
 sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)) + "/../../plugins/importers/")
 
@@ -53,4 +56,72 @@ class TestUtil(rpm_support_base.PulpRPMTests):
         self.assertFalse(util.is_rpm_newer(rpm_a, newer_a))
         self.assertFalse(util.is_rpm_newer(newer_a, rpm_b))
 
+    def test_verify_exists_with_cache(self):
+        file_path = os.path.join(self.temp_dir, "test.rpm")
+        open(file_path, "w").write("test package content")
+        checksum = util.get_file_checksum(filename=file_path)
+        cache = util.VerificationCache(os.path.join(self.temp_dir, "cache.db"))
+        verify_options = {"checksum" : True, "cache" : cache}
+        self.assertTrue(util.verify_exists(file_path, checksum, "sha256", verify_options=verify_options))
+        self.assertEquals(cache.lookup(file_path, "sha256", os.stat(file_path)), checksum)
+
+        # a verified, unchanged file is not hashed again
+        mock_checksums = mock.Mock(return_value={"sha256" : checksum})
+        with mock.patch("pulp_rpm.common.checksum.file_checksums", mock_checksums):
+            self.assertTrue(util.verify_exists(file_path, checksum, "sha256", verify_options=verify_options))
+            self.assertEquals(mock_checksums.call_count, 0)
+        cache.close()
+
+        # the cache persists; a changed file is hashed again and removed when it no longer matches
+        cache = util.VerificationCache(os.path.join(self.temp_dir, "cache.db"))
+        self.assertEquals(cache.lookup(file_path, "sha256", os.stat(file_path)), checksum)
+        open(file_path, "w").write("modified package content")
+        self.assertEquals(cache.lookup(file_path, "sha256", os.stat(file_path)), None)
+        verify_options["cache"] = cache
+        self.assertFalse(util.verify_exists(file_path, checksum, "sha256", verify_options=verify_options))
+        self.assertFalse(os.path.exists(file_path))
+        cache.close()
+
+    def test_verification_cache_max_age(self):
+        file_path = os.path.join(self.temp_dir, "test.rpm")
+        open(file_path, "w").write("test package content")
+        f_stat = os.stat(file_path)
+        cache = util.VerificationCache(os.path.join(self.temp_dir, "cache.db"), max_age=60)
+        cache.record(file_path, "sha256", f_stat, "digest")
+        self.assertEquals(cache.lookup(file_path, "sha256", f_stat), "digest")
+        self.assertEquals(cache.lookup(file_path, "sha1", f_stat), None)
+        original_time = time.time
+        time.time = lambda: original_time() + 120
+        try:
+            self.assertEquals(cache.lookup(file_path, "sha256", f_stat), None)
+        finally:
+            time.time = original_time
+        cache.close()
+
+    def test_verify_files(self):
+        contents = {"a.rpm" : "package a", "b.rpm" : "package b", "c.rpm" : "package c"}
+        for name, content in contents.items():
+            open(os.path.join(self.temp_dir, name), "w").write(content)
+        a_path = os.path.join(self.temp_dir, "a.rpm")
+        b_path = os.path.join(self.temp_dir, "b.rpm")
+        c_path = os.path.join(self.temp_dir, "c.rpm")
+        files = [
+            (a_path, util.get_file_checksum(filename=a_path), "sha256", 9),
+            (a_path, util.get_file_checksum(filename=a_path, hashtype="sha"), "sha", 9),
+            (b_path, "bad checksum", "sha256", 9),
+            (c_path, util.get_file_checksum(filename=c_path), "sha256", 100),
+            (os.path.join(self.temp_dir, "missing.rpm"), "checksum", "sha256", 9),
+        ]
+        results = util.verify_files(files, {"checksum" : True, "size" : True})
+        self.assertEquals(results, [True, True, False, False, False])
+        # files failing verification are removed
+        self.assertTrue(os.path.exists(a_path))
+        self.assertFalse(os.path.exists(b_path))
+        self.assertFalse(os.path.exists(c_path))
 
+    def test_get_errata_package_keys(self):
+        pkglist = [{"packages" : [{"name" : "patb", "arch" : "x86_64"}, {"name" : "emoticons", "arch" : "noarch"}]},
+                   {"packages" : [{"name" : "patb", "arch" : "x86_64"}, {"name" : "patb", "arch" : "i686"}]}]
+        self.assertEquals(util.get_errata_package_keys(pkglist),
+                          ["emoticons noarch", "patb i686", "patb x86_64"])
+        self.assertEquals(util.get_errata_package_keys(None), [])
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2013 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+import os
+import shutil
+import sys
+import tempfile
+
+import mock
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)) + "/../../../plugins/importers/")
+
+from grinder.BaseFetch import BaseFetch
+from yum_importer import download
+import importer_mocks
+import rpm_support_base
+
+
+class TestYumDownloadRun(rpm_support_base.PulpRPMTests):
+
+    def setUp(self):
+        super(TestYumDownloadRun, self).setUp()
+        self.temp_dir = tempfile.mkdtemp()
+        self.config = importer_mocks.get_basic_config(feed_url="http://example.com/repo/",
+            num_threads=4, max_downloads_per_host=2, max_in_flight_bytes=100, num_retries=2, retry_delay=0)
+
+    def tearDown(self):
+        super(TestYumDownloadRun, self).tearDown()
+        shutil.rmtree(self.temp_dir)
+
+    def get_item(self, host, name, size):
+        return {"downloadurl": "http://%s/repo/%s" % (host, name), "filename": name,
+                "pkgpath": os.path.join(self.temp_dir, host), "size": size,
+                "item_type": BaseFetch.RPM}
+
+    def test_split_by_host(self):
+        items = [self.get_item("a.com", "1.rpm", 1), self.get_item("b.com", "2.rpm", 1),
+                 self.get_item("a.com", "3.rpm", 1)]
+        hosts = download.split_by_host(items)
+        self.assertEquals(sorted(hosts.keys()), ["a.com", "b.com"])
+        self.assertEquals([i["filename"] for i in hosts["a.com"]], ["1.rpm", "3.rpm"])
+
+    def test_split_by_size(self):
+        items = [self.get_item("a.com", "%s.rpm" % i, size) for i, size in enumerate((60, 30, 20, 150, 10))]
+        batches = download.split_by_size(items, 100)
+        self.assertEquals([[i["size"] for i in b] for b in batches], [[60, 30], [20], [150], [10]])
+
+    def test_use_native_download(self):
+        self.assertTrue(download.use_native_download(self.config))
+        config = importer_mocks.get_basic_config(feed_url="https://example.com/repo/")
+        self.assertTrue(download.use_native_download(config))
+        config = importer_mocks.get_basic_config(feed_url="file:///srv/repo/")
+        self.assertFalse(download.use_native_download(config))
+        config = importer_mocks.get_basic_config(feed_url="http://example.com/repo/", native_download=False)
+        self.assertFalse(download.use_native_download(config))
+        config = importer_mocks.get_basic_config(feed_url="file:///srv/repo/", native_download=True)
+        self.assertTrue(download.use_native_download(config))
+
+    def test_get_downloader_config(self):
+        downloader_config = download.get_downloader_config(self.config, 2)
+        self.assertEquals(downloader_config.num_threads, 2)
+        self.assertEquals(downloader_config.ssl_verify_peer, 1)
+
+    def test_get_downloader_config_ssl(self):
+        config = importer_mocks.get_basic_config(feed_url="https://example.com/repo/",
+            ssl_ca_cert="CA CERT", ssl_client_cert="CLIENT CERT", ssl_client_key="CLIENT KEY")
+        downloader_config = download.get_downloader_config(config, 2)
+        # the certificates are passed as they are configured, not as paths
+        self.assertEquals(downloader_config.protocol, "https")
+        self.assertEquals(downloader_config.ssl_ca_cert, "CA CERT")
+        self.assertEquals(downloader_config.ssl_client_cert, "CLIENT CERT")
+        self.assertEquals(downloader_config.ssl_client_key, "CLIENT KEY")
+
+    @mock.patch("yum_importer.download.factory.get_downloader")
+    def test_download(self, mock_get_downloader):
+        items = [self.get_item("a.com", "1.rpm", 60), self.get_item("a.com", "2.rpm", 60),
+                 self.get_item("b.com", "3.rpm", 10)]
+        finished = []
+        progress = []
+        requested = []
+        run = download.YumDownloadRun(self.config, progress_callback=progress.append,
+            item_callback=lambda item, succeeded: finished.append((item["filename"], succeeded)))
+
+        def get_downloader(config, event_listener):
+            downloader = mock.Mock()
+            def download_requests(requests):
+                for r in requests:
+                    requested.append(os.path.basename(r.url))
+                    report = mock.Mock(url=r.url, bytes_downloaded=10)
+                    if r.url.endswith("2.rpm"):
+                        event_listener.download_failed(report)
+                    else:
+                        event_listener.download_succeeded(report)
+            downloader.download.side_effect = download_requests
+            return downloader
+        mock_get_downloader.side_effect = get_downloader
+
+        run.addItems(items)
+        report = run.download()
+        # one downloader per host, each limited by max_downloads_per_host
+        self.assertEquals(mock_get_downloader.call_count, 2)
+        self.assertEquals(mock_get_downloader.call_args[0][0].num_threads, 2)
+        # the failed item is tried once and retried num_retries times
+        self.assertEquals(requested.count("2.rpm"), 3)
+        self.assertEquals(requested.count("1.rpm"), 1)
+        self.assertEquals(sorted(finished), [("1.rpm", True), ("2.rpm", False), ("3.rpm", True)])
+        self.assertEquals(report.successes, 2)
+        self.assertEquals(report.errors, 1)
+        self.assertTrue("error" in items[1])
+        # the run keeps its own download state; only the error is reported on the item
+        self.assertEquals(sorted(items[1].keys()), sorted(self.get_item("a.com", "2.rpm", 60).keys() + ["error"]))
+        self.assertEquals(items[0], self.get_item("a.com", "1.rpm", 60))
+        self.assertEquals(report.last_progress.items_left, 0)
+        self.assertEquals(progress[-1]["state"], "FINISHED")
+        self.assertEquals(progress[-1]["details"][BaseFetch.RPM]["num_error"], 1)
+
+    @mock.patch("yum_importer.download.factory.get_downloader")
+    def test_download_retry_succeeds(self, mock_get_downloader):
+        items = [self.get_item("a.com", "1.rpm", 10)]
+        finished = []
+        run = download.YumDownloadRun(self.config,
+            item_callback=lambda item, succeeded: finished.append((item["filename"], succeeded)))
+
+        def get_downloader(config, event_listener):
+            downloader = mock.Mock()
+            def download_requests(requests):
+                report = mock.Mock(url=requests[0].url, bytes_downloaded=10)
+                if downloader.download.call_count == 1:
+                    event_listener.download_failed(report)
+                else:
+                    event_listener.download_succeeded(report)
+            downloader.download.side_effect = download_requests
+            return downloader
+        mock_get_downloader.side_effect = get_downloader
+
+        run.addItems(items)
+        report = run.download()
+        self.assertEquals(finished, [("1.rpm", True)])
+        self.assertEquals(report.successes, 1)
+        self.assertEquals(report.errors, 0)
+        self.assertEquals(report.last_progress.size_left, 0)
+        self.assertFalse("error" in items[0])
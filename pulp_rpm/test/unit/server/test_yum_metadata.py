@@ -12,8 +12,10 @@
 # have received a copy of GPLv2 along with this software; if not, see
 # http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
 
+import bz2
 import os
 import shutil
+import sqlite3
 import sys
 import tempfile
 import time
@@ -25,7 +27,8 @@ sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)) + "/../../plugins/
 sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)) + "/../../plugins/distributors/")
 sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)) + "/../../common")
 
-from pulp_rpm.yum_plugin  import metadata
+from pulp_rpm.common.ids import TYPE_ID_RPM
+from pulp_rpm.yum_plugin  import metadata, repomd, sqlitedb, util
 from pulp.plugins.model import Repository
 import distributor_mocks
 import rpm_support_base
@@ -122,3 +125,200 @@ class TestYumMetadataGenerate(rpm_support_base.PulpRPMTests):
         self.assertTrue(location_info == "href=\"feedless-1.0-1.noarch.rpm\"")
 
 
+
+    def test_unit_metadata_cache(self):
+        def get_unit(unit_id, changelog=""):
+            unit = mock.Mock()
+            unit.id = unit_id
+            unit.metadata = {"repodata" : {"primary" : u"<package>%s-primary</package>" % unit_id,
+                                           "filelists" : u"<package>%s-filelists</package>" % unit_id,
+                                           "other" : u"<package>%s-other%s</package>" % (unit_id, changelog)}}
+            unit.metadata[util.REPODATA_DIGEST] = util.get_repodata_digest(unit.metadata["repodata"])
+            return unit
+        def read_xml(cache, ftype):
+            xml_path = os.path.join(self.temp_dir, "%s.xml.gz" % ftype)
+            cache.write_xml(ftype, xml_path)
+            return metadata.gzip.open(xml_path).read()
+
+        repo_dir = os.path.join(self.temp_dir, "repo")
+        cache_dir = metadata.get_unit_metadata_cache_dir(repo_dir + "/")
+        # the cache is not published with the repo
+        self.assertFalse(cache_dir.startswith(repo_dir + "/"))
+        cache = metadata.UnitMetadataCache(cache_dir, "sha256")
+        self.assertFalse(cache.load())
+        cache.update([get_unit("a"), get_unit("b"), get_unit("c")], set())
+        primary = read_xml(cache, "primary")
+        self.assertTrue('packages="3"' in primary)
+        self.assertTrue(primary.index("a-primary") < primary.index("b-primary") < primary.index("c-primary"))
+        self.assertTrue(primary.endswith(metadata.XML_FOOTERS["primary"]))
+
+        # a new publish picks up the cache; only the added unit is compressed
+        cache = metadata.UnitMetadataCache(cache_dir, "sha256")
+        self.assertTrue(cache.load())
+        digests = cache.unit_digests()
+        self.assertEquals(set(digests), set(["a", "b", "c"]))
+        self.assertEquals(digests["a"], get_unit("a").metadata[util.REPODATA_DIGEST])
+        self.assertNotEquals(digests["a"], get_unit("a", changelog="-rewritten").metadata[util.REPODATA_DIGEST])
+        cache.update([get_unit("d")], set(["b"]))
+        self.assertEquals(cache.unit_count, 3)
+        filelists = read_xml(cache, "filelists")
+        self.assertTrue('packages="3"' in filelists)
+        self.assertFalse("b-filelists" in filelists)
+        self.assertTrue("a-filelists" in filelists and "c-filelists" in filelists and "d-filelists" in filelists)
+        self.assertEquals(len(os.listdir(cache.cache_dir)), len(metadata.UNIT_METADATA_FTYPES) + 1)
+        batches = list(cache.iter_snippets(2))
+        self.assertEquals(len(batches), 2)
+        self.assertEquals(batches[0][0], "<package>a-primary</package><package>c-primary</package>")
+        self.assertEquals(batches[1][2], "<package>d-other</package>")
+
+        # a cache written with another checksum type is not used
+        cache = metadata.UnitMetadataCache(cache_dir, "sha")
+        self.assertFalse(cache.load())
+        self.assertEquals(cache.unit_digests(), {})
+
+    def test_merge_unit_metadata_incremental(self):
+        def get_unit(unit_id, changelog=""):
+            unit = mock.Mock()
+            unit.id = unit_id
+            unit.type_id = TYPE_ID_RPM
+            unit.unit_key = {"name" : unit_id, "epoch" : "0", "version" : "1.0", "release" : "1",
+                             "arch" : "noarch", "checksumtype" : "sha256", "checksum" : unit_id}
+            unit.metadata = {"repodata" : {
+                "primary" : u'<package type="rpm"><name>%s</name><arch>noarch</arch>'
+                            u'<version epoch="0" ver="1.0" rel="1"/><checksum type="sha256" pkgid="YES">%s</checksum>'
+                            u'<time file="1" build="1"/><size package="1" installed="1" archive="1"/>'
+                            u'<location href="%s-1.0-1.noarch.rpm"/></package>' % (unit_id, unit_id, unit_id),
+                "filelists" : u'<package pkgid="%s" name="%s" arch="noarch"><file>/%s</file></package>' % \
+                              (unit_id, unit_id, unit_id),
+                "other" : u'<package pkgid="%s" name="%s" arch="noarch">'
+                          u'<changelog author="pulp" date="1">%s-other%s</changelog></package>' % \
+                          (unit_id, unit_id, unit_id, changelog)}}
+            unit.metadata[util.REPODATA_DIGEST] = util.get_repodata_digest(unit.metadata["repodata"])
+            return unit
+        units = {"a" : get_unit("a"), "b" : get_unit("b")}
+        unit_fields = []
+        def get_units(criteria):
+            unit_fields.append(criteria.unit_fields)
+            if criteria.unit_filters and "_id" in criteria.unit_filters:
+                return [units[unit_id] for unit_id in criteria.unit_filters["_id"]["$in"]]
+            return [u for u in units.values() if u.type_id in criteria.type_ids]
+        publish_conduit = mock.Mock()
+        publish_conduit.get_units.side_effect = get_units
+        repo_dir = os.path.join(self.temp_dir, "repo")
+
+        generator = YumMetadataGenerator(repo_dir, checksum_type="sha256")
+        generator.merge_unit_metadata_incremental(publish_conduit)
+        self.assertEquals(generator.unit_count, 2)
+        self.assertFalse(metadata.UNIT_METADATA_CACHE_DIR_SUFFIX in os.listdir(repo_dir))
+        # the sqlite databases are filled from the cached snippets rather than by createrepo
+        self.assertTrue(generator.package_databases is not None)
+        self.assertEquals(generator.package_databases.package_counts["primary"], 2)
+        generator.abort_xml()
+
+        # the snippets of b are rewritten in place; its member is rebuilt, not reused
+        units["b"] = get_unit("b", changelog="-rewritten")
+        del unit_fields[:]
+        generator = YumMetadataGenerator(repo_dir, checksum_type="sha256")
+        generator.merge_unit_metadata_incremental(publish_conduit)
+        self.assertEquals(generator.unit_count, 2)
+        other = metadata.gzip.open(generator.other_xml_path).read()
+        self.assertTrue("b-other-rewritten" in other)
+        self.assertEquals(other.count("b-other"), 1)
+        generator.abort_xml()
+        # only the rewritten unit's repodata is read
+        self.assertEquals(len([fields for fields in unit_fields if "repodata" in fields]), 1)
+
+    def test_package_xml_writer(self):
+        for unit_count in (2, None):
+            xml_path = os.path.join(self.temp_dir, "other.xml.gz")
+            temp_xml_path = os.path.join(self.temp_dir, "temp_other.xml.gz")
+            writer = metadata.PackageXmlWriter("other", xml_path, temp_xml_path)
+            writer.open(unit_count)
+            writer.write("<package>one</package>")
+            writer.write("<package>two</package>")
+            writer.close(2)
+            expected = metadata.XML_HEADERS["other"] % 2 + "<package>one</package><package>two</package>" + \
+                       metadata.XML_FOOTERS["other"]
+            self.assertEquals(metadata.gzip.open(xml_path).read(), expected)
+            self.assertFalse(os.path.exists(temp_xml_path))
+
+    def test_package_databases(self):
+        primary = """<package type="rpm"><name>feedless</name><arch>noarch</arch><version epoch="0" ver="1.0" rel="1"/><checksum type="sha" pkgid="YES">c1181097439ae4c69793c91febd8513475fb7ed6</checksum><summary>dummy testing pkg</summary><description>A dumb 1Mb pkg.</description><packager/><url/><time file="1299184404" build="1299168170"/><size package="1050973" installed="2097152" archive="1048976"/><location href="feedless-1.0-1.noarch.rpm"/><format><rpm:license>GPLv2</rpm:license><rpm:vendor/><rpm:group>Application</rpm:group><rpm:buildhost>pulp-qe-rhel5.usersys.redhat.com</rpm:buildhost><rpm:sourcerpm>feedless-1.0-1.src.rpm</rpm:sourcerpm><rpm:header-range start="456" end="1846"/><rpm:provides><rpm:entry name="feedless" flags="EQ" epoch="0" ver="1.0" rel="1"/></rpm:provides><rpm:requires><rpm:entry name="rpmlib(CompressedFileNames)" flags="LE" epoch="0" ver="3.0.4" rel="1" pre="1"/><rpm:entry name="rpmlib(PayloadFilesHavePrefix)" flags="LE" epoch="0" ver="4.0" rel="1" pre="1"/></rpm:requires></format></package>"""
+        filelists = """<package pkgid="c1181097439ae4c69793c91febd8513475fb7ed6" name="feedless" arch="noarch"><version epoch="0" ver="1.0" rel="1"/><file>/tmp/rpm_test/feedless/key</file><file type="dir">/tmp/rpm_test/feedless</file></package>"""
+        other = """<package pkgid="c1181097439ae4c69793c91febd8513475fb7ed6" name="feedless" arch="noarch"><version epoch="0" ver="1.0" rel="1"/><changelog author="pulp" date="1299168000">- initial</changelog></package>"""
+        databases = sqlitedb.PackageDatabases(self.temp_dir)
+        databases.add_snippets(primary, filelists, other)
+        entries = databases.close({"primary" : "a", "filelists" : "b", "other" : "c"}, "sha256")
+        self.assertEquals(entries["primary"]["type"], "primary_db")
+        self.assertEquals(entries["primary"]["location"], "repodata/primary.sqlite.bz2")
+        self.assertFalse(os.path.exists(os.path.join(self.temp_dir, "primary.sqlite")))
+
+        def query(ftype, statement):
+            db_path = os.path.join(self.temp_dir, "%s.sqlite.uncompressed" % ftype)
+            open(db_path, "wb").write(bz2.BZ2File(os.path.join(self.temp_dir, "%s.sqlite.bz2" % ftype)).read())
+            connection = sqlite3.connect(db_path)
+            try:
+                return connection.execute(statement).fetchall()
+            finally:
+                connection.close()
+        self.assertEquals(query("primary", "select name, version, epoch, location_href, rpm_header_end from packages"),
+            [("feedless", "1.0", "0", "feedless-1.0-1.noarch.rpm", 1846)])
+        self.assertEquals(query("primary", "select count(*) from requires where pre = 'TRUE'"), [(2,)])
+        self.assertEquals(query("primary", "select dbversion, checksum from db_info"), [(10, "a")])
+        self.assertEquals(query("filelists", "select dirname, filenames, filetypes from filelist order by dirname"),
+            [("/tmp/rpm_test", "feedless", "d"), ("/tmp/rpm_test/feedless", "key", "f")])
+        self.assertEquals(query("other", "select author, date, changelog from changelog"),
+            [("pulp", 1299168000, "- initial")])
+
+    def test_repomd_editor(self):
+        repodata_dir = os.path.join(self.temp_dir, "repodata")
+        shutil.copytree(os.path.join(os.path.dirname(__file__), "../data/test_repo/repodata"), repodata_dir)
+        updateinfo_xml_path = os.path.join(self.temp_dir, "updateinfo.xml")
+        open(updateinfo_xml_path, "w").write("<updates></updates>")
+
+        editor = repomd.RepomdEditor(repodata_dir, checksum_type="sha256")
+        editor.add(updateinfo_xml_path)
+        editor.remove("product")
+        editor.save()
+        self.assertFalse(editor.has_changes())
+        repomd_xml = os.path.join(repodata_dir, "repomd.xml")
+        ft_data = util.get_repomd_filetype_dump(repomd_xml)
+        self.assertTrue("updateinfo" in ft_data)
+        self.assertFalse("product" in ft_data)
+        self.assertTrue("primary" in ft_data)
+        self.assertFalse(os.path.exists(os.path.join(repodata_dir,
+            "854c463fd8138340b1ba2fbecd3abb18d44a13a7c35753640880471bf4aea20a-product.gz")))
+        updateinfo_path = os.path.join(self.temp_dir, ft_data["updateinfo"]["location"])
+        self.assertEquals(metadata.gzip.open(updateinfo_path).read(), "<updates></updates>")
+        self.assertTrue(os.path.basename(updateinfo_path).startswith(
+            metadata.util.get_file_checksum(filename=updateinfo_path)))
+
+    def test_repomd_editor_xml_syntax(self):
+        # single quoted attributes, attributes after the type and namespace prefixes
+        repodata_dir = os.path.join(self.temp_dir, "repodata")
+        os.makedirs(repodata_dir)
+        open(os.path.join(repodata_dir, "product.gz"), "w").write("product")
+        repomd_xml = os.path.join(repodata_dir, "repomd.xml")
+        open(repomd_xml, "w").write("""<?xml version='1.0' encoding='UTF-8'?>
+<repo:repomd xmlns:repo='http://linux.duke.edu/metadata/repo' xmlns:rpm='http://linux.duke.edu/metadata/rpm'>
+  <repo:revision>1283359366</repo:revision>
+  <repo:data type='product' extra="1">
+    <repo:checksum type='sha256'>abc</repo:checksum>
+    <repo:location href='repodata/product.gz'/>
+    <repo:timestamp>1314733106</repo:timestamp>
+  </repo:data>
+  <repo:data type="primary"><repo:checksum type="sha256">def</repo:checksum><repo:location href="repodata/primary.xml.gz"/><repo:timestamp>1283359366</repo:timestamp></repo:data>
+</repo:repomd>
+""")
+        updateinfo_xml_path = os.path.join(self.temp_dir, "updateinfo.xml")
+        open(updateinfo_xml_path, "w").write("<updates></updates>")
+
+        editor = repomd.RepomdEditor(repodata_dir, checksum_type="sha256")
+        editor.add(updateinfo_xml_path)
+        editor.remove("product")
+        editor.save()
+        ft_data = util.get_repomd_filetype_dump(repomd_xml)
+        self.assertEquals(sorted(ft_data.keys()), ["primary", "updateinfo"])
+        self.assertEquals(ft_data["primary"]["checksum"], ("sha256", "def"))
+        self.assertFalse(os.path.exists(os.path.join(repodata_dir, "product.gz")))
+        self.assertTrue(os.path.exists(os.path.join(self.temp_dir, ft_data["updateinfo"]["location"])))
@@ -18,6 +18,7 @@ from pulp.bindings.server import PulpConnection
 from pulp.bindings.bindings import Bindings
 from pulp.common.bundle import Bundle as BundleImpl
 from pulp.common.config import Config
+from pulp_rpm.common.profile import ProfileRecord
 
 requires_api_version = '2.5'
 plugin_type = (TYPE_CORE,)
@@ -69,7 +70,16 @@ def posttrans_hook(conduit):
             return # not registered
         bindings = PulpBindings()
         profile = get_profile('rpm').collect()
-        http = bindings.profile.send(myid, 'rpm', profile)
+        record = ProfileRecord()
+        upload = record.form_upload(myid, profile)
+        try:
+            http = bindings.profile.send(myid, 'rpm', upload)
+        except Exception:
+            if upload is profile:
+                raise
+            # the server does not have the recorded profile, send the whole profile
+            http = bindings.profile.send(myid, 'rpm', profile)
+        record.save(myid, profile)
         msg = 'pulp: profile sent, status=%d' % http.response_code
         conduit.info(2, msg)
     except Exception, e: